@@ -14,6 +14,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 from itertools import  product,permutations, combinations_with_replacement, chain
 
+import stage_timer
+
 
 class Unary(nn.Module):
     def __init__(self, embed_size):
@@ -23,13 +25,14 @@ class Unary(nn.Module):
         self.dropout = nn.Dropout()
 
     def forward(self,  X):
-        X = X.transpose(1, 2)
+        with stage_timer.label('atten.unary'):
+            X = X.transpose(1, 2)
 
-        X_embed = self.embed(X)
+            X_embed = self.embed(X)
 
-        X_nl_embed = self.dropout(F.relu(X_embed))
-        X_poten = self.feature_reduce(X_nl_embed)
-        return X_poten.squeeze(1)
+            X_nl_embed = self.dropout(F.relu(X_embed))
+            X_poten = self.feature_reduce(X_nl_embed)
+            return X_poten.squeeze(1)
 
 class Pairwise(nn.Module):
     def __init__(self, embed_x_size, x_spatial_dim=None, embed_y_size=None, y_spatial_dim=None):
@@ -50,31 +53,31 @@ class Pairwise(nn.Module):
             self.margin_Y = nn.Conv1d(self.x_spatial_dim, 1, 1)
 
     def forward(self, X, Y=None):
+        with stage_timer.label('atten.pairwise'):
+            X_t = X.transpose(1, 2)
+            Y_t = Y.transpose(1, 2) if Y is not None else X_t
 
-        X_t = X.transpose(1, 2)
-        Y_t = Y.transpose(1, 2) if Y is not None else X_t
-
-        X_embed = self.embed_X(X_t)
-        Y_embed = self.embed_Y(Y_t)
+            X_embed = self.embed_X(X_t)
+            Y_embed = self.embed_Y(Y_t)
 
-        X_norm = F.normalize(X_embed)
-        Y_norm = F.normalize(Y_embed)
+            X_norm = F.normalize(X_embed)
+            Y_norm = F.normalize(Y_embed)
 
-        S = X_norm.transpose(1, 2).bmm(Y_norm)
-        if self.x_spatial_dim is not None:
-            S = self.normalize_S(S.view(-1, self.x_spatial_dim * self.y_spatial_dim)) \
-                .view(-1, self.x_spatial_dim, self.y_spatial_dim)
+            S = X_norm.transpose(1, 2).bmm(Y_norm)
+            if self.x_spatial_dim is not None:
+                S = self.normalize_S(S.view(-1, self.x_spatial_dim * self.y_spatial_dim)) \
+                    .view(-1, self.x_spatial_dim, self.y_spatial_dim)
 
-            X_poten = self.margin_X(S.transpose(1, 2)).transpose(1, 2).squeeze(2)
-            Y_poten = self.margin_Y(S).transpose(1, 2).squeeze(2)
-        else:
-            X_poten = S.mean(dim=2, keepdim=False)
-            Y_poten = S.mean(dim=1, keepdim=False)
+                X_poten = self.margin_X(S.transpose(1, 2)).transpose(1, 2).squeeze(2)
+                Y_poten = self.margin_Y(S).transpose(1, 2).squeeze(2)
+            else:
+                X_poten = S.mean(dim=2, keepdim=False)
+                Y_poten = S.mean(dim=1, keepdim=False)
 
-        if Y is None:
-            return X_poten
-        else:
-            return X_poten, Y_poten
+            if Y is None:
+                return X_poten
+            else:
+                return X_poten, Y_poten
 
 
 class Atten(nn.Module):
@@ -238,7 +241,7 @@ class Atten(nn.Module):
                 if self.prior_flag:
                     prior = priors[i] \
                         if priors[i] is not None \
-                        else torch.zeros_like(util_poten[i][0], requires_grad=False).cuda()
+                        else torch.zeros_like(util_poten[i][0], requires_grad=False)
 
                     util_poten[i].append(prior)
 
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""Batched beam search over the decoders' initialize/update/predict interface
+   All the hypotheses of all the samples are kept as one batched decoder
+   state of (samples x beam) rows.  Each step runs a single decoder update,
+   selects the candidates with top-k on the device and reorders the states
+   by index.
+"""
+
+import six
+import torch
+
+
+def _expand(x, rows, dim):
+    return x.index_select(dim, rows) if x is not None else None
+
+
+def beam_search(decoder, s, ctx, sos=2, eos=2, unk=0, minlen=1, maxlen=100, beam=5, penalty=1.0, nbest=1,
+                early_stop=True, abs_margin=None, rel_margin=None, stats=None):
+    """Generate sequences using beam search
+
+    The search follows the original per-hypothesis loop: at every step each
+    live hypothesis is completed with eos (once minlen is reached), and the
+    `beam` best extensions by any word but <unk> and eos are kept.
+    With early_stop, the search ends once, for every sample, the nbest-th
+    completed score is not lower than the best score any live hypothesis
+    could still reach (log probabilities are not positive, so a hypothesis
+    can only gain the insertion penalty of its future words).  This does
+    not change the results.  The margins prune the live hypotheses that are
+    too far behind the best one of their sample, which may change them.
+    Args:
+        decoder: decoder module (Summary_HLSTMDecoder, HLSTMDecoder, ...)
+        s (pair of Tensor or None): initial (hidden, cell) states, (layers, B, hidden)
+        ctx (Tensor): decoder context, (B, context_size)
+        sos (int): id number of start-of-sentence label
+        eos (int): id number of end-of-sentence label
+        unk (int): id number of unknown-word label
+        maxlen (int): maximum number of steps
+        beam (int): beam width
+        penalty (float): penalty added to log probabilities
+                         of each output label.
+        nbest (int): number of n-best hypotheses to be output
+        early_stop (bool): stop when no live hypothesis can enter the n-best
+        abs_margin (float or None): prune live hypotheses whose log
+                         probability is more than abs_margin below the best
+        rel_margin (float or None): prune live hypotheses whose log
+                         probability is below (1 + rel_margin) times the best
+        stats (dict or None): if given, 'searches', 'steps' and 'max_steps'
+                         are incremented with the number of samples and of
+                         decoding steps run and allowed for them
+    Return:
+        list (one per sample) of n-best lists of tuples (hyp, score)
+        list (one per sample) of the decoder state (hy, cy, dy) after eos
+            of the best hypothesis, or None
+    """
+    n_samples = ctx.size(0)
+    n_rows = n_samples * beam
+    device = ctx.device
+    # row r holds hypothesis r % beam of sample r // beam
+    rows = torch.tensor([r // beam for r in six.moves.range(n_rows)], dtype=torch.long, device=device)
+    offsets = torch.arange(0, n_samples, dtype=torch.long, device=device) * beam
+    if s is not None:
+        s = (_expand(s[0], rows, 1), _expand(s[1], rows, 1))
+    st = decoder.initialize(s, ctx.index_select(0, rows),
+                            torch.full((n_rows,), sos, dtype=torch.long, device=device))
+    eos_tokens = torch.full((n_rows,), eos, dtype=torch.long, device=device)
+    excluded = torch.tensor([unk, eos], dtype=torch.long, device=device)
+    # only the first hypothesis of each sample is live at the beginning
+    lp = torch.full((n_samples, beam), float('-inf'), device=device)
+    lp[:, 0] = 0.
+    outs = [[] for _ in six.moves.range(n_rows)]
+    comp_hyplist = [[] for _ in six.moves.range(n_samples)]
+    best_lp = torch.full((n_samples,), float('-inf'), device=device)
+    best_state = None
+    # scores of the n-best completed hypotheses of each sample
+    comp_top = torch.full((n_samples, nbest), float('-inf'), device=device)
+    steps = 0
+    for l in six.moves.range(maxlen):
+        steps += 1
+        logp = decoder.predict(st)
+        lp_vec = logp + lp.view(-1, 1)
+        if l >= minlen:
+            new_lp = lp_vec[:, eos] + penalty * (l + 1)
+            # hypotheses not better than the current n-best cannot be output
+            kth = comp_top[:, -1].tolist()
+            for r, score in enumerate(new_lp.tolist()):
+                if score != float('-inf') and score > kth[r // beam]:
+                    comp_hyplist[r // beam].append((outs[r], score))
+            comp_top = torch.cat((comp_top, new_lp.view(n_samples, beam)), 1).topk(nbest, dim=1)[0]
+            # keep the state after eos of the best completed hypothesis
+            max_lp, argmax = new_lp.view(n_samples, beam).max(1)
+            improved = max_lp > best_lp
+            if improved.any():
+                new_st = decoder.update(st, eos_tokens)
+                new_st = [x.index_select(1, offsets + argmax) for x in new_st]
+                if best_state is None:
+                    best_state = new_st
+                else:
+                    mask = improved.view(1, -1, 1)
+                    best_state = [torch.where(mask.expand_as(x), x, y)
+                                  for x, y in zip(new_st, best_state)]
+                best_lp = torch.max(best_lp, max_lp)
+
+        if l == maxlen - 1:
+            break
+        # select the best extensions over all hypotheses of each sample
+        lp_vec.index_fill_(1, excluded, float('-inf'))
+        n_words = lp_vec.size(1)
+        lp, top = lp_vec.view(n_samples, -1).topk(beam, dim=1)
+        # top-k is sorted, so the best live hypothesis is the first one
+        if abs_margin is not None:
+            lp = lp.masked_fill(lp < lp[:, :1] - abs_margin, float('-inf'))
+        if rel_margin is not None:
+            lp = lp.masked_fill(lp < lp[:, :1] * (1. + rel_margin), float('-inf'))
+        if early_stop:
+            bound = lp[:, 0] + max(penalty * (l + 2), penalty * maxlen)
+            if bool((comp_top[:, -1] >= bound).all()):
+                break
+        src = []
+        words = []
+        for b, top_b in enumerate(top.tolist()):
+            for t in top_b:
+                src.append(b * beam + t // n_words)
+                words.append(t % n_words)
+        outs = [outs[r] + [w] for r, w in zip(src, words)]
+        src = torch.tensor(src, dtype=torch.long, device=device)
+        st = decoder.update((st[0].index_select(1, src), st[1].index_select(1, src)),
+                            torch.tensor(words, dtype=torch.long, device=device))
+
+    if stats is not None:
+        stats['searches'] = stats.get('searches', 0) + n_samples
+        stats['steps'] = stats.get('steps', 0) + n_samples * steps
+        stats['max_steps'] = stats.get('max_steps', 0) + n_samples * maxlen
+    maxhyps = []
+    states = []
+    for b in six.moves.range(n_samples):
+        if len(comp_hyplist[b]) > 0:
+            maxhyps.append(sorted(comp_hyplist[b], key=lambda h: -h[1])[:nbest])
+            states.append(tuple(x[:, b:b + 1] for x in best_state))
+        else:
+            maxhyps.append([([], 0)])
+            states.append(None)
+    return maxhyps, states
+
+
+def greedy_search(decoder, s, ctx, sos=2, eos=2, unk=0, minlen=1, maxlen=100, penalty=1.0):
+    """Generate sequences by picking the most likely word at every step
+
+    The words are selected with argmax on the device and the decoding stops
+    as soon as every sequence has emitted eos.  Sequences that reach maxlen
+    without eos are completed with eos.
+    Args:
+        (as for beam_search)
+    Return:
+        list (one per sample) of lists of one tuple (hyp, score)
+        list (one per sample) of the decoder state (hy, cy, dy) after eos
+    """
+    n_samples = ctx.size(0)
+    device = ctx.device
+    st = decoder.initialize(s, ctx, torch.full((n_samples,), sos, dtype=torch.long, device=device))
+    eos_tokens = torch.full((n_samples,), eos, dtype=torch.long, device=device)
+    score = torch.zeros(n_samples, device=device)
+    # torch.where() takes a bool condition (uint8 before torch 1.2)
+    finished = torch.zeros(n_samples, dtype=getattr(torch, 'bool', torch.uint8), device=device)
+    words = []
+    final_state = None
+    for l in six.moves.range(maxlen):
+        logp = decoder.predict(st)
+        logp[:, unk] = float('-inf')
+        if l < minlen:
+            logp[:, eos] = float('-inf')
+        lp, w = logp.max(1)
+        w = torch.where(finished, eos_tokens, w)
+        score = score + torch.where(finished, torch.zeros_like(lp), lp + penalty)
+        st = decoder.update(st, w)
+        done = finished | (w == eos)
+        if final_state is None:
+            final_state = st
+        else:
+            # keep the state right after the eos of each sequence
+            mask = (done & ~finished).view(1, -1, 1)
+            final_state = [torch.where(mask.expand_as(x), x, y) for x, y in zip(st, final_state)]
+        finished = done
+        words.append(w)
+        if finished.all():
+            break
+    if not finished.all():
+        st = decoder.update(st, eos_tokens)
+        mask = (~finished).view(1, -1, 1)
+        final_state = [torch.where(mask.expand_as(x), x, y) for x, y in zip(st, final_state)]
+
+    maxhyps = []
+    for b, (hyp, sc) in enumerate(zip(torch.stack(words, 1).tolist(), score.tolist())):
+        maxhyps.append([([w for w in hyp if w != eos], sc)])
+    return maxhyps, [tuple(x[:, b:b + 1] for x in final_state) for b in six.moves.range(n_samples)]
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+"""CPU microbenchmarks of the data handling and model hot paths
+   The benchmarks run on a synthetic corpus (see synthetic_avsd.py), made
+   on first use in --data-dir, and a model of the qa_run.sh configuration:
+       load                 qa_data_handler.load()
+       make_batch_indices   qa_data_handler.make_batch_indices()
+       make_batch_a         qa_data_handler.make_batch_a() of a mini-batch
+       atten_forward        Atten.forward() of the A-bot attention
+       loss                 MMSeq2SeqModel.loss() forward and backward
+       generate             MMSeq2SeqModel.generate() of one sample
+   Each one is run --warmup times, then timed --repeat times.  The results
+   are written to --output (json); with --compare, the medians are checked
+   against those of an earlier output, and the exit status is 1 if any of
+   them is slower by more than --threshold.
+
+   usage: benchmark.py --data-dir data/synthetic --output bench.json [--compare baseline.json]
+"""
+
+import argparse
+import collections
+import json
+import logging
+import platform
+import sys
+import timeit
+
+import numpy as np
+import six
+import torch
+
+import qa_data_handler as dh
+import synthetic_avsd
+from model_builder import build_model
+
+# options of the benchmarked model (those of qa_run.sh)
+MODEL_OPTIONS = {'embed_size': 128, 'in_enc_layers': 1, 'in_enc_hsize': 256,
+                 'hist_enc_layers': [2, 1], 'hist_enc_hsize': 128, 'hist_out_size': 128,
+                 'dec_layers': 1, 'dec_psize': 256, 'dec_hsize': 256}
+
+FEA_TYPES = [synthetic_avsd.AUDIO_FEATURE, synthetic_avsd.VISUAL_FEATURE]
+
+
+def measure(fn, warmup=2, repeat=10):
+    """Time fn() and return {min, median, mean, std, repeat} (seconds)"""
+    for _ in six.moves.range(warmup):
+        fn()
+    times = []
+    for _ in six.moves.range(repeat):
+        start = timeit.default_timer()
+        fn()
+        times.append(timeit.default_timer() - start)
+    return {'min': float(np.min(times)), 'median': float(np.median(times)),
+            'mean': float(np.mean(times)), 'std': float(np.std(times)), 'repeat': repeat}
+
+
+def batch_tensors(data, index):
+    # the inputs of MMSeq2SeqModel.loss() for a mini-batch, as in qa_train.py
+    x_batch, h_batch, q_batch, a_batch_in, a_batch_out, s_batch, summary_batch_in, summary_batch_out, c_batch = \
+        dh.make_batch_a(data, index)
+    q_batch_in, q_batch_out, all_a_batch_in, all_q_batch_in = dh.make_batch_q(data, index)
+    t = lambda batch: [torch.from_numpy(b) for b in batch]
+    return {'x': t(x_batch), 'h': [t(hb) for hb in h_batch], 'q': t(q_batch), 'c': t(c_batch),
+            'ai': t(a_batch_in), 'ao': t(a_batch_out), 'qi': t(q_batch_in), 'qo': t(q_batch_out),
+            'smi': t(summary_batch_in), 'smo': t(summary_batch_out),
+            'all_ai': t(all_a_batch_in), 'all_qi': t(all_q_batch_in),
+            's': torch.from_numpy(s_batch).float()}
+
+
+def bench_load(env):
+    return lambda: dh.load(FEA_TYPES, env['fea_path'], env['dialog_file'], vocab=dict(env['vocab']))
+
+
+def bench_make_batch_indices(env):
+    return lambda: dh.make_batch_indices(env['data'], env['batch_size'], max_length=env['max_length'])
+
+
+def bench_make_batch_a(env):
+    return lambda: dh.make_batch_a(env['data'], env['index'])
+
+
+def bench_atten_forward(env):
+    model = env['model']
+    b = env['batch']
+    model.eval()
+    with torch.no_grad():
+        s_for_q, s_for_a, a, ei_c, c_prior = model.encode_video(b['x'], b['c'], b['s'])
+        eh_temp, _ = model.history_encoder(None, b['h'])
+    utils = [s_for_a[0], s_for_a[1], s_for_a[2], s_for_a[3], a, ei_c, eh_temp]
+    priors = [None, None, None, None, None, c_prior, None]
+
+    def run():
+        with torch.no_grad():
+            model.a_atten(utils=list(utils), priors=list(priors))
+    return run
+
+
+def bench_loss(env):
+    model = env['model']
+    b = env['batch']
+
+    def run():
+        model.train()
+        model.zero_grad()
+        _, _, loss = model.loss(b['x'], b['h'], b['q'], b['c'], b['ai'], b['qi'], b['smi'],
+                                b['ao'], b['qo'], b['smo'], b['s'], b['all_ai'], b['all_qi'])
+        loss.backward()
+    return run
+
+
+def bench_generate(env):
+    model = env['model']
+    b = env['sample']
+
+    def run():
+        model.eval()
+        # the projections generate() draws are the same in every run
+        torch.manual_seed(1)
+        with torch.no_grad():
+            model.generate(b['x'], b['h'], b['q'], b['c'], b['s'], b['ai'], b['qi'],
+                           b['all_ai'], b['all_qi'], maxlen=20, beam=3, penalty=1.0, nbest=5)
+    return run
+
+
+BENCHMARKS = collections.OrderedDict([
+    ('load', bench_load),
+    ('make_batch_indices', bench_make_batch_indices),
+    ('make_batch_a', bench_make_batch_a),
+    ('atten_forward', bench_atten_forward),
+    ('loss', bench_loss),
+    ('generate', bench_generate),
+])
+
+
+def setup(args):
+    dialog_file, fea_path = synthetic_avsd.ensure(args.data_dir, num_dialogs=args.num_dialogs,
+                                                  vocab_size=args.vocab_size, seed=args.seed)
+    vocab = dh.get_vocabulary(dialog_file)
+    data = dh.load(FEA_TYPES, fea_path, dialog_file, vocab=vocab)
+    # mini-batches are sorted by history length, the middle one is taken
+    indices, _ = dh.make_batch_indices(data, args.batch_size, max_length=args.max_length)
+    index = indices[len(indices) // 2]
+    samples, _ = dh.make_batch_indices(data, 1)
+    torch.manual_seed(args.seed)
+    model = build_model(argparse.Namespace(**MODEL_OPTIONS), vocab)
+    return {'dialog_file': dialog_file, 'fea_path': fea_path, 'vocab': vocab, 'data': data,
+            'batch_size': args.batch_size, 'max_length': args.max_length, 'index': index,
+            'batch': batch_tensors(data, index),
+            'sample': batch_tensors(data, samples[len(samples) // 2]),
+            'model': model}
+
+
+def compare(results, baseline, threshold):
+    """Log the medians against those of the baseline and return the names
+       of the benchmarks that are slower by more than threshold"""
+    regressions = []
+    logging.info('%-20s %12s %12s %8s' % ('benchmark', 'baseline(ms)', 'current(ms)', 'ratio'))
+    for name, st in results['benchmarks'].items():
+        if name not in baseline['benchmarks']:
+            logging.info('%-20s %12s %12.3f %8s' % (name, '-', 1000. * st['median'], '-'))
+            continue
+        base = baseline['benchmarks'][name]['median']
+        ratio = st['median'] / base if base > 0 else float('inf')
+        flag = ''
+        if ratio > 1. + threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        logging.info('%-20s %12.3f %12.3f %8.3f%s' % (name, 1000. * base, 1000. * st['median'], ratio, flag))
+    if baseline.get('scale') != results['scale']:
+        logging.warning('the baseline was run at a different scale: %s' % baseline.get('scale'))
+    return regressions
+
+
+##################################
+# main
+if __name__ =="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', required=True, type=str,
+                        help='Directory of the synthetic corpus (generated if needed)')
+    parser.add_argument('--num-dialogs', default=200, type=int,
+                        help='Number of dialogs of the synthetic corpus')
+    parser.add_argument('--vocab-size', default=2000, type=int,
+                        help='Number of distinct words of the synthetic corpus')
+    parser.add_argument('--seed', default=1, type=int,
+                        help='Random seed of the corpus and model')
+    parser.add_argument('--batch-size', '-b', default=64, type=int,
+                        help='Batch size of the mini-batch benchmarks')
+    parser.add_argument('--max-length', default=256, type=int,
+                        help='Maximum length for controling batch size')
+    parser.add_argument('--only', nargs='+', default=[], choices=list(BENCHMARKS),
+                        help='Benchmarks to run (all by default)')
+    parser.add_argument('--warmup', default=2, type=int,
+                        help='Number of untimed runs of each benchmark')
+    parser.add_argument('--repeat', default=10, type=int,
+                        help='Number of timed runs of each benchmark')
+    parser.add_argument('--threads', default=1, type=int,
+                        help='Number of torch CPU threads')
+    parser.add_argument('--output', '-o', default='', type=str,
+                        help='Results file (.json)')
+    parser.add_argument('--compare', default='', type=str,
+                        help='Results of an earlier run to check for regressions')
+    parser.add_argument('--threshold', default=0.1, type=float,
+                        help='Relative slowdown of the median reported as a regression')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s: %(message)s')
+
+    torch.set_num_threads(args.threads)
+    env = setup(args)
+    results = {'environment': {'python': platform.python_version(), 'torch': torch.__version__,
+                               'numpy': np.__version__, 'machine': platform.machine(),
+                               'threads': args.threads},
+               'scale': {'num_dialogs': args.num_dialogs, 'vocab_size': args.vocab_size,
+                         'seed': args.seed, 'batch_size': args.batch_size,
+                         'max_length': args.max_length},
+               'benchmarks': collections.OrderedDict()}
+    for name in args.only or BENCHMARKS:
+        st = measure(BENCHMARKS[name](env), warmup=args.warmup, repeat=args.repeat)
+        results['benchmarks'][name] = st
+        logging.info('%-20s median %10.3f ms  min %10.3f ms  std %8.3f ms'
+                     % (name, 1000. * st['median'], 1000. * st['min'], 1000. * st['std']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            logging.warning('slower than the baseline: ' + ', '.join(regressions))
+            sys.exit(1)
+    logging.info('done')
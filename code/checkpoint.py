@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""Resumable training checkpoints
+   A checkpoint holds the model and optimizer states, the random generator
+   states and the position in the training loop, so that qa_train.py
+   --resume continues from the batch after the one it was taken at.
+   The states are copied to host memory on the training thread (a
+   snapshot), and written to disk by a background thread while training
+   goes on.  <model>.ckpt.json lists the checkpoints on disk; the last
+   --keep-last ones and the one of the best validation perplexity are kept.
+"""
+
+import json
+import logging
+import os
+import random
+import threading
+
+import numpy as np
+import torch
+from six.moves import queue
+
+
+def _to_host(obj):
+    # copy all the tensors of a (nested) state dict to host memory
+    if torch.is_tensor(obj):
+        t = obj.detach().cpu()
+        return t.clone() if t.data_ptr() == obj.data_ptr() else t
+    if isinstance(obj, dict):
+        return type(obj)((k, _to_host(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_host(v) for v in obj)
+    return obj
+
+
+def rng_states():
+    states = {'random': random.getstate(), 'numpy': np.random.get_state(),
+              'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states):
+    random.setstate(states['random'])
+    np.random.set_state(states['numpy'])
+    torch.set_rng_state(states['torch'])
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+
+def snapshot(model, optimizer, scheduler=None, **progress):
+    """Copy the training state to host memory
+
+    Args:
+        model (nn.Module): model
+        optimizer (Optimizer): optimizer
+        scheduler: learning rate scheduler, if any
+        progress: position in the training loop and running statistics
+    Return:
+        dict to be given to AsyncCheckpointer.save() and restore()
+    """
+    return {'model': _to_host(model.state_dict()),
+            'optimizer': _to_host(optimizer.state_dict()),
+            'scheduler': scheduler.state_dict() if scheduler is not None else None,
+            'rng': rng_states(),
+            'progress': progress}
+
+
+def restore(state, model, optimizer, scheduler=None):
+    """Load a checkpoint into the model and optimizer
+
+    Return:
+        the progress dict given to snapshot()
+    """
+    model.load_state_dict(state['model'])
+    optimizer.load_state_dict(state['optimizer'])
+    if scheduler is not None and state['scheduler'] is not None:
+        scheduler.load_state_dict(state['scheduler'])
+    set_rng_states(state['rng'])
+    return state['progress']
+
+
+def index_file(prefix):
+    return prefix + '.ckpt.json'
+
+
+def latest(prefix):
+    """Return the file of the last checkpoint listed for prefix, or None"""
+    if not os.path.exists(index_file(prefix)):
+        return None
+    with open(index_file(prefix), 'r') as f:
+        entries = json.load(f)['checkpoints']
+    return os.path.join(os.path.dirname(prefix), entries[-1]['file']) if entries else None
+
+
+def reset(prefix):
+    """Forget the checkpoints of an earlier run (their files are left)"""
+    if os.path.exists(index_file(prefix)):
+        os.remove(index_file(prefix))
+
+
+def load(path):
+    return torch.load(path, map_location='cpu')
+
+
+class AsyncCheckpointer(object):
+
+    def __init__(self, prefix, keep_last=2, keep_best=True, await_validation=False):
+        """Start the writer thread
+
+        Args:
+            prefix (str): path prefix of the checkpoints (the model name)
+            keep_last (int): number of most recent checkpoints kept (at least 1)
+            keep_best (bool): also keep the checkpoint of the best validation
+            await_validation (bool): the validation perplexities of the
+                checkpoints of the end of the epochs are given later, by
+                set_valid_ppl(); those checkpoints are kept until then
+        """
+        if keep_last < 1:
+            raise ValueError('keep_last must be at least 1, not %d' % keep_last)
+        self.prefix = prefix
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.await_validation = await_validation
+        self.entries = []
+        self.best = None
+        if os.path.exists(index_file(prefix)):
+            with open(index_file(prefix), 'r') as f:
+                index = json.load(f)
+            self.entries = index['checkpoints']
+            self.best = index.get('best')
+        self.error = None
+        self.jobs = queue.Queue()
+        thread = threading.Thread(target=self._loop)
+        thread.daemon = True
+        thread.start()
+
+
+    def _loop(self):
+        while True:
+            job, args = self.jobs.get()
+            try:
+                job(*args)
+            except Exception as e:
+                logging.exception('checkpoint writer failed')
+                self.error = e
+            self.jobs.task_done()
+
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+    def submit(self, job, *args):
+        """Run job(*args) on the writer thread, after the previous jobs"""
+        self._check()
+        self.jobs.put((job, args))
+
+
+    def save(self, state, epoch, iteration, valid_ppl=None):
+        """Write a snapshot in the background
+
+        Args:
+            state (dict): output of snapshot()
+            epoch (int), iteration (int): position the training resumes from
+            valid_ppl (float): validation perplexity, for keep-best
+        """
+        name = '%s.ckpt_%d_%d.pt' % (os.path.basename(self.prefix), epoch, iteration)
+        self.submit(self._write, state, name, epoch, iteration, valid_ppl)
+
+
+    def set_valid_ppl(self, epoch, valid_ppl):
+        """Record, in the background, the validation perplexity of the
+           checkpoint of the end of an epoch (see await_validation)"""
+        self.submit(self._set_valid_ppl, epoch, valid_ppl)
+
+
+    def wait(self):
+        """Block until all the submitted jobs are written"""
+        self.jobs.join()
+        self._check()
+
+
+    def _write(self, state, name, epoch, iteration, valid_ppl):
+        path = os.path.join(os.path.dirname(self.prefix), name)
+        torch.save(state, path + '.tmp')
+        os.rename(path + '.tmp', path)
+        entry = {'file': name, 'epoch': epoch, 'iteration': iteration, 'valid_ppl': valid_ppl}
+        self.entries = [e for e in self.entries if e['file'] != name] + [entry]
+        if valid_ppl is not None and (self.best is None or valid_ppl < self.best['valid_ppl']):
+            self.best = entry
+        self._prune()
+        logging.info('checkpoint written to %s' % path)
+
+
+    def _set_valid_ppl(self, epoch, valid_ppl):
+        entries = [e for e in self.entries if e['epoch'] == epoch and e['iteration'] == 0]
+        if not entries:
+            logging.warning('no checkpoint of the end of epoch %d to record its validation '
+                            'perplexity' % epoch)
+            return
+        entries[0]['valid_ppl'] = valid_ppl
+        if self.best is None or valid_ppl < self.best['valid_ppl']:
+            self.best = entries[0]
+        self._prune()
+
+
+    def _prune(self):
+        # update the index and remove the checkpoints that are not kept
+        keep = set(e['file'] for e in self.entries[-self.keep_last:])
+        if self.keep_best and self.best is not None:
+            keep.add(self.best['file'])
+        if self.await_validation:
+            keep.update(e['file'] for e in self.entries if e['iteration'] == 0 and e['valid_ppl'] is None)
+        removed = [e for e in self.entries if e['file'] not in keep]
+        self.entries = [e for e in self.entries if e['file'] in keep]
+        # the index is updated before the old files are removed
+        with open(index_file(self.prefix) + '.tmp', 'w') as f:
+            json.dump({'checkpoints': self.entries, 'best': self.best}, f, indent=1)
+        os.rename(index_file(self.prefix) + '.tmp', index_file(self.prefix))
+        for e in removed:
+            try:
+                os.remove(os.path.join(os.path.dirname(self.prefix), e['file']))
+            except OSError:
+                pass
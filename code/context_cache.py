@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""Cache of the per-video context used in generation
+   The frame, audio and caption encodings returned by
+   MMSeq2SeqModel.encode_video() only depend on the video and the model
+   weights, so they are computed once per video and shared by all the turns
+   and dialogs about it.  Entries are kept in memory up to a size limit, the
+   least recently used first out; with a spill directory, evicted entries
+   are written to disk and read back on the next use.
+"""
+
+import collections
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+import torch
+
+
+def _nbytes(context):
+    return sum(x.numel() * x.element_size() for x in context)
+
+
+class ContextCache(object):
+
+    def __init__(self, checkpoint_hash='', max_bytes=1 << 30, spill_dir=None):
+        """Initialize the cache
+
+        Args:
+            checkpoint_hash (str): hash of the model checkpoint, part of the
+                keys so that spilled entries of other models are not used
+            max_bytes (int): size limit of the entries kept in memory
+            spill_dir (str or None): directory for the evicted entries
+        """
+        self.checkpoint_hash = checkpoint_hash
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if spill_dir and not os.path.isdir(spill_dir):
+            os.makedirs(spill_dir)
+
+
+    def key(self, vid, caption):
+        """Key of a video; the caption is included since it is given with each dialog"""
+        content = json.dumps([self.checkpoint_hash, vid, np.asarray(caption).tolist()])
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+    def _file(self, key):
+        return os.path.join(self.spill_dir, key + '.pt')
+
+
+    def get(self, key, device=None):
+        """Return the context of one sample stored for key, or None"""
+        if key in self.entries:
+            context = self.entries.pop(key)
+            self.entries[key] = context
+            self.hits += 1
+            return context
+        if self.spill_dir and os.path.exists(self._file(key)):
+            context = tuple(torch.load(self._file(key), map_location='cpu'))
+            if device is not None:
+                context = tuple(x.to(device) for x in context)
+            self.disk_hits += 1
+            self._insert(key, context)
+            return context
+        self.misses += 1
+        return None
+
+
+    def put(self, key, context):
+        """Store the context of one sample (a tuple of tensors)"""
+        if key in self.entries:
+            self.total_bytes -= _nbytes(self.entries.pop(key))
+        self._insert(key, tuple(x.detach() for x in context))
+
+
+    def _insert(self, key, context):
+        self.entries[key] = context
+        self.total_bytes += _nbytes(context)
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            old_key, old_context = self.entries.popitem(last=False)
+            self.total_bytes -= _nbytes(old_context)
+            if self.spill_dir and not os.path.exists(self._file(old_key)):
+                tmp = self._file(old_key) + '.tmp.%d' % os.getpid()
+                torch.save([x.cpu() for x in old_context], tmp)
+                os.rename(tmp, self._file(old_key))
+
+
+    def stats(self):
+        return {'hits': self.hits + self.disk_hits, 'disk_hits': self.disk_hits,
+                'lookups': self.hits + self.disk_hits + self.misses,
+                'entries': len(self.entries), 'bytes': self.total_bytes}
+
+
+    def report(self):
+        st = self.stats()
+        logging.info('context cache: %d hits (%d from disk) / %d lookups (%.1f%%), %d entries, %d bytes in memory'
+                     % (st['hits'], st['disk_hits'], st['lookups'],
+                        100. * st['hits'] / st['lookups'] if st['lookups'] > 0 else 0.,
+                        st['entries'], st['bytes']))
+
+
+def video_context(model, cache, keys, mx, c, s):
+    """Return the output of model.encode_video() for a batch, encoding only
+       the samples whose context is not cached
+
+    Args:
+        model (MMSeq2SeqModel): model
+        cache (ContextCache or None): cache, encode_video() is called if None
+        keys (list of str): cache keys of the samples
+        mx, c, s: batched inputs as for generate()
+    """
+    if cache is None:
+        return model.encode_video(mx, c, s)
+    contexts = [cache.get(key, s.device) for key in keys]
+    missing = [b for b, context in enumerate(contexts) if context is None]
+    if len(missing) > 0:
+        idx = torch.tensor(missing, dtype=torch.long)
+        sub_mx = [x.index_select(1, idx) for x in mx]
+        sub_c = [c[b] for b in missing]
+        sub_s = s.index_select(1, idx.to(s.device))
+        for b, context in zip(missing, model.split_context(model.encode_video(sub_mx, sub_c, sub_s))):
+            cache.put(keys[b], context)
+            contexts[b] = context
+    return model.merge_context(contexts)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""LSTM recurrences with a constant per-sequence context
+   The decoders feed the LSTM with [word embedding; context], where the
+   context is the same vector at every step of a sequence.  Since
+       W_ih [e; c] + b_ih = W_e e + (W_c c + b_ih)
+   the context part is multiplied through the input weights once per
+   sequence and added to every step as a bias.  This is used in step-wise
+   decoding (beam search), where each step is a separate call anyway; the
+   teacher-forced training pass keeps the fused cuDNN nn.LSTM over a packed
+   batch.  The functions below reuse the parameters of an existing nn.LSTM,
+   so checkpoints are unchanged.
+"""
+
+import six
+import torch
+import torch.nn.functional as F
+
+
+def supported(lstm):
+    """Check that the module exposes plain float weights (e.g. not quantized)"""
+    weights = [getattr(lstm, 'weight_ih_l0', None), getattr(lstm, 'weight_hh_l0', None)]
+    return all(isinstance(w, torch.Tensor) and not getattr(w, 'is_quantized', False)
+               for w in weights)
+
+
+def _layer_weights(lstm, l):
+    return (getattr(lstm, 'weight_ih_l%d' % l), getattr(lstm, 'weight_hh_l%d' % l),
+            getattr(lstm, 'bias_ih_l%d' % l, None), getattr(lstm, 'bias_hh_l%d' % l, None))
+
+
+def _cell(gates, c):
+    # gate order of nn.LSTM: input, forget, cell, output
+    i, f, g, o = gates.chunk(4, 1)
+    c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+    h = torch.sigmoid(o) * torch.tanh(c)
+    return h, c
+
+
+def context_gates(lstm, ctx):
+    """Project the constant context through the first-layer input weights
+
+    Args:
+        lstm (nn.LSTM): LSTM whose input is [embedding; context].
+        ctx (Tensor): context vectors, (batch, context_size).
+    Return:
+        (Tensor) (batch, 4 * hidden_size) input gate bias, including b_ih
+    """
+    w_ih = lstm.weight_ih_l0
+    return F.linear(ctx, w_ih[:, w_ih.size(1) - ctx.size(1):], getattr(lstm, 'bias_ih_l0', None))
+
+
+def _initial_state(lstm, s, x, n):
+    if s is None:
+        zeros = x.new_zeros((lstm.num_layers, n, lstm.hidden_size))
+        return list(zeros), list(zeros)
+    return list(s[0]), list(s[1])
+
+
+def step(lstm, emb, gates, s=None):
+    """Run a single step
+
+    Args:
+        lstm (nn.LSTM): LSTM whose input is [embedding; context].
+        emb (Tensor): word embeddings, (batch, embed_size).
+        gates (Tensor): output of context_gates(), (batch or 1, 4 * hidden_size).
+        s (pair of Tensor or None): (hidden, cell) states, (layers, batch, hidden_size).
+    Return:
+        (hy, cy): updated states, (layers, batch, hidden_size)
+    """
+    h, c = _initial_state(lstm, s, emb, emb.size(0))
+    x = F.linear(emb, lstm.weight_ih_l0[:, :emb.size(1)]) + gates
+    for l in six.moves.range(lstm.num_layers):
+        w_ih, w_hh, b_ih, b_hh = _layer_weights(lstm, l)
+        if l > 0:
+            x = F.linear(x, w_ih, b_ih)
+        h[l], c[l] = _cell(x + F.linear(h[l], w_hh, b_hh), c[l])
+        x = h[l]
+    return torch.stack(h, 0), torch.stack(c, 0)
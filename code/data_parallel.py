@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""Multi-process data-parallel training
+   qa_train.py --num-workers N runs N copies of itself, with the RANK,
+   WORLD_SIZE, MASTER_ADDR and MASTER_PORT variables that
+   torch.distributed reads from the environment (so the workers can also be
+   started by torch.distributed.launch or a cluster scheduler).  Each worker
+   trains on its own shard of the mini-batches, and the gradients are
+   averaged over the workers after every backward pass, so that all the
+   replicas apply the same update.
+"""
+
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+import six
+import torch
+import torch.distributed as dist
+
+
+def is_worker():
+    """Whether this process was started as one of the workers"""
+    return 'RANK' in os.environ and 'WORLD_SIZE' in os.environ
+
+
+def launch(num_workers, port=29500, addr='127.0.0.1'):
+    """Run the current command in num_workers processes
+
+    The workers are stopped as soon as one of them fails, since the others
+    would wait for it forever.
+    Return:
+        exit status (0 if all the workers succeeded)
+    """
+    procs = []
+    for rank in six.moves.range(num_workers):
+        env = dict(os.environ, RANK=str(rank), WORLD_SIZE=str(num_workers),
+                   MASTER_ADDR=addr, MASTER_PORT=str(port))
+        procs.append(subprocess.Popen([sys.executable] + sys.argv, env=env))
+    status = 0
+    while any(p.poll() is None for p in procs):
+        failed = [p for p in procs if p.poll() not in (None, 0)]
+        if failed:
+            status = failed[0].returncode
+            for p in procs:
+                if p.poll() is None:
+                    p.terminate()
+        time.sleep(1)
+    for p in procs:
+        status = status or p.wait()
+    return status
+
+
+def init(backend='gloo'):
+    """Join the process group described by the environment
+
+    Return:
+        rank, world size
+    """
+    rank = int(os.environ['RANK'])
+    world_size = int(os.environ['WORLD_SIZE'])
+    dist.init_process_group(backend, init_method='env://', rank=rank, world_size=world_size)
+    return rank, world_size
+
+
+def shard(indices, rank, world_size):
+    """Mini-batches of a worker, the same number for every worker so that
+       they all take part in every gradient exchange"""
+    n = len(indices) // world_size
+    return indices[rank::world_size][:n]
+
+
+def broadcast_parameters(model):
+    """Copy the parameters and buffers of rank 0 to all the workers"""
+    for tensor in model.state_dict().values():
+        dist.broadcast(tensor, 0)
+
+
+def average_gradients(params, world_size):
+    """Average the gradients over the workers, in a single all-reduce
+
+    Parameters that got no gradient in this step are given a zero gradient,
+    so that all the workers reduce buffers of the same layout.
+    """
+    grads = []
+    for p in params:
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+        grads.append(p.grad.data)
+    flat = torch._utils._flatten_dense_tensors(grads)
+    dist.all_reduce(flat)
+    flat /= world_size
+    for grad, synced in zip(grads, torch._utils._unflatten_dense_tensors(flat, grads)):
+        grad.copy_(synced)
+
+
+def all_sum(values):
+    """Sum a list of numbers over the workers"""
+    t = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(t)
+    return t.tolist()
+
+
+def record_scaling(path, world_size, steps_per_sec, batch_size):
+    """Append the throughput of this run to a scaling report and log the
+       throughput of all the runs in it against their number of workers
+
+    Args:
+        path (str): json-lines report file
+        world_size (int): number of workers
+        steps_per_sec (float): optimizer steps per second (each worker
+            processes one mini-batch per step)
+        batch_size (int): mini-batch size
+    """
+    with open(path, 'a') as f:
+        f.write(json.dumps({'workers': world_size, 'iters_per_sec': steps_per_sec,
+                            'batches_per_sec': steps_per_sec * world_size,
+                            'batch_size': batch_size}) + '\n')
+    runs = {}
+    with open(path, 'r') as f:
+        for line in f:
+            run = json.loads(line)
+            # the last run with each number of workers
+            runs[run['workers']] = run
+    base = runs.get(1)
+    logging.info('workers  iters/sec  batches/sec  speedup  efficiency')
+    for workers in sorted(runs):
+        run = runs[workers]
+        if base is not None and base['batches_per_sec'] > 0:
+            speedup = run['batches_per_sec'] / base['batches_per_sec']
+            logging.info('%7d  %9.3f  %11.3f  %7.2f  %9.1f%%'
+                         % (workers, run['iters_per_sec'], run['batches_per_sec'],
+                            speedup, 100. * speedup / workers))
+        else:
+            logging.info('%7d  %9.3f  %11.3f        -          -'
+                         % (workers, run['iters_per_sec'], run['batches_per_sec']))
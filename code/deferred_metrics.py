@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""Loss sums kept on the device
+   Reading a loss back to the host (loss.item(), loss.cpu()) waits for the
+   device to finish the step, so the host cannot queue the next one in the
+   meantime.  A WordLoss adds the losses of the mini-batches as tensors on
+   the device they were computed on, and is read only when a perplexity is
+   reported.
+"""
+
+import math
+
+import torch
+
+
+class WordLoss(object):
+
+    def __init__(self, total=0., words=0):
+        """Initialize the sums
+
+        Args:
+            total (float): sum of the per-word losses so far
+            words (int): number of words so far
+        """
+        self.total = total
+        self.words = words
+
+
+    def add(self, loss, num_words):
+        """Add the mean per-word loss of num_words words, without reading it"""
+        if torch.is_tensor(loss):
+            loss = loss.detach().double() * num_words
+        else:
+            loss = loss * num_words
+        self.total = loss + self.total
+        self.words += num_words
+
+
+    def value(self):
+        """Sum of the per-word losses (synchronizes with the device)"""
+        if torch.is_tensor(self.total):
+            self.total = self.total.item()
+        return self.total
+
+
+    def perplexity(self):
+        return math.exp(self.value() / self.words)
+
+
+    def reset(self):
+        self.total = 0.
+        self.words = 0
@@ -10,7 +10,6 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import six
-import scipy.io as sio
 #from atten import H_Q_Attention
 
 class HLSTMEncoder(nn.Module):
@@ -47,6 +46,7 @@ class HLSTMEncoder(nn.Module):
         """
         # word level within sentence
         sx = []
+        device = next(self.embed.parameters()).device
         # print("length of xs:",len(xs)) # num of qa pairs before the current question 
         for l in six.moves.range(len(xs)):
             if len(xs[l]) != 0: # if there is dialog history
@@ -55,7 +55,7 @@ class HLSTMEncoder(nn.Module):
                 #print("xs[l]:", xs[l])
                 # print("sections:", sections.shape)
                 aa = torch.cat(xs[l], 0)
-                bb = self.embed(torch.tensor(aa, dtype=torch.long).cuda())
+                bb = self.embed(torch.tensor(aa, dtype=torch.long).to(device))
                 cc = sections.tolist()
                 wj = torch.split(bb, cc, dim=0)
                 wj = list(wj)
@@ -79,12 +79,12 @@ class HLSTMEncoder(nn.Module):
             if len(xs[l]) > 1:
                 idx = (cc - 1).view(-1, 1).expand(ys.size(0), ys.size(2)).unsqueeze(1)
                 idx = torch.tensor(idx, dtype=torch.long)
-                decoded = ys.gather(1, idx.cuda()).squeeze()
+                decoded = ys.gather(1, idx.to(device)).squeeze()
 
                 # restore the sorting
                 cc2, perm_index2 = torch.sort(perm_index, 0)
                 odx = perm_index2.view(-1, 1).expand(ys.size(0), ys.size(-1))
-                decoded = decoded.gather(0, odx.cuda())
+                decoded = decoded.gather(0, odx.to(device))
             else:
                 decoded = ys[:, -1, :]
 
@@ -109,6 +109,31 @@ class HLSTMEncoder(nn.Module):
         return sxs, shy
 
 
+    def extend(self, x, s=None):
+        """Encode one more history sentence of a single dialog
+           The word-level state is carried from one sentence to the next as in
+           __call__, so encoding a history sentence by sentence gives the same
+           vectors as encoding it at once, and the vectors of a history prefix
+           do not depend on the sentences that follow.
+        Args:
+            x (~chainer.Variable): word ids of the sentence
+            s (pair of ~chainer.Variable or None): word-level (hidden, cell) states
+                after the previous sentence, None for the first one.
+        Return:
+            the sentence vector, (1, hidden_size)
+            (hy, cy): word-level states to be passed with the next sentence
+        """
+        device = next(self.embed.parameters()).device
+        w = self.embed(torch.tensor(x, dtype=torch.long).to(device)).unsqueeze(0)
+        packed_w = nn.utils.rnn.pack_padded_sequence(w, [len(x)], batch_first=True)
+        if s is None or (hasattr(self, 'independent') and self.independent):
+            ys, (why, wcy) = self.wlstm(packed_w)
+        else:
+            ys, (why, wcy) = self.wlstm(packed_w, s)
+        ys = nn.utils.rnn.pad_packed_sequence(ys, batch_first=True)[0]
+        return ys[:, -1, :], (why, wcy)
+
+
 
 
 # class HLSTMMemory(nn.Module):
@@ -9,7 +9,6 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import scipy.io as sio
 
 
 class LSTMEncoder(nn.Module):
@@ -46,7 +45,8 @@ class LSTMEncoder(nn.Module):
             sections = np.array([len(x) for x in xs], dtype=np.int32)
             # aa = self.embed(torch.tensor(xs[0][0],dtype=torch.long).cuda())
             aa = torch.cat(xs, 0)
-            bb = self.embed(torch.tensor(aa, dtype=torch.long).cuda())
+            device = next(self.embed.parameters()).device
+            bb = self.embed(torch.tensor(aa, dtype=torch.long).to(device))
             cc = sections.tolist()
             wj = torch.split(bb, cc, dim=0)
             wj = list(wj)
@@ -66,7 +66,7 @@ class LSTMEncoder(nn.Module):
             ys, (hy,cy) = self.lstm(packed_wj)
         #resorting
         ys, _ = nn.utils.rnn.pad_packed_sequence(ys, batch_first=True)
-        original_idx = perm_index.unsqueeze(1).unsqueeze(1).expand(-1, ys.shape[1], ys.shape[2]).cuda()
+        original_idx = perm_index.unsqueeze(1).unsqueeze(1).expand(-1, ys.shape[1], ys.shape[2]).to(ys.device)
         ys = torch.zeros_like(ys).scatter_(0, original_idx, ys)
 
 
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""Memory footprint accounting
+   deep_size() gives the host memory held by a (nested) object: the loaded
+   datasets, an assembled mini-batch.  A MemoryAccount records, for each
+   phase of a run (loading, an epoch of training, validation, a generation
+   call), the resident set size at its end and its peak, and the CUDA memory
+   allocated by tensors.  The peak RSS is that of the phase where the kernel
+   allows resetting it (Linux, /proc/self/clear_refs), and the peak of the
+   whole run so far otherwise.
+"""
+
+import collections
+import logging
+import resource
+import sys
+
+import numpy as np
+import torch
+
+from shared_embedding import OPTIMIZER_STATES
+
+MB = float(1 << 20)
+
+
+def deep_size(obj, seen=None):
+    """Bytes of host memory held by obj and everything it refers to, each
+       object (and tensor storage) counted once"""
+    if seen is None:
+        seen = set()
+    if torch.is_tensor(obj):
+        key = ('storage', obj.data_ptr())
+        if key in seen or obj.is_cuda:
+            return sys.getsizeof(obj)
+        seen.add(key)
+        return sys.getsizeof(obj) + obj.numel() * obj.element_size()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, np.ndarray):
+        # the data of a view (or a memory map) belongs to its base
+        if obj.base is not None and not isinstance(obj.base, np.memmap):
+            size += deep_size(obj.base, seen)
+    elif isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(v, seen) for v in obj)
+    return size
+
+
+def dataset_sizes(data):
+    """Return the bytes of the parts of a dataset loaded by qa_data_handler
+
+    The features are read per mini-batch; 'feature_files' is the size of the
+    arrays they refer to, which are not held in memory.
+    """
+    sizes = collections.OrderedDict()
+    for key in ('dialogs', 'original', 'features', 'vocab'):
+        sizes[key] = deep_size(data[key])
+    files = {}
+    for features in data['features']:
+        for value in features.values():
+            itemsize = np.dtype(value[3]).itemsize if len(value) == 4 else 4
+            files[value[0], value[2] if len(value) == 4 else 0] = int(np.prod(value[1])) * itemsize
+    sizes['feature_files'] = sum(files.values())
+    return sizes
+
+
+def log_dataset(name, data):
+    sizes = dataset_sizes(data)
+    logging.info('%s data: %s' % (name, ', '.join('%s %.1f MB' % (k, v / MB) for k, v in sizes.items())))
+    return sizes
+
+
+def state_bytes(model, optimizer=None):
+    """Return the bytes of the parameters, gradients and optimizer states"""
+    sizes = collections.OrderedDict()
+    params = list(model.parameters())
+    sizes['params'] = sum(p.numel() * p.element_size() for p in params)
+    sizes['grads'] = sum(p.grad.numel() * p.grad.element_size() for p in params if p.grad is not None)
+    if optimizer is not None:
+        sizes['optimizer'] = sum(v.numel() * v.element_size() for state in optimizer.state.values()
+                                 for v in state.values() if torch.is_tensor(v))
+    return sizes
+
+
+def rss():
+    """Current resident set size in bytes (Linux), or None"""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+
+def peak_rss():
+    """Peak resident set size in bytes, since the last reset_peak_rss()"""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    # kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def reset_peak_rss():
+    """Reset the peak RSS to the current one, if the kernel allows it"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _reset_cuda_peak():
+    reset = getattr(torch.cuda, 'reset_peak_memory_stats', None) or \
+        getattr(torch.cuda, 'reset_max_memory_allocated', None)
+    if reset is not None:
+        reset()
+
+
+def projected_bytes(model, optimizer_name, batch_bytes, device):
+    """Host memory projected for training: the current RSS, two mini-batches
+       (the current one and the prefetched one) and, on CPU, the gradients
+       and optimizer states still to be allocated.  The activations are not
+       included.
+    """
+    total = (rss() or peak_rss()) + 2 * batch_bytes
+    if device.type == 'cpu':
+        params = state_bytes(model)['params']
+        total += params * (1 + OPTIMIZER_STATES.get(optimizer_name, 0))
+    return total
+
+
+class _Phase(object):
+
+    def __init__(self, account, name):
+        self.account = account
+        self.name = name
+
+
+    def __enter__(self):
+        self.account.begin(self.name)
+        return self
+
+
+    def __exit__(self, *exc):
+        self.account.end(self.name)
+        return False
+
+
+class MemoryAccount(object):
+
+    def __init__(self, model=None, optimizer=None):
+        """Initialize the account
+
+        Args:
+            model (nn.Module): model whose states are reported with each phase
+            optimizer (Optimizer): its optimizer
+        """
+        self.model = model
+        self.optimizer = optimizer
+        self.cuda = torch.cuda.is_available()
+        self.phases = collections.OrderedDict()
+
+
+    def phase(self, name):
+        """Context accounting for the memory of a phase"""
+        return _Phase(self, name)
+
+
+    def begin(self, name):
+        reset_peak_rss()
+        if self.cuda:
+            _reset_cuda_peak()
+
+
+    def end(self, name):
+        """Record and log the memory of the phase that ends, and return it"""
+        record = collections.OrderedDict([('rss', rss()), ('peak_rss', peak_rss())])
+        if self.cuda:
+            record['cuda_allocated'] = torch.cuda.memory_allocated()
+            record['cuda_peak'] = torch.cuda.max_memory_allocated()
+        if self.model is not None:
+            record.update(state_bytes(self.model, self.optimizer))
+        self.phases[name] = record
+        logging.info('memory %s: %s' % (name, ', '.join('%s %.1f MB' % (k, v / MB)
+                                                          for k, v in record.items() if v is not None)))
+        return record
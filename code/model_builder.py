@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""Construction of the model from the training options
+   Only the model classes are imported here, so that generation can
+   rebuild a model (see model_io.load) without importing the training code.
+"""
+
+import torch
+import torch.nn as nn
+
+from new_qa_bot_model import MMSeq2SeqModel
+from lstm_encoder import LSTMEncoder
+from hlstm_encoder import HLSTMEncoder
+from hlstm_decoder import HLSTMDecoder
+from summary_decoder import Summary_HLSTMDecoder
+from question_decoder import Question_HLSTMDecoder
+import shared_embedding
+
+
+def initialize_model_weights(model, initialization, lstm_initialization):
+    if initialization == "he":
+        print("kaiming normal initialization.")
+    elif initialization == "xavier":
+        print("xavier normal initialization.")
+    else:
+        print("default initialization, no changes made.")
+    if(initialization):
+        for name, param in model.named_parameters():
+            print("\n"+name)
+
+            # Bias params
+            if("bias" in name.split(".")[-1]):
+                print("zero")
+                param.data.zero_()
+
+            # Batchnorm weight params
+            elif("weight" in name.split(".")[-1] and len(param.size())==1):
+                print("batchnorm weight: default initialization")
+
+            # LSTM weight params
+            elif("weight" in name.split(".")[-1] and "lstm" in name):
+                if "xavier" in lstm_initialization:
+                    print("xavier")
+                    torch.nn.init.xavier_normal(param)
+                elif "he" in lstm_initialization:
+                    print("he")
+                    torch.nn.init.kaiming_normal(param)
+
+            # Other weight params
+            elif("weight" in name.split(".")[-1] and "lstm" not in name):
+                if "xavier" in initialization:
+                    print("xavier")
+                    torch.nn.init.xavier_normal(param)
+                elif "he" in initialization:
+                    print("he")
+                    torch.nn.init.kaiming_normal(param)
+
+
+def build_model(args, vocab):
+    """Construct the model from the training options
+
+    With args.share_embedding, a single vocabulary embedding table is shared
+    by the encoders and decoders (projected where the widths differ).
+    """
+    if getattr(args, 'share_embedding', False):
+        embed_model = nn.Embedding(len(vocab), args.shared_embed_size or args.embed_size)
+    else:
+        embed_model = None
+    embed = shared_embedding.consumer_embedding(embed_model, args.embed_size)
+    dropout = 0.5
+    model = MMSeq2SeqModel(
+        None,
+        HLSTMEncoder(args.hist_enc_layers[0], args.hist_enc_layers[1],
+                     len(vocab), args.hist_out_size, args.embed_size,
+                     args.hist_enc_hsize, dropout=dropout, embed=embed),
+        LSTMEncoder(args.in_enc_layers, len(vocab), args.in_enc_hsize,
+                    args.embed_size, dropout=dropout, embed=embed),
+        LSTMEncoder(args.in_enc_layers, len(vocab), args.in_enc_hsize,
+                    args.embed_size, dropout=dropout, embed=embed),
+        HLSTMDecoder(args.dec_layers, len(vocab), len(vocab), args.embed_size,
+                    args.hist_out_size + args.in_enc_hsize,
+                     args.dec_hsize, args.dec_psize,
+                     independent=False, dropout=dropout, embed=embed),
+        Summary_HLSTMDecoder(args.dec_layers, len(vocab), len(vocab), args.embed_size,
+                    args.hist_out_size + args.in_enc_hsize,
+                     args.dec_hsize, args.dec_psize,
+                     independent=False, dropout=dropout, embed=embed),
+        Question_HLSTMDecoder(args.dec_layers, len(vocab), len(vocab), args.embed_size,
+                    args.hist_out_size + args.in_enc_hsize,
+                     args.dec_hsize, args.dec_psize,
+                     independent=False, dropout=dropout, embed=embed),
+        )
+    return model
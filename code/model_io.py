@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""State-dict checkpoints
+   A checkpoint is a directory holding
+       config.json  vocabulary and training options
+       index.json   name, dtype, shape and byte offset of each tensor
+       state.bin    the tensor data, one after the other
+   The model is rebuilt from the options with model_builder.build_model(),
+   so loading does not depend on the module layout at save time, and the
+   tensors are read through a memory map instead of being unpickled.
+"""
+
+import argparse
+import json
+import os
+import pickle
+
+import numpy as np
+import torch
+
+import model_builder
+
+# alignment of each tensor in state.bin
+ALIGN = 64
+
+# modules that are only used by the training loss
+TRAINING_ONLY = ('sampled_softmax.',)
+
+
+def is_checkpoint(path):
+    return os.path.isfile(os.path.join(path, 'index.json'))
+
+
+def save(model, vocab, args, path):
+    """Write a checkpoint directory
+
+    Args:
+        model (MMSeq2SeqModel): model to save
+        vocab (dict): vocabulary
+        args (Namespace): training options given to model_builder.build_model()
+        path (str): checkpoint directory
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    index = []
+    offsets = {}
+    offset = 0
+    with open(os.path.join(path, 'state.bin.tmp'), 'wb') as f:
+        for name, tensor in model.state_dict().items():
+            if name.startswith(TRAINING_ONLY):
+                continue
+            # parameters shared by several modules are stored once
+            key = (tensor.data_ptr(), tuple(tensor.size()))
+            if key not in offsets:
+                array = tensor.detach().cpu().contiguous().numpy()
+                f.write(b'\0' * (-offset % ALIGN))
+                offset += -offset % ALIGN
+                offsets[key] = (offset, str(array.dtype))
+                f.write(array.tobytes())
+                offset += array.nbytes
+            index.append({'name': name, 'dtype': offsets[key][1],
+                          'shape': list(tensor.size()), 'offset': offsets[key][0]})
+    config = {'vocab': vocab, 'args': vars(args),
+              'memory_report': getattr(model, 'memory_report', None)}
+    with open(os.path.join(path, 'config.json.tmp'), 'w') as f:
+        json.dump(config, f)
+    with open(os.path.join(path, 'index.json.tmp'), 'w') as f:
+        json.dump(index, f)
+    # the index is written last, so that a partial checkpoint is not loaded
+    for name in ('state.bin', 'config.json', 'index.json'):
+        os.rename(os.path.join(path, name + '.tmp'), os.path.join(path, name))
+
+
+def load_config(path):
+    """Return the vocabulary, training options and memory report of a checkpoint"""
+    with open(os.path.join(path, 'config.json'), 'r') as f:
+        config = json.load(f)
+    return config['vocab'], argparse.Namespace(**config['args']), config.get('memory_report')
+
+
+def _assign(model, name, tensor):
+    # follow the attribute path, since modules shared by several parents
+    # are listed once by named_parameters()
+    parts = name.split('.')
+    module = model
+    for part in parts[:-1]:
+        module = getattr(module, part)
+    if parts[-1] in module._parameters:
+        module._parameters[parts[-1]].data = tensor
+    elif parts[-1] in module._buffers:
+        module._buffers[parts[-1]] = tensor
+    else:
+        raise KeyError('unexpected tensor ' + name)
+
+
+def load(path, device=None):
+    """Rebuild a model from a checkpoint directory
+
+    On the CPU, the parameters are views of the memory-mapped file
+    (copy-on-write), so only the pages that are used are read.  On other
+    devices they are copied from the map.
+    Return:
+        model, vocab, training options
+    """
+    vocab, args, memory_report = load_config(path)
+    with open(os.path.join(path, 'index.json'), 'r') as f:
+        index = json.load(f)
+    mapped = np.memmap(os.path.join(path, 'state.bin'), dtype=np.uint8, mode='c')
+    state = {}
+    for entry in index:
+        dtype = np.dtype(entry['dtype'])
+        count = int(np.prod(entry['shape']))
+        array = mapped[entry['offset']:entry['offset'] + count * dtype.itemsize].view(dtype)
+        state[entry['name']] = torch.from_numpy(array.reshape(entry['shape']))
+
+    # the random initialization of the new model must not change the
+    # generator state seen by generation, as with a pickled model
+    rng_state = torch.get_rng_state()
+    model = model_builder.build_model(args, vocab)
+    torch.set_rng_state(rng_state)
+    model.memory_report = memory_report
+    if device is None:
+        device = torch.device('cpu')
+    elif not isinstance(device, torch.device):
+        device = torch.device(device)
+    if device.type == 'cpu':
+        missing = set(model.state_dict().keys()) - set(state.keys())
+        if missing:
+            raise KeyError('missing tensors in %s: %s' % (path, ', '.join(sorted(missing))))
+        for name, tensor in state.items():
+            _assign(model, name, tensor)
+    else:
+        model.to(device)
+        model.load_state_dict(state)
+    return model, vocab, args
+
+
+def load_model(model_path, conf_path='', device=None):
+    """Load a model saved by qa_train.py in either format
+
+    Args:
+        model_path (str): checkpoint name without extension; the state-dict
+            directory model_path + '.state' is used if it exists, and the
+            pickled model_path + '.pth.tar' otherwise
+        conf_path (str): pickled (vocab, args) file for a pickled model
+        device: device to move the model to
+    Return:
+        model, vocab, training options, files the model was read from
+    """
+    if is_checkpoint(model_path + '.state'):
+        path = model_path + '.state'
+        model, vocab, args = load(path, device)
+        return model, vocab, args, [os.path.join(path, 'config.json'), os.path.join(path, 'state.bin')]
+    with open(conf_path, 'rb') as f:
+        vocab, args = pickle.load(f)
+    model = torch.load(model_path + '.pth.tar')
+    if getattr(model, 'quantized', False):
+        # int8 models (see quantize_model.py) run on the CPU only
+        device = torch.device('cpu')
+    if device is not None:
+        model.to(device)
+    return model, vocab, args, [model_path + '.pth.tar']
@@ -11,6 +11,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 import random
 from atten import Atten
+import beam_search
+import stage_timer
 torch.manual_seed(1)
 
 
@@ -72,12 +74,59 @@ class MMSeq2SeqModel(nn.Module):
                 ds (pair of ~chainer.Variable(s)): decoder state
                 loss (~chainer.Variable) : cross-entropy loss
         """
+        hidden_temporal_state_for_q, es_rounds = self.unroll_rounds(mx, hx, c, y_a, y_q, s, all_ai, all_qi)
+        es_final = es_rounds[-1]
+        with stage_timer.scope('model.summary'):
+            return self.summary_loss(hidden_temporal_state_for_q, es_final, y_s, t_s)
+
+
+    def dialog_loss(self, mx, hx, c, y_a, y_q, y_s, t_s, s, all_ai, all_qi, n_cuts=0):
+        """ Dialog-level forward propagation and loss calculation
+            The rounds of a dialog are unrolled once from its first turn and the
+            summary loss is attached at every history cut point, i.e. to the
+            Q-bot context at the start of each round, instead of unrolling the
+            remaining rounds again for every turn of the dialog.
+            Args:
+                (same as loss, for a batch made of the first turn of each dialog)
+                n_cuts (int): number of cut points sampled for the batch
+                              (0 uses all of them)
+            Return:
+                es (pair of ~chainer.Variable(s)): encoder state
+                ds (pair of ~chainer.Variable(s)): decoder state
+                loss (~chainer.Variable) : cross-entropy loss over all cut points
+        """
+        hidden_temporal_state_for_q, es_rounds = self.unroll_rounds(mx, hx, c, y_a, y_q, s, all_ai, all_qi)
+        cuts = list(six.moves.range(len(es_rounds)))
+        if 0 < n_cuts < len(cuts):
+            cuts = sorted(random.sample(cuts, n_cuts))
+        n = len(cuts)
+
+        # decode the summary for all cut points in a single batch
+        es_cuts = torch.cat([es_rounds[k] for k in cuts], dim=0)
+        state = tuple(st.repeat(1, n, 1) for st in hidden_temporal_state_for_q)
+        t_cuts = list(t_s) * n if t_s is not None else None
+        with stage_timer.scope('model.summary'):
+            return self.summary_loss(state, es_cuts, list(y_s) * n, t_cuts)
+
+
+    def unroll_rounds(self, mx, hx, c, y_a, y_q, s, all_ai, all_qi):
+        """ Unroll the Q-bot/A-bot dialog rounds with teacher forcing
+            Args:
+                hx (list of ~chainer.Variable): dialog history
+                all_ai, all_qi (list of ~chainer.Variable): remaining answers
+                                and questions of the dialog
+            Return:
+                hidden_temporal_state_for_q: visual state of the Q-bot
+                es_rounds (list): Q-bot context at the start of each round
+        """
 
         ###################################################################
         qa_id = len(hx)
         remain_len = 10 - len(hx)
-        eh_temp, eh = self.history_encoder(None, hx)
+        with stage_timer.scope('model.history'):
+            eh_temp, eh = self.history_encoder(None, hx)
         round_n = 0
+        es_rounds = []
         while qa_id < 11:
             #print('round_n', round_n)
             if qa_id < 9:
@@ -143,10 +192,15 @@ class MMSeq2SeqModel(nn.Module):
                 a_a_s_for_q = torch.cat([u.unsqueeze(1) for u in a_s_for_q], dim=1)
                 _, hidden_temporal_state_for_q = self.q_emb_temporal_sp(a_a_s_for_q)
 
-            ei_for_q = self.q_atten(utils=[s_for_q[0], s_for_q[3], eh_temp], priors=[None, None, None])
+            with stage_timer.scope('model.q_attention'):
+                ei_for_q = self.q_atten(utils=[s_for_q[0], s_for_q[3], eh_temp], priors=[None, None, None])
             es_for_q = ei_for_q[2]
+            es_rounds.append(es_for_q)
 
-            _, _, dq = self.q_question_decoder(hidden_temporal_state_for_q, es_for_q, seperate_qi)
+            # only the hidden states are needed here; the summary decoder
+            # provides the loss, so the vocabulary projection is skipped
+            with stage_timer.scope('model.q_decoder'):
+                _, _, dq = self.q_question_decoder(hidden_temporal_state_for_q, es_for_q, seperate_qi, output=False)
 
             _, (r_dq,dc) = self.qalstm(dq.transpose(0,1))      
 
@@ -158,9 +212,9 @@ class MMSeq2SeqModel(nn.Module):
                 ei_c, ei_len_c = self.a_caption_encoder(None, c)
                 # print('ei_c:', ei_c.size())
                 # print('ei_len_c:', ei_len_c.size())
-                c_prior = torch.zeros(ei_c.size(0), ei_c.size(1)).cuda()
-                idx_c = torch.from_numpy(ei_len_c - 1).long().cuda()
-                batch_index_c = torch.arange(0, ei_len_c.shape[0]).long().cuda()
+                c_prior = torch.zeros(ei_c.size(0), ei_c.size(1), device=s.device)
+                idx_c = torch.from_numpy(ei_len_c - 1).long().to(s.device)
+                batch_index_c = torch.arange(0, ei_len_c.shape[0]).long().to(s.device)
                 c_prior[batch_index_c, idx_c] = 1
 
                 # visual input for A BOT
@@ -173,7 +227,7 @@ class MMSeq2SeqModel(nn.Module):
                  # print("visual embedding before attention:", s.size()) is (4, 64, 49, 256)
 
                  # Audio input for A BOT
-                a = mx[0].cuda().permute(1, 2, 0)
+                a = mx[0].to(s.device).permute(1, 2, 0)
                 a = self.a_emb_a(a)
                 a = a.transpose(1, 2)
 
@@ -186,7 +240,8 @@ class MMSeq2SeqModel(nn.Module):
                 a_a_s = torch.cat([a_a.unsqueeze(1)] + [u.unsqueeze(1) for u in a_s_for_a], dim=1)
                 _, hidden_temporal_state_for_a = self.a_emb_temporal_sp(a_a_s)
 
-            ei = self.a_atten(utils=[s_for_a[0], s_for_a[1], s_for_a[2], s_for_a[3], a, ei_c, eh_temp], priors=[None, None, None, None, None, c_prior, None])
+            with stage_timer.scope('model.a_attention'):
+                ei = self.a_atten(utils=[s_for_a[0], s_for_a[1], s_for_a[2], s_for_a[3], a, ei_c, eh_temp], priors=[None, None, None, None, None, c_prior, None])
             a_c = ei[5]
             a_h = ei[6]
             es_for_a = torch.cat((a_c, a_h, r_dq.squeeze(0)), dim=1)
@@ -194,10 +249,11 @@ class MMSeq2SeqModel(nn.Module):
         #generate answer for the given question
             if hasattr(self.a_response_decoder, 'context_to_state') \
                 and self.a_response_decoder.context_to_state==True:
-                _,  _, da = self.a_response_decoder(es_for_a, None, y_a) 
+                _,  _, da = self.a_response_decoder(es_for_a, None, y_a, output=False)
             else:
             # decode
-                _, _, da = self.a_response_decoder(hidden_temporal_state_for_a, es_for_a, seperate_ai)
+                with stage_timer.scope('model.a_decoder'):
+                    _, _, da = self.a_response_decoder(hidden_temporal_state_for_a, es_for_a, seperate_ai, output=False)
 
 ##################################################################################################################
 
@@ -205,36 +261,58 @@ class MMSeq2SeqModel(nn.Module):
             qa_id += 1
             round_n += 1
             r_p = torch.cat((dq,da), dim=1).transpose(0,1)
-            _, (r_p, _) = self.qalstm(r_p)
+            with stage_timer.scope('model.qa_lstm'):
+                _, (r_p, _) = self.qalstm(r_p)
 
             eh_temp = torch.cat((eh_temp, r_p.transpose(0,1)), dim=1)
+        return hidden_temporal_state_for_q, es_rounds
+
 
-###################################################################################################################
-        if qa_id == 11:
-                es_final = es_for_q
-
-            #generate summary 
-                if hasattr(self.q_summary_decoder, 'context_to_state') \
-                    and self.q_summary_decoder.context_to_state==True:
-                    ds_q, dy_q = self.q_summary_decoder(es_final, None, y_s) 
-                else:
-                    # decode
-                    ds_q, dy_q = self.q_summary_decoder(hidden_temporal_state_for_q, es_final, y_s)
-
-                # compute loss
-                if t_s is not None:
-                    tt = torch.cat(t_s, dim=0)
-                    loss = F.cross_entropy(dy_q, torch.tensor(tt, dtype=torch.long).cuda())
-                    #max_index = dy.max(dim=1)[1]
-                    #hit = (max_index == torch.tensor(tt, dtype=torch.long).cuda()).sum()
-                    #cul_loss += loss
-                    return None, ds_q, loss
-                else:  # if target is None, it only returns states
-                    return None, ds_q
+    def summary_loss(self, state, es_final, y_s, t_s):
+        """ Decode the summary from the final Q-bot context and compute the loss
+            Args:
+                state (pair of ~chainer.Variable): initial decoder state
+                es_final (~chainer.Variable): Q-bot context
+                y_s (list of ~chainer.Variable): list of summary input sequences
+                t_s (list of ~chainer.Variable): list of summary target sequences
+                                   if t_s is None, it returns only states
+            Return:
+                es (pair of ~chainer.Variable(s)): encoder state
+                ds (pair of ~chainer.Variable(s)): decoder state
+                loss (~chainer.Variable) : cross-entropy loss
+        """
+        # the sampled softmax replaces the full output layer in training only
+        sampled = self.training and t_s is not None \
+            and getattr(self, 'sampled_softmax', None) is not None
+
+        #generate summary 
+        if hasattr(self.q_summary_decoder, 'context_to_state') \
+            and self.q_summary_decoder.context_to_state==True:
+            ds_q, dy_q = self.q_summary_decoder(es_final, None, y_s, logits=not sampled)
+        else:
+            # decode
+            ds_q, dy_q = self.q_summary_decoder(state, es_final, y_s, logits=not sampled)
+
+        # compute loss
+        if t_s is not None:
+            tt = torch.cat(t_s, dim=0)
+            if sampled:
+                out = self.q_summary_decoder.out
+                loss = self.sampled_softmax(dy_q, out.weight, out.bias,
+                                            torch.tensor(tt, dtype=torch.long).to(dy_q.device))
+            else:
+                loss = F.cross_entropy(dy_q, torch.tensor(tt, dtype=torch.long).to(dy_q.device))
+            #max_index = dy.max(dim=1)[1]
+            #hit = (max_index == torch.tensor(tt, dtype=torch.long).cuda()).sum()
+            #cul_loss += loss
+            return None, ds_q, loss
+        else:  # if target is None, it only returns states
+            return None, ds_q
 ###################################################################################################
 
 
-    def generate(self, mx, hx, x, c, s, y_a, y_q, all_ai, all_qi, sos=2, eos=2, unk=0, minlen=1, maxlen=100, beam=5, penalty=1.0, nbest=1):
+    def generate(self, mx, hx, x, c, s, y_a, y_q, all_ai, all_qi, sos=2, eos=2, unk=0, minlen=1, maxlen=100, beam=5, penalty=1.0, nbest=1,
+                 inner_decode='beam', inner_maxlen=None, summary_opts=None, context=None):
         """ Generate sequence using beam search
             Args:
                 es (pair of ~chainer.Variable(s)): encoder state
@@ -247,6 +325,16 @@ class MMSeq2SeqModel(nn.Module):
                 penalty (float): penalty added to log probabilities
                                  of each output label.
                 nbest (int): number of n-best hypotheses to be output
+                inner_decode (str): decoding of the questions and answers of
+                                 the rounds, 'beam' (beam search of width 1)
+                                 or 'greedy' (argmax, stops at eos)
+                inner_maxlen (int): maximum length of the questions and
+                                 answers, maxlen if None
+                summary_opts (dict): other keyword arguments of the summary
+                                 beam search (early_stop, abs_margin, rel_margin,
+                                 stats), see beam_search.beam_search()
+                context (tuple): output of encode_video(), e.g. from a
+                                 context_cache.ContextCache, computed if None
             Return:
                 list of tuples (hyp, score): n-best hypothesis list
                  - hyp (list): generated word Id sequence
@@ -255,131 +343,179 @@ class MMSeq2SeqModel(nn.Module):
         """
 
 
-        qa_id = len(hx)
-        remain_len = 10 - len(hx)
-        eh_temp, eh = self.history_encoder(None, hx)
-        round_n = 0
-	lin_layer = nn.Linear(256,128).cuda()
+        maxhyps, states = self.generate_batch(mx, hx, c, s, sos=sos, eos=eos, unk=unk, minlen=minlen,
+                                              maxlen=maxlen, beam=beam, penalty=penalty, nbest=nbest,
+                                              inner_decode=inner_decode, inner_maxlen=inner_maxlen,
+                                              summary_opts=summary_opts, context=context)
+        return maxhyps[0], states[0]
 
-        while qa_id < 11:
-            #print('round_n', round_n)
-            if qa_id < 9:
-                seperate_ai = []
-                seperate_qi = []
-                for k in range(len(all_ai)):
-                    temp_ai = all_ai[k]
-                    temp_qi = all_qi[k]
-                    ai_count = 0
-                    qi_count = 0
-                    for ki in range(len(temp_qi)):
-                        if temp_qi[ki] == 2 and qi_count == round_n:
-                            pos_s = ki
-                        if temp_qi[ki] == 2 and qi_count == (round_n+1):
-                            pos_e = ki
-                        if temp_qi[ki] == 2:
-                            qi_count += 1
-                    qi = temp_qi[pos_s: pos_e]
-                    seperate_qi.append(qi)
-                            #break
-                    for ki in range(len(temp_ai)):
-                        if temp_ai[ki] == 2 and ai_count == round_n:
-                            pos_s = ki
-                        if temp_ai[ki] == 2 and ai_count == (round_n+1):
-                            pos_e = ki
-                        if temp_ai[ki] == 2:
-                            ai_count += 1
-                    ai = temp_ai[pos_s: pos_e]
 
-                    seperate_ai.append(ai)
-            else:
-                seperate_ai = y_a
-                seperate_qi = y_q
+    def input_device(self):
+        """ Device the inputs of generate() are expected on
+            (the LSTM and Linear layers may be quantized, and the remaining
+            float parameters are used to find it)
+        """
+        return next(self.parameters()).device
 
+
+    def round_projection(self):
+        """ Projection of the Q/A decoder cell states used in generation
+            generate() draws a freshly initialized layer for each sample from
+            the global random generator; the draw is kept separate so that
+            batched callers can reproduce the per-sample draws.
+        """
+        return nn.Linear(256, 128).to(self.input_device())
+
+
+    def encode_history(self, hx):
+        """ Encode the dialog history of each sample on its own
+            The history encoder carries its word-level state from one sentence
+            to the next in length-sorted order, so encoding several samples
+            together does not give the same vectors as encoding them one by one.
+            The vectors of the first n sentences are those of a history of
+            length n, so the history of a dialog at every turn is a prefix of
+            the one of its last turn.
+            Return:
+                history vectors, (samples, sentences, hist_out_size)
+        """
+        eh = []
+        for b in six.moves.range(len(hx[0])):
+            state = None
+            sx = []
+            for h in hx:
+                x, state = self.history_encoder.extend(h[b], state)
+                sx.append(x)
+            eh.append(torch.stack(sx, dim=1))
+        return torch.cat(eh, dim=0)
+
+
+    def encode_video(self, mx, c, s):
+        """ Encode the inputs that do not depend on the dialog history
+            (frames for both agents, audio and caption for the A-bot), so that
+            they can be shared by all the turns of a dialog
+            Return:
+                (s_for_q, s_for_a, a, ei_c, c_prior)
+        """
+        # visual input for Q BOT
+        num_samples = s.shape[0]
+        s_for_q = s.view(-1, s.size(2), s.size(3)).transpose(1, 2)
+        s_for_q = self.q_emb_s(s_for_q)
+        s_for_q = s_for_q.view(num_samples, -1, s_for_q.size(1), s_for_q.size(2)).transpose(2, 3)
+
+        # caption embed for A BOT
+        ei_c, ei_len_c = self.a_caption_encoder(None, c)
+        c_prior = torch.zeros(ei_c.size(0), ei_c.size(1), device=s.device)
+        idx_c = torch.from_numpy(ei_len_c - 1).long().to(s.device)
+        batch_index_c = torch.arange(0, ei_len_c.shape[0]).long().to(s.device)
+        c_prior[batch_index_c, idx_c] = 1
+
+        # visual input for A BOT
+        s_for_a = s.view(-1, s.size(2), s.size(3)).transpose(1, 2)
+        s_for_a = self.a_emb_s(s_for_a)
+        s_for_a = s_for_a.view(num_samples, -1, s_for_a.size(1), s_for_a.size(2)).transpose(2, 3)
+
+        a = mx[0].to(s.device).permute(1, 2, 0)
+        a = self.a_emb_a(a)
+        a = a.transpose(1, 2)
+        return s_for_q, s_for_a, a, ei_c, c_prior
+
+
+    def split_context(self, context):
+        """ Split the output of encode_video() into one tuple per sample
+            (copies, so that a sample does not keep the whole batch alive)
+        """
+        s_for_q, s_for_a, a, ei_c, c_prior = context
+        return [(s_for_q[:, b:b + 1].clone(), s_for_a[:, b:b + 1].clone(),
+                 a[b:b + 1].clone(), ei_c[b:b + 1].clone(), c_prior[b:b + 1].clone())
+                for b in six.moves.range(a.size(0))]
+
+
+    def merge_context(self, contexts):
+        """ Inverse of split_context(), the samples must have the same
+            audio and caption lengths
+        """
+        s_for_q, s_for_a, a, ei_c, c_prior = zip(*contexts)
+        return (torch.cat(s_for_q, dim=1), torch.cat(s_for_a, dim=1),
+                torch.cat(a, dim=0), torch.cat(ei_c, dim=0), torch.cat(c_prior, dim=0))
+
+
+    def _project(self, x, lin_layers):
+        # apply the projection of each sample to its own column
+        return torch.cat([lin(x[:, b:b + 1]) for b, lin in enumerate(lin_layers)], dim=1)
+
+
+    def _decode_round(self, decoder, state, es, lin_layers, sos, eos, unk, minlen, maxlen, penalty, inner_decode='beam'):
+        """ Decode a question or an answer for all samples and return the
+            projected cell state after eos of the best hypothesis
+        """
+        if inner_decode == 'greedy':
+            _, states = beam_search.greedy_search(decoder, state, es, sos=sos, eos=eos, unk=unk, minlen=minlen,
+                                                  maxlen=maxlen, penalty=penalty)
+        else:
+            _, states = beam_search.beam_search(decoder, state, es, sos=sos, eos=eos, unk=unk, minlen=minlen,
+                                                maxlen=maxlen, beam=1, penalty=penalty, nbest=1)
+        if any(st is None for st in states):
+            raise ValueError('no complete hypothesis within maxlen=%d' % maxlen)
+        return self._project(torch.cat([st[1] for st in states], dim=1), lin_layers)
+
+
+    def generate_batch(self, mx, hx, c, s, lin_layers=None, sos=2, eos=2, unk=0, minlen=1, maxlen=100, beam=5, penalty=1.0, nbest=1,
+                       context=None, history=None, inner_decode='beam', inner_maxlen=None, summary_opts=None):
+        """ Generate summaries for a batch of samples
+            The samples are decoded independently, so a batch gives the same
+            results as one generate() call per sample as long as it does not
+            introduce padding (same history, audio and caption lengths).
+            Args:
+                mx, hx, c, s: batched inputs as for generate()
+                lin_layers (list of nn.Linear): per-sample projections of the
+                                Q/A decoder states (see round_projection)
+                context (tuple): output of encode_video() for these samples,
+                                computed from mx, c and s if None
+                history (Tensor): output of encode_history() for these samples,
+                                computed from hx if None
+                inner_decode, inner_maxlen: decoding of the rounds, see generate()
+                summary_opts (dict): options of the summary beam search, see generate()
+                (other arguments as for generate())
+            Return:
+                list (one per sample) of n-best lists of tuples (hyp, score)
+                list (one per sample) of the decoder states of the best hypothesis
+        """
+        n_samples = s.size(1)
+        if inner_maxlen is None:
+            inner_maxlen = maxlen
+        if lin_layers is None:
+            lin_layers = [self.round_projection() for _ in six.moves.range(n_samples)]
+
+        if context is None:
+            context = self.encode_video(mx, c, s)
+        s_for_q, s_for_a, a, ei_c, c_prior = context
+        eh_temp = self.encode_history(hx) if history is None else history
+        qa_id = eh_temp.size(1)
+        round_n = 0
+        while qa_id < 11:
         # ###########Q BOT##################################################
 
             if round_n == 0:
 
-                # visual input for Q BOT
-                num_samples = s.shape[0]
-                s_for_q = s.view(-1, s.size(2), s.size(3)).transpose(1, 2)
-                s_for_q = self.q_emb_s(s_for_q)
-                s_for_q = s_for_q.view(num_samples, -1, s_for_q.size(1), s_for_q.size(2)).transpose(2, 3)
-
-            	# Multimodal attention
+                # Multimodal attention
                 ei_for_q = self.q_atten(utils=[s_for_q[0], s_for_q[3], eh_temp], priors=[None, None, None])
 
-            	# Prepare the decoder
+                # Prepare the decoder
                 a_s_for_q = [ei_for_q[0], ei_for_q[1]]
                 a_a_s_for_q = torch.cat([u.unsqueeze(1) for u in a_s_for_q], dim=1)
                 _, hidden_temporal_state_for_q = self.q_emb_temporal_sp(a_a_s_for_q)
 
-            ei_for_q = self.q_atten(utils=[s_for_q[0], s_for_q[3], eh_temp], priors=[None, None, None])
+            with stage_timer.scope('model.q_attention'):
+                ei_for_q = self.q_atten(utils=[s_for_q[0], s_for_q[3], eh_temp], priors=[None, None, None])
             es_for_q = ei_for_q[2]
 
-	    ##################################################
-	    inq_ds = self.q_question_decoder.initialize(hidden_temporal_state_for_q, es_for_q, torch.from_numpy(np.asarray([sos])).cuda())
-	    inq_hyplist = [([], 0., inq_ds)]
-	    inq_best_state = None
-	    inq_comp_hyplist = []
-	    for l in six.moves.range(maxlen):
-		new_hyplist = []
-		argmin = 0
-		for out, lp, st in inq_hyplist:
-		    logp = self.q_question_decoder.predict(st)
-		    lp_vec = logp.cpu().data.numpy() + lp
-		    lp_vec = np.squeeze(lp_vec)
-		    if l >= minlen:
-			new_lp = lp_vec[eos] + penalty * (len(out) + 1)
-			new_st = self.q_question_decoder.update(st, torch.from_numpy(np.asarray([eos])).cuda())
-			inq_comp_hyplist.append((out, new_lp))
-			if inq_best_state is None or inq_best_state[0] < new_lp:
-			    inq_best_state = (new_lp, new_st)
-
-		    for o in np.argsort(lp_vec)[::-1]:
-			if o == unk or o == eos:
-			    continue
-			new_lp = lp_vec[o]
-			if len(new_hyplist) == 1:
-			    if new_hyplist[argmin][1] < new_lp:
-				new_st = self.q_question_decoder.update(st, torch.from_numpy(np.asarray([o])).cuda())
-				new_hyplist[argmin] = (out + [o], new_lp, new_st)
-				argmin = min(enumerate(new_hyplist), key=lambda h: h[1][1])[0]
-			    else:
-				break
-			else:
-			    new_st = self.q_question_decoder.update(st, torch.from_numpy(np.asarray([o])).cuda())
-			    new_hyplist.append((out + [o], new_lp, new_st))
-			    if len(new_hyplist) == 1:
-				argmin = min(enumerate(new_hyplist), key=lambda h: h[1][1])[0]
-		inq_hyplist = new_hyplist
-	    if len(inq_comp_hyplist) > 0:
-		inq_maxhyps = sorted(inq_comp_hyplist, key=lambda h: -h[1])[:nbest]
-		r_dq = inq_best_state[1][1]
-		r_dq = r_dq.cuda()
-		r_dq = lin_layer(r_dq)
-		
+            r_dq = self._decode_round(self.q_question_decoder, hidden_temporal_state_for_q, es_for_q,
+                                      lin_layers, sos, eos, unk, minlen, inner_maxlen, penalty, inner_decode)
+
         #################   A bot #####################
 
             if round_n == 0:
 
-
-                # caption embed for A BOT
-                ei_c, ei_len_c = self.a_caption_encoder(None, c)
-                c_prior = torch.zeros(ei_c.size(0), ei_c.size(1)).cuda()
-                idx_c = torch.from_numpy(ei_len_c - 1).long().cuda()
-                batch_index_c = torch.arange(0, ei_len_c.shape[0]).long().cuda()
-                c_prior[batch_index_c, idx_c] = 1
-		
-                # visual input for A BOT
-                num_samples = s.shape[0]
-                s_for_a = s.view(-1, s.size(2), s.size(3)).transpose(1, 2)
-                s_for_a = self.a_emb_s(s_for_a)
-                s_for_a = s_for_a.view(num_samples, -1, s_for_a.size(1), s_for_a.size(2)).transpose(2, 3)
-
-                a = mx[0].cuda().permute(1, 2, 0)
-                a = self.a_emb_a(a)
-                a = a.transpose(1, 2)
-
                 # Multimodal attention
                 ei = self.a_atten(utils=[s_for_a[0], s_for_a[1], s_for_a[2], s_for_a[3], a, ei_c, eh_temp], priors=[None, None, None, None, None, c_prior, None])
 
@@ -389,113 +525,37 @@ class MMSeq2SeqModel(nn.Module):
                 a_h = ei[6]
                 a_a_s = torch.cat([a_a.unsqueeze(1)] + [u.unsqueeze(1) for u in a_s_for_a], dim=1)
                 _, hidden_temporal_state_for_a = self.a_emb_temporal_sp(a_a_s)
-                #eh_temp, eh = self.history_encoder(None, hx)
 
-            ei = self.a_atten(utils=[s_for_a[0], s_for_a[1], s_for_a[2], s_for_a[3], a, ei_c, eh_temp], priors=[None, None, None, None, None, c_prior, None])
+            with stage_timer.scope('model.a_attention'):
+                ei = self.a_atten(utils=[s_for_a[0], s_for_a[1], s_for_a[2], s_for_a[3], a, ei_c, eh_temp], priors=[None, None, None, None, None, c_prior, None])
             a_c = ei[5]
             a_h = ei[6]
             es_for_a = torch.cat((a_c, a_h, r_dq.squeeze(0)), dim=1)
 
             #generate answer for the given question
-	    ina_ds = self.a_response_decoder.initialize(hidden_temporal_state_for_a, es_for_a, torch.from_numpy(np.asarray([sos])).cuda())
-	    ina_hyplist = [([], 0., ina_ds)]
-	    ina_best_state = None
-	    ina_comp_hyplist = []
-	    for l in six.moves.range(maxlen):
-		new_hyplist = []
-		argmin = 0
-		for out, lp, st in ina_hyplist:
-		    logp = self.a_response_decoder.predict(st)
-		    lp_vec = logp.cpu().data.numpy() + lp
-		    lp_vec = np.squeeze(lp_vec)
-		    if l >= minlen:
-			new_lp = lp_vec[eos] + penalty * (len(out) + 1) 
-			new_st = self.a_response_decoder.update(st, torch.from_numpy(np.asarray([eos])).cuda())
-			ina_comp_hyplist.append((out, new_lp))
-			if ina_best_state is None or ina_best_state[0] < new_lp:
-			    ina_best_state = (new_lp, new_st)
-
-		    for o in np.argsort(lp_vec)[::-1]:
-			if o == unk or o == eos:
-			    continue
-			new_lp = lp_vec[o]
-			if len(new_hyplist) == 1:
-			    if new_hyplist[argmin][1] < new_lp:
-				new_st = self.a_response_decoder.update(st, torch.from_numpy(np.asarray([o])).cuda())
-				new_hyplist[argmin] = (out + [o], new_lp, new_st)
-				argmin = min(enumerate(new_hyplist), key=lambda h: h[1][1])[0]
-			    else:
-				break
-			else:
-			    new_st = self.a_response_decoder.update(st, torch.from_numpy(np.asarray([o])).cuda())
-			    new_hyplist.append((out + [o], new_lp, new_st))
-			    if len(new_hyplist) == 1:
-				argmin = min(enumerate(new_hyplist), key=lambda h: h[1][1])[0]
-
-		ina_hyplist = new_hyplist
-	    if len(ina_comp_hyplist) > 0:
-		ina_maxhyps = sorted(ina_comp_hyplist, key=lambda h: -h[1])[:nbest]
-		r_da = ina_best_state[1][1].cuda()
-		r_da = lin_layer(r_da)
-
+            r_da = self._decode_round(self.a_response_decoder, hidden_temporal_state_for_a, es_for_a,
+                                      lin_layers, sos, eos, unk, minlen, inner_maxlen, penalty, inner_decode)
 
 ##################################################################################################################
 
 
             qa_id += 1
             round_n += 1
-	    r_p = torch.cat((r_dq,r_da),dim=2)
-	    r_p = lin_layer(r_p)
+            r_p = torch.cat((r_dq,r_da),dim=2)
+            r_p = self._project(r_p, lin_layers)
             eh_temp = torch.cat((eh_temp, r_p.transpose(0,1)), dim=1)
 
+        if round_n == 0:
+            # the history already holds all the QA pairs: no round is
+            # generated and the summary is decoded from the history itself
+            ei_for_q = self.q_atten(utils=[s_for_q[0], s_for_q[3], eh_temp], priors=[None, None, None])
+            a_a_s_for_q = torch.cat([ei_for_q[0].unsqueeze(1), ei_for_q[1].unsqueeze(1)], dim=1)
+            _, hidden_temporal_state_for_q = self.q_emb_temporal_sp(a_a_s_for_q)
+            es_for_q = ei_for_q[2]
 
-        if qa_id == 11:
-                es_final = es_for_q
+        es_final = es_for_q
 
         # beam search
-        ds = self.q_summary_decoder.initialize(hidden_temporal_state_for_q, es_final, torch.from_numpy(np.asarray([sos])).cuda())
-        hyplist = [([], 0., ds)]
-        best_state = None
-        comp_hyplist = []
-        for l in six.moves.range(maxlen):
-            new_hyplist = []
-            argmin = 0
-            for out, lp, st in hyplist:
-                logp = self.q_summary_decoder.predict(st)
-                lp_vec = logp.cpu().data.numpy() + lp
-                lp_vec = np.squeeze(lp_vec)
-                if l >= minlen:
-                    new_lp = lp_vec[eos] + penalty * (len(out) + 1)
-                    new_st = self.q_summary_decoder.update(st, torch.from_numpy(np.asarray([eos])).cuda())
-                    comp_hyplist.append((out, new_lp))
-                    if best_state is None or best_state[0] < new_lp:
-                        best_state = (new_lp, new_st)
-
-                for o in np.argsort(lp_vec)[::-1]:
-                    if o == unk or o == eos:  # exclude <unk> and <eos>
-                        continue
-                    new_lp = lp_vec[o]
-                    if len(new_hyplist) == beam:
-                        if new_hyplist[argmin][1] < new_lp:
-                            new_st = self.q_summary_decoder.update(st, torch.from_numpy(np.asarray([o])).cuda())
-                            new_hyplist[argmin] = (out + [o], new_lp, new_st)
-                            argmin = min(enumerate(new_hyplist), key=lambda h: h[1][1])[0]
-                        else:
-                            break
-                    else:
-                        new_st = self.q_summary_decoder.update(st, torch.from_numpy(np.asarray([o])).cuda())
-                        new_hyplist.append((out + [o], new_lp, new_st))
-                        if len(new_hyplist) == beam:
-                            argmin = min(enumerate(new_hyplist), key=lambda h: h[1][1])[0]
-
-            hyplist = new_hyplist
-
-        if len(comp_hyplist) > 0:
-            maxhyps = sorted(comp_hyplist, key=lambda h: -h[1])[:nbest]
-	    #print("best_state:", best_state[1][1].size())
-            return maxhyps, best_state[1]
-        else:
-            return [([], 0)], None
-
-
-
+        return beam_search.beam_search(self.q_summary_decoder, hidden_temporal_state_for_q, es_final,
+                                       sos=sos, eos=eos, unk=unk, minlen=minlen, maxlen=maxlen,
+                                       beam=beam, penalty=penalty, nbest=nbest, **(summary_opts or {}))
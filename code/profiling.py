@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""Scheduled profiler windows
+   A ProfileWindow is stepped once per training iteration (or generated
+   sample) and profiles a few consecutive steps of the run:
+       start   steps skipped before the schedule begins
+       wait    further steps run without profiling
+       warmup  steps profiled but discarded (the profiler start-up overhead)
+       active  steps recorded
+   The recorded window is written to <prefix>.trace.json (chrome://tracing
+   or Perfetto) and <prefix>.ops.txt, which holds the top operators by time
+   and by memory.  While the window is open the stage_timer scopes and
+   labels (e.g. atten.pairwise, model.a_decoder) are recorded as ranges of
+   the trace, so operator time can be attributed to the model parts.
+   torch.profiler (torch >= 1.8) is used when available; otherwise the
+   window is recorded with torch.autograd.profiler, which has no memory or
+   stack attribution.
+"""
+
+import logging
+
+import torch
+
+import stage_timer
+
+try:
+    import torch.profiler as _profiler
+except ImportError:
+    _profiler = None
+
+
+def _record_function():
+    return getattr(torch.autograd.profiler, 'record_function', None)
+
+
+class ProfileWindow(object):
+
+    def __init__(self, prefix, wait=1, warmup=1, active=3, start=0,
+                 memory=True, stack=True, top=20):
+        """Set up the schedule; profiling starts with the first step
+
+        Args:
+            prefix (str): path prefix of the trace and summary files
+            wait, warmup, active, start (int): schedule, in steps
+            memory (bool): record the tensor allocations
+            stack (bool): record the source stack of the operators
+            top (int): number of operators in the summary tables
+        """
+        self.prefix = prefix
+        self.begin = start + wait
+        self.record = self.begin + warmup
+        self.end = self.record + active
+        self.memory = memory
+        self.stack = stack
+        self.top = top
+        self.cuda = torch.cuda.is_available()
+        self.steps = 0
+        self.done = False
+        self.prof = None
+        if _profiler is not None:
+            activities = [_profiler.ProfilerActivity.CPU]
+            if self.cuda:
+                activities.append(_profiler.ProfilerActivity.CUDA)
+            self.prof = _profiler.profile(
+                activities=activities,
+                schedule=_profiler.schedule(skip_first=start, wait=wait, warmup=warmup,
+                                            active=active, repeat=1),
+                on_trace_ready=self._export, record_shapes=True,
+                profile_memory=memory, with_stack=stack)
+            self.prof.__enter__()
+        else:
+            if memory or stack:
+                logging.warning('torch %s profiler: no memory or stack attribution' % torch.__version__)
+        self._update()
+
+
+    def _in_window(self):
+        return self.begin <= self.steps < self.end
+
+
+    def _update(self):
+        # open or close the window before the next step
+        if self.done:
+            return
+        stage_timer.set_labels(_record_function() if self._in_window() else None)
+        if self.prof is None and self.steps == self.record and self.record < self.end:
+            self.legacy = torch.autograd.profiler.profile(use_cuda=self.cuda)
+            self.legacy.__enter__()
+        if self.steps >= self.end:
+            self.close()
+
+
+    def step(self):
+        """Mark the end of a training iteration or generated sample"""
+        if self.done:
+            return
+        self.steps += 1
+        if self.prof is not None:
+            self.prof.step()
+        elif self.steps == self.end and self.record < self.end:
+            self.legacy.__exit__(None, None, None)
+            self._export(self.legacy)
+        self._update()
+
+
+    def close(self):
+        """Stop profiling (an unfinished window is discarded)"""
+        if self.done:
+            return
+        self.done = True
+        stage_timer.set_labels(None)
+        if self.prof is not None:
+            self.prof.__exit__(None, None, None)
+        elif self.record <= self.steps < self.end:
+            self.legacy.__exit__(None, None, None)
+        if self.steps < self.end:
+            logging.warning('the run ended after %d steps, before the profiler window (steps %d-%d) was complete'
+                            % (self.steps, self.record, self.end - 1))
+
+
+    def _export(self, prof):
+        trace = self.prefix + '.trace.json'
+        prof.export_chrome_trace(trace)
+        device = 'cuda' if self.cuda else 'cpu'
+        if self.prof is not None:
+            events = prof.key_averages()
+            tables = ['operators by self %s time' % device,
+                      events.table(sort_by='self_%s_time_total' % device, row_limit=self.top)]
+            if self.memory:
+                tables += ['operators by self %s memory' % device,
+                           events.table(sort_by='self_%s_memory_usage' % device, row_limit=self.top)]
+            if self.stack:
+                tables += ['operators by self %s time, per call site' % device,
+                           prof.key_averages(group_by_stack_n=5).table(
+                               sort_by='self_%s_time_total' % device, row_limit=self.top)]
+        else:
+            tables = ['operators by %s time' % device,
+                      prof.key_averages().table(sort_by='%s_time_total' % device)]
+        summary = self.prefix + '.ops.txt'
+        with open(summary, 'w') as f:
+            f.write('steps %d-%d\n\n' % (self.record, self.end - 1))
+            for i in range(0, len(tables), 2):
+                f.write(tables[i] + '\n' + tables[i + 1] + '\n\n')
+        logging.info('profile of steps %d-%d written to %s and %s'
+                     % (self.record, self.end - 1, trace, summary))
+        logging.info(tables[0] + '\n' + tables[1])
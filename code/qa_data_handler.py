@@ -25,11 +25,76 @@ def get_npy_shape(filename):
     return shape
 
 
-def get_vocabulary(dataset_file, cutoff=1, include_caption=False):
+# memory maps of the packed feature files (see save_preprocessed)
+_packed_files = {}
+
+
+def load_feature(value):
+    # return the array of a feature entry, either (path, shape) of a .npy
+    # file or (path, shape, offset, dtype) of an array in a packed file,
+    # which is read through a memory map shared by all the processes
+    if len(value) == 2:
+        return np.load(value[0])
+    path, shape, offset, dtype = value
+    if path not in _packed_files:
+        _packed_files[path] = np.memmap(path, dtype=np.uint8, mode='r')
+    dtype = np.dtype(dtype)
+    count = int(np.prod(shape))
+    return _packed_files[path][offset:offset + count * dtype.itemsize].view(dtype).reshape(shape)
+
+
+def save_preprocessed(path, datasets, info):
+    # write tokenized datasets (outputs of load()) to a directory, with the
+    # features of each type packed into one file, features<k>.bin, so that
+    # the trainings that read them share the page cache
+    # info (dict) is stored along with the datasets
+    tmp = path + '.tmp.%d' % os.getpid()
+    os.makedirs(tmp)
+    n_types = len(datasets[0]['features'])
+    packed = [{} for _ in six.moves.range(n_types)]
+    for k in six.moves.range(n_types):
+        binpath = os.path.join(os.path.abspath(path), 'features%d.bin' % k)
+        offset = 0
+        with open(os.path.join(tmp, 'features%d.bin' % k), 'wb') as f:
+            for data in datasets:
+                for vid, value in data['features'][k].items():
+                    if value[0] in packed[k]:
+                        continue
+                    array = np.ascontiguousarray(load_feature(value))
+                    f.write(b'\0' * (-offset % 64))
+                    offset += -offset % 64
+                    packed[k][value[0]] = (binpath, tuple(array.shape), offset, str(array.dtype))
+                    f.write(array.tobytes())
+                    offset += array.nbytes
+    out = []
+    for data in datasets:
+        data = dict(data)
+        data['features'] = [dict((vid, packed[k][value[0]]) for vid, value in features.items())
+                            for k, features in enumerate(data['features'])]
+        out.append(data)
+    with open(os.path.join(tmp, 'data.pkl'), 'wb') as f:
+        pickle.dump({'datasets': out, 'info': info}, f, -1)
+    os.rename(tmp, path)
+
+
+def is_preprocessed(path):
+    return os.path.exists(os.path.join(path, 'data.pkl'))
+
+
+def load_preprocessed(path):
+    # return the datasets and info written by save_preprocessed()
+    with open(os.path.join(path, 'data.pkl'), 'rb') as f:
+        saved = pickle.load(f)
+    return saved['datasets'], saved['info']
+
+
+def get_vocabulary(dataset_file, cutoff=1, include_caption=False, with_counts=False):
     vocab = {'<unk>':0, '<sos>':1, '<eos>':2}
     dialog_data = json.load(open(dataset_file, 'r'))
     word_freq = {}
+    n_sentences = 0
     for dialog in dialog_data['dialogs']:
+        n_sentences += 2 * len(dialog['dialog'])
         if include_caption:
             for word in dialog['caption'].split():
                 if word in word_freq:
@@ -47,6 +112,14 @@ def get_vocabulary(dataset_file, cutoff=1, include_caption=False):
         if freq > cutoff:
             vocab[word] = len(vocab) 
 
+    if with_counts:
+        # word counts indexed by id, words under the cutoff are counted as <unk>
+        counts = np.zeros(len(vocab), dtype=np.int64)
+        for word, freq in word_freq.items():
+            counts[vocab.get(word, vocab['<unk>'])] += freq
+        counts[vocab['<eos>']] = n_sentences
+        return vocab, counts
+
     # file = open('vocab.txt','w')
     # for k in range(len(vocab)):
     #     file.write(str(k))
@@ -78,6 +151,14 @@ def words2ids(str_in, vocab, unk=0, eos=-1):
 def load(fea_types, fea_path, dataset_file, vocabfile='', vocab={}, 
         include_caption=False, dictmap=None):
     dialog_data = json.load(open(dataset_file, 'r'))
+    return load_dialogs(fea_types, fea_path, dialog_data, vocabfile=vocabfile, vocab=vocab,
+                        include_caption=include_caption, dictmap=dictmap)
+
+
+def load_dialogs(fea_types, fea_path, dialog_data, vocabfile='', vocab={},
+                 include_caption=False, dictmap=None, fea_files=None):
+    # same as load() for dialogs already in memory
+    # fea_files ({fea_type: {vid: path}}) overrides the paths given by fea_path
     if vocabfile != '':
         vocab_from_file = json.load(open(vocabfile,'r'))
         for w in vocab_from_file:
@@ -172,7 +253,10 @@ def load(fea_types, fea_path, dataset_file, vocabfile='', vocab={},
         basepath = fea_path.replace('<FeaType>', ftype)
         features = {}
         for vid in vid_set:
-            filepath = basepath.replace('<ImageID>', vid)
+            if fea_files is not None and vid in fea_files.get(ftype, {}):
+                filepath = fea_files[ftype][vid]
+            else:
+                filepath = basepath.replace('<ImageID>', vid)
             shape = get_npy_shape(filepath)
             features[vid] = (filepath, shape)
             #print (shape)
@@ -185,10 +269,14 @@ def load(fea_types, fea_path, dataset_file, vocabfile='', vocab={},
 
 
 
-def make_batch_indices(data, batchsize=100, max_length=20):
+def make_batch_indices(data, batchsize=100, max_length=20, dialog_level=False):
     # Setup mini-batches
+    # with dialog_level=True, only the first turn of each dialog is used so that
+    # a dialog is the unit of work (see MMSeq2SeqModel.dialog_loss)
     idxlist = []
     for n, dialog in enumerate(data['dialogs']):
+        if dialog_level and len(dialog[2]) > 1:
+            continue
         vid = dialog[0]  # video ID
         x_len = []
         for feat in data['features']:
@@ -237,6 +325,24 @@ def make_batch_indices(data, batchsize=100, max_length=20):
     return batch_indices, n_samples
 
 
+def merge_batch_indices(indices):
+    # merge batch indices into a single mini-batch
+    vids = [vid for index in indices for vid in index[0]]
+    qa_ids = [qa_id for index in indices for qa_id in index[1]]
+    x_len = [max(index[2][j] for index in indices) for j in six.moves.range(len(indices[0][2]))]
+    lens = [max(index[k] for index in indices) for k in six.moves.range(3, 10)]
+    return tuple([vids, qa_ids, x_len] + lens + [len(vids)])
+
+
+def split_batch_index(index, parts):
+    # split a mini-batch into (at most) parts micro-batches of consecutive
+    # samples, padded to the same lengths as the mini-batch
+    n_seqs = index[-1]
+    bounds = [n_seqs * k // parts for k in six.moves.range(parts + 1)]
+    return [tuple([index[0][b:e], index[1][b:e]] + list(index[2:-1]) + [e - b])
+            for b, e in zip(bounds[:-1], bounds[1:]) if e > b]
+
+
 def make_batch_a(data, index, eos=1):
     x_len, h_len, q_len, a_len, summary_len, caption_len, all_a_len, all_q_len, n_seqs = index[2:]
     feature_info = data['features']
@@ -248,10 +354,10 @@ def make_batch_a(data, index, eos=1):
         #s_fea dim: 4 * 49 * 512
         for fi in feature_info:
             if len(fi[vid][1]) > 2:
-                s_fea = np.load(fi[vid][0])
+                s_fea = load_feature(fi[vid])
                 #print('s_fea in data loading:', s_fea.shape)
             else:
-                fea.append(np.load(fi[vid][0]))
+                fea.append(load_feature(fi[vid]))
 
 
         if j == 0:
@@ -312,10 +418,10 @@ def make_batch_q(data, index, eos=1):
         #s_fea dim: 4 * 49 * 512
         for fi in feature_info:
             if len(fi[vid][1]) > 2:
-                s_fea = np.load(fi[vid][0])
+                s_fea = load_feature(fi[vid])
                 #print('s_fea in data loading:', s_fea.shape)
             else:
-                fea.append(np.load(fi[vid][0]))
+                fea.append(load_feature(fi[vid]))
 
 
         if j == 0:
@@ -376,7 +482,7 @@ def feature_shape(data):
     for features in data["features"]:
         sample_feature = features.values()[0]
         if isinstance(sample_feature, tuple):
-            sample_fea = np.load(sample_feature[0])
+            sample_fea = load_feature(sample_feature)
             if len(sample_fea.shape) > 2:
                 print "Detected spatial features, ", sample_fea.shape
                 spatial_dims = sample_fea.shape[1:]
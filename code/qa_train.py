@@ -3,6 +3,7 @@
 """
 
 import argparse
+import copy
 import logging
 import math
 import sys
@@ -20,67 +21,110 @@ import torch
 
 import qa_data_handler as dh
 
-from new_qa_bot_model import MMSeq2SeqModel
-from lstm_encoder import LSTMEncoder
-from hlstm_encoder import HLSTMEncoder
-from hlstm_decoder import HLSTMDecoder
-from summary_decoder import Summary_HLSTMDecoder
-from question_decoder import Question_HLSTMDecoder
-
-def initialize_model_weights(model, initialization, lstm_initialization):
-    if initialization == "he":
-        print("kaiming normal initialization.")
-    elif initialization == "xavier":
-        print("xavier normal initialization.")
-    else:
-        print("default initialization, no changes made.")
-    if(initialization):
-        for name, param in model.named_parameters():
-            print("\n"+name)
-
-            # Bias params
-            if("bias" in name.split(".")[-1]):
-                print("zero")
-                param.data.zero_()
-
-            # Batchnorm weight params
-            elif("weight" in name.split(".")[-1] and len(param.size())==1):
-                print("batchnorm weight: default initialization")
-
-            # LSTM weight params
-            elif("weight" in name.split(".")[-1] and "lstm" in name):
-                if "xavier" in lstm_initialization:
-                    print("xavier")
-                    torch.nn.init.xavier_normal(param)
-                elif "he" in lstm_initialization:
-                    print("he")
-                    torch.nn.init.kaiming_normal(param)
-
-            # Other weight params
-            elif("weight" in name.split(".")[-1] and "lstm" not in name):
-                if "xavier" in initialization:
-                    print("xavier")
-                    torch.nn.init.xavier_normal(param)
-                elif "he" in initialization:
-                    print("he")
-                    torch.nn.init.kaiming_normal(param)
+from model_builder import build_model, initialize_model_weights
+from sampled_softmax import SampledSoftmaxLoss
+import shared_embedding
+import model_io
+import data_parallel
+import checkpoint
+import stage_timer
+import profiling
+import memory_usage
+from deferred_metrics import WordLoss
+import validation_worker
 
 def fetch_batch_a(dh, data, index, result):
-    result.append(dh.make_batch_a(data, index))
+    with stage_timer.scope('data.make_batch_a'):
+        result.append(dh.make_batch_a(data, index))
 
 def fetch_batch_q(dh, data, index, result):
-    result.append(dh.make_batch_q(data, index))
+    with stage_timer.scope('data.make_batch_q'):
+        result.append(dh.make_batch_q(data, index))
+
+def is_out_of_memory(error):
+    return isinstance(error, RuntimeError) and 'out of memory' in str(error)
+
+
+def release_memory():
+    # drop the references of the last exception to the activations
+    if hasattr(sys, 'exc_clear'):
+        sys.exc_clear()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def length_bucket(index):
+    """Key of the mini-batches of similar history, audio and remaining
+       question lengths, which share a micro-batch size"""
+    return (index[3], index[2][0] // 32 if index[2] else 0, index[9] // 32)
+
+
+def micro_batch_step(model, data, index, parts, device, dialog_level=False, num_cuts=0):
+    """Forward and backward passes of a mini-batch in micro-batches
+
+    The loss of each micro-batch is weighted by its share of the summary
+    words, so that the accumulated gradients are approximately equivalent
+    to those of the loss of the whole mini-batch (a mean over the words);
+    they are not identical, since the loss depends on the composition of
+    the batch (its padding, and the history encoder state carried across
+    its samples).  The number of parts is doubled as long as a micro-batch
+    does not fit in memory, down to micro-batches of one sample.
+    Return:
+        loss of the mini-batch, number of summary words, number of parts
+    """
+    total_words = sum(len(data['dialogs'][qa_id][9]) for qa_id in index[1])
+    while True:
+        model.zero_grad()
+        try:
+            batch_loss = 0.
+            for sub in dh.split_batch_index(index, parts):
+                x_batch, h_batch, q_batch, a_batch_in, a_batch_out, s_batch, summary_batch_in, summary_batch_out, c_batch = \
+                    dh.make_batch_a(data, sub)
+                q_batch_in, q_batch_out, all_a_batch_in, all_q_batch_in = dh.make_batch_q(data, sub)
+                x = [torch.from_numpy(x) for x in x_batch]
+                h = [[torch.from_numpy(h) for h in hb] for hb in h_batch]
+                q = [torch.from_numpy(q) for q in q_batch]
+                c = [torch.from_numpy(c) for c in c_batch]
+                ai = [torch.from_numpy(ai) for ai in a_batch_in]
+                ao = [torch.from_numpy(ao) for ao in a_batch_out]
+                qi = [torch.from_numpy(qi) for qi in q_batch_in]
+                qo = [torch.from_numpy(qo) for qo in q_batch_out]
+                smi = [torch.from_numpy(smi) for smi in summary_batch_in]
+                smo = [torch.from_numpy(smo) for smo in summary_batch_out]
+                all_ai = [torch.from_numpy(all_ai) for all_ai in all_a_batch_in]
+                all_qi = [torch.from_numpy(all_qi) for all_qi in all_q_batch_in]
+                s = torch.from_numpy(s_batch).to(device).float()
+                if dialog_level:
+                    _, _, loss = model.dialog_loss(x, h, c, ai, qi, smi, smo, s, all_ai, all_qi,
+                                                   n_cuts=num_cuts)
+                else:
+                    _, _, loss = model.loss(x, h, q, c, ai, qi, smi, ao, qo, smo, s, all_ai, all_qi)
+                share = sum([len(t) for t in smo]) / float(total_words)
+                (loss * share).backward()
+                batch_loss = loss.detach() * share + batch_loss
+            return batch_loss, total_words, parts
+        except RuntimeError as e:
+            if not is_out_of_memory(e) or parts >= index[-1]:
+                raise
+        loss = None
+        release_memory()
+        parts = min(2 * parts, index[-1])
+        logging.warning('out of memory in micro-batches, retrying in %d parts' % parts)
+
 
 # Evaluation routine
-def evaluate(model, data, indices):
+def evaluate(model, data, indices, distributed=False):
+    """Return the perplexity on the given mini-batches and the wall time;
+       with distributed, each worker evaluates its own mini-batches and the
+       perplexity is that of all of them"""
     start_time = time.time()
-    eval_loss = 0.
-    eval_num_words = 0
+    eval_loss = WordLoss()
     model.eval()
     with torch.no_grad():
-        # fetch the first batch
-        batch_a = [dh.make_batch_a(data, indices[0])]
-        batch_q = [dh.make_batch_q(data, indices[0])]
+        # fetch the first batch (with more workers than batches, a worker
+        # has none, and only takes part in the sum below)
+        batch_a = [dh.make_batch_a(data, indices[0])] if len(indices) > 0 else []
+        batch_q = [dh.make_batch_q(data, indices[0])] if len(indices) > 0 else []
         # evaluation loop
         for j in six.moves.range(len(indices)):
             # get a fetched batch
@@ -101,7 +145,7 @@ def evaluate(model, data, indices):
                 q = [torch.from_numpy(q) for q in q_batch]
                 ai = [torch.from_numpy(ai) for ai in a_batch_in]
                 ao = [torch.from_numpy(ao) for ao in a_batch_out]
-                s = torch.from_numpy(s_batch).cuda().float()
+                s = torch.from_numpy(s_batch).to(next(model.parameters()).device).float()
                 smi = [torch.from_numpy(smi) for smi in summary_batch_in] 
                 smo = [torch.from_numpy(smo) for smo in summary_batch_out]
                 c = [torch.from_numpy(c) for c in c_batch]
@@ -112,16 +156,17 @@ def evaluate(model, data, indices):
 
                 _, _, loss = model.loss(x, h, q, c, ai, qi, smi, ao, qo, smo, s, all_ai, all_qi)
 
-                num_words = sum([len(s) for s in smo])
-                eval_loss += loss.cpu().data.numpy() * num_words
-                eval_num_words += num_words
+                eval_loss.add(loss, sum([len(s) for s in smo]))
                 # wait prefetch completion
-            prefetch1.join()
-            prefetch2.join()
+            if j < len(indices) - 1:
+                prefetch1.join()
+                prefetch2.join()
     model.train()
+    if distributed:
+        eval_loss = WordLoss(*data_parallel.all_sum([eval_loss.value(), eval_loss.words]))
 
     wall_time = time.time() - start_time
-    return math.exp(eval_loss / eval_num_words), wall_time
+    return eval_loss.perplexity(), wall_time
 
 class AverageMeter(object):
     """Computes and stores the average and current value"""
@@ -181,6 +226,10 @@ if __name__ == "__main__":
     # input (question) encoder parameters
     parser.add_argument('--embed-size', default=200, type=int,
                         help='Word embedding size')
+    parser.add_argument('--share-embedding', action='store_true',
+                        help='Share one vocabulary embedding table across encoders and decoders')
+    parser.add_argument('--shared-embed-size', default=0, type=int,
+                        help='Width of the shared embedding table (0: same as --embed-size)')
     parser.add_argument('--in-enc-layers', default=2, type=int,
                         help='Number of input encoder layers')
     parser.add_argument('--in-enc-hsize', default=200, type=int,
@@ -199,6 +248,9 @@ if __name__ == "__main__":
                         help='Number of decoder projection layer units')
     parser.add_argument('--dec-hsize', '-d', default=200, type=int,
                         help='Number of decoder hidden layer units')
+    parser.add_argument('--sampled-softmax', default=0, type=int,
+                        help='Number of negative words of a sampled softmax for the summary '
+                             'training loss (0: full softmax)')
     # Training conditions
     parser.add_argument('--optimizer', '-o', default='AdaDelta', type=str,
                         choices=['SGD', 'Adam', 'AdaDelta', 'RMSprop'],
@@ -209,12 +261,92 @@ if __name__ == "__main__":
                         help='Batch size in training')
     parser.add_argument('--max-length', default=20, type=int,
                         help='Maximum length for controling batch size')
+    parser.add_argument('--dialog-level', action='store_true',
+                        help='Unroll each dialog once and attach the summary loss at every history cut point')
+    parser.add_argument('--num-cuts', default=0, type=int,
+                        help='Number of cut points sampled per batch in dialog-level training (0: all)')
+    parser.add_argument('--save-format', default='both', choices=['pickle', 'state', 'both'],
+                        help='Checkpoint format: pickled module (.pth.tar), state-dict '
+                             'directory (.state) or both')
+    parser.add_argument('--data-cache', default='', type=str,
+                        help='Directory of the tokenized data and packed features, '
+                             'written on first use and shared by the trainings that use it')
+    parser.add_argument('--prepare-only', action='store_true',
+                        help='Exit after writing --data-cache')
+    # checkpoints
+    parser.add_argument('--checkpoint-interval', default=0, type=int,
+                        help='Write a resumable checkpoint every N iterations '
+                             '(0: at the end of each epoch only)')
+    parser.add_argument('--keep-last', default=2, type=int,
+                        help='Number of most recent resumable checkpoints kept (at least 1)')
+    parser.add_argument('--no-keep-best', action='store_true',
+                        help='Do not keep the resumable checkpoint of the best validation perplexity')
+    parser.add_argument('--resume', default='', type=str,
+                        help='Resumable checkpoint to continue from, or "latest" for the '
+                             'last one of --model')
+    # timing
+    parser.add_argument('--timing-report', default='', type=str,
+                        help='Time the training stages and write the percentiles to this '
+                             'file (.csv, or json otherwise)')
+    parser.add_argument('--timing-interval', default=100, type=int,
+                        help='Number of iterations between writes of the timing report')
+    parser.add_argument('--timing-sync', action='store_true',
+                        help='Synchronize CUDA around each timed stage (slower, exact per-stage times)')
+    # profiling
+    parser.add_argument('--profile', default='', type=str,
+                        help='Profile a window of training iterations and write the trace and '
+                             'operator summary to files with this prefix')
+    parser.add_argument('--profile-start', default=10, type=int,
+                        help='Number of iterations before the profiler schedule begins')
+    parser.add_argument('--profile-wait', default=1, type=int,
+                        help='Number of iterations waited before the profiler warmup')
+    parser.add_argument('--profile-warmup', default=1, type=int,
+                        help='Number of profiled iterations discarded as warmup')
+    parser.add_argument('--profile-active', default=3, type=int,
+                        help='Number of iterations recorded')
+    parser.add_argument('--profile-top', default=20, type=int,
+                        help='Number of operators in the profile summary tables')
+    parser.add_argument('--profile-no-memory', action='store_true',
+                        help='Do not record memory allocations in the profile')
+    parser.add_argument('--profile-no-stack', action='store_true',
+                        help='Do not record the source stacks of the operators in the profile')
+    # validation
+    parser.add_argument('--validation-worker', action='store_true',
+                        help='Validate the epoch models in a separate process while training goes on')
+    parser.add_argument('--valid-batch-size', default=0, type=int,
+                        help='Batch size of the validation worker (0: twice --batch-size)')
+    parser.add_argument('--valid-device', default='', type=str,
+                        help='Device of the validation worker (default: cuda:0 if available)')
+    parser.add_argument('--valid-generate-dialogs', default=0, type=int,
+                        help='Number of validation dialogs whose summaries the validation worker '
+                             'generates and scores')
+    # memory
+    parser.add_argument('--memory-budget', default=0., type=float,
+                        help='Host memory (GB) the training is expected to fit in; a warning is '
+                             'given if the projected usage for --batch-size exceeds it (0: no check)')
+    # data-parallel training
+    parser.add_argument('--num-workers', default=1, type=int,
+                        help='Number of data-parallel worker processes')
+    parser.add_argument('--dist-backend', default='gloo', choices=['gloo', 'nccl'],
+                        help='torch.distributed backend of the workers (gloo also runs on CPU)')
+    parser.add_argument('--dist-port', default=29500, type=int,
+                        help='Port of the rank 0 worker for the process group rendezvous')
+    parser.add_argument('--scaling-report', default='', type=str,
+                        help='File (json lines) the training throughput of this run is appended to')
     # others
     parser.add_argument('--verbose', '-v', default=0, type=int,
                         help='verbose level')
     parser.add_argument('--model_name', help='Name of the model')
 
     args = parser.parse_args()
+    if args.keep_last < 1:
+        parser.error('--keep-last must be at least 1')
+    if args.num_workers > 1 and not data_parallel.is_worker():
+        sys.exit(data_parallel.launch(args.num_workers, port=args.dist_port))
+    if data_parallel.is_worker():
+        rank, world_size = data_parallel.init(args.dist_backend)
+    else:
+        rank, world_size = 0, 1
     random.seed(args.rand_seed)
     np.random.seed(args.rand_seed)
 
@@ -229,54 +361,80 @@ if __name__ == "__main__":
     else:
         logging.basicConfig(level=logging.INFO,
                             format='%(asctime)s %(levelname)s: %(message)s')
+    if world_size > 1:
+        # each worker logs to <model>.rank<N>.log, and only rank 0 to the console
+        formatter = logging.Formatter('%%(asctime)s [rank %d] %%(levelname)s: %%(message)s' % rank)
+        for handler in logging.getLogger().handlers:
+            handler.setFormatter(formatter)
+            if rank > 0:
+                handler.setLevel(logging.WARNING)
+        handler = logging.FileHandler('%s.rank%d.log' % (args.model, rank))
+        handler.setFormatter(formatter)
+        logging.getLogger().addHandler(handler)
 
     logging.info('Command line: ' + ' '.join(sys.argv))
+    if args.timing_report:
+        timer = stage_timer.enable(sync=args.timing_sync)
+        timing_report = args.timing_report
+        if world_size > 1:
+            base, ext = os.path.splitext(timing_report)
+            timing_report = '%s.rank%d%s' % (base, rank, ext)
+    else:
+        timer = None
     # get vocabulary
-    logging.info('Extracting words from ' + args.train_set)
-    vocab = dh.get_vocabulary(args.train_set, include_caption=args.include_caption)
-    # load data
-    logging.info('Loading training data from ' + args.train_set)
-    train_data = dh.load(args.fea_type, args.train_path, args.train_set,
-                         vocabfile=args.vocabfile,
-                         include_caption=args.include_caption,
-                         vocab=vocab, dictmap=dictmap)
-
-    logging.info('Loading validation data from ' + args.valid_set)
-    valid_data = dh.load(args.fea_type, args.valid_path, args.valid_set,
-                         vocabfile=args.vocabfile,
-                         include_caption=args.include_caption,
-                         vocab=vocab, dictmap=dictmap)
-
+    # options the tokenized data depends on
+    data_options = {'train_set': args.train_set, 'valid_set': args.valid_set,
+                    'train_path': args.train_path, 'valid_path': args.valid_path,
+                    'fea_type': args.fea_type, 'include_caption': args.include_caption,
+                    'vocabfile': args.vocabfile, 'dictmap': args.dictmap}
+    if args.data_cache and dh.is_preprocessed(args.data_cache):
+        logging.info('Loading preprocessed data from ' + args.data_cache)
+        (train_data, valid_data), info = dh.load_preprocessed(args.data_cache)
+        if info['options'] != data_options:
+            raise ValueError('%s was prepared with other data options: %s'
+                             % (args.data_cache, info['options']))
+        vocab, word_counts = train_data['vocab'], info['word_counts']
+    else:
+        logging.info('Extracting words from ' + args.train_set)
+        vocab, word_counts = dh.get_vocabulary(args.train_set, include_caption=args.include_caption,
+                                               with_counts=True)
+        # load data
+        logging.info('Loading training data from ' + args.train_set)
+        train_data = dh.load(args.fea_type, args.train_path, args.train_set,
+                             vocabfile=args.vocabfile,
+                             include_caption=args.include_caption,
+                             vocab=vocab, dictmap=dictmap)
+
+        logging.info('Loading validation data from ' + args.valid_set)
+        valid_data = dh.load(args.fea_type, args.valid_path, args.valid_set,
+                             vocabfile=args.vocabfile,
+                             include_caption=args.include_caption,
+                             vocab=vocab, dictmap=dictmap)
+        if args.data_cache and rank == 0:
+            logging.info('Writing preprocessed data to ' + args.data_cache)
+            dh.save_preprocessed(args.data_cache, [train_data, valid_data],
+                                 {'options': data_options, 'word_counts': word_counts})
+    if args.prepare_only:
+        logging.info('done')
+        sys.exit(0)
+
+    memory_usage.log_dataset('training', train_data)
+    memory_usage.log_dataset('validation', valid_data)
     feature_dims, spatial_dims = dh.feature_shape(train_data)
     logging.info("Detected feature dims: {}".format(feature_dims));
 
     # Prepare RNN model and load data
-    #embed_model = nn.Embedding(len(vocab), args.embed_size)
-    #print("vocab:", len(vocab))
-    embed_model = None
-    dropout = 0.5
-    model = MMSeq2SeqModel(
-        None,
-        HLSTMEncoder(args.hist_enc_layers[0], args.hist_enc_layers[1],
-                     len(vocab), args.hist_out_size, args.embed_size,
-                     args.hist_enc_hsize, dropout=dropout, embed=embed_model),
-        LSTMEncoder(args.in_enc_layers, len(vocab), args.in_enc_hsize,
-                    args.embed_size, dropout=dropout, embed=embed_model),
-        LSTMEncoder(args.in_enc_layers, len(vocab), args.in_enc_hsize,
-                    args.embed_size, dropout=dropout, embed=embed_model),
-        HLSTMDecoder(args.dec_layers, len(vocab), len(vocab), args.embed_size,
-                    args.hist_out_size + args.in_enc_hsize,
-                     args.dec_hsize, args.dec_psize,
-                     independent=False, dropout=dropout, embed=embed_model),
-        Summary_HLSTMDecoder(args.dec_layers, len(vocab), len(vocab), args.embed_size,
-                    args.hist_out_size + args.in_enc_hsize,
-                     args.dec_hsize, args.dec_psize,
-                     independent=False, dropout=dropout, embed=embed_model),
-        Question_HLSTMDecoder(args.dec_layers, len(vocab), len(vocab), args.embed_size,
-                    args.hist_out_size + args.in_enc_hsize,
-                     args.dec_hsize, args.dec_psize,
-                     independent=False, dropout=dropout, embed=embed_model),
-        )
+    model = build_model(args, vocab)
+    # kept in the checkpoint along with the model
+    model.memory_report = shared_embedding.embedding_memory(model, args.optimizer)
+    logging.info('embedding params: %(embedding_params)d (%(unshared_embedding_params)d if unshared), '
+                 '%(saved_bytes)d bytes of parameters, gradients and optimizer states saved'
+                 % model.memory_report)
+
+    if args.sampled_softmax > 0:
+        logging.info('sampled softmax with %d negative words for the summary loss'
+                     % args.sampled_softmax)
+        model.sampled_softmax = SampledSoftmaxLoss(word_counts, args.sampled_softmax)
 
     # check param number
     print('Param number:', sum(param.numel() for param in model.parameters()))
@@ -286,7 +444,8 @@ if __name__ == "__main__":
     # make batchset for training
     logging.info('Making mini batches for training data')
     train_indices, train_samples = dh.make_batch_indices(train_data, args.batch_size,
-                                                         max_length=args.max_length)
+                                                         max_length=args.max_length,
+                                                         dialog_level=args.dialog_level)
     logging.info('#train sample = %d' % train_samples)
     logging.info('#train batch = %d' % len(train_indices))
     # make batchset for validation
@@ -296,12 +455,32 @@ if __name__ == "__main__":
     logging.info('#validation sample = %d' % valid_samples)
     logging.info('#validation batch = %d' % len(valid_indices))
     # copy model to gpu
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    if torch.cuda.is_available():
+        device = torch.device('cuda:%d' % (rank % torch.cuda.device_count()))
+    else:
+        device = torch.device("cpu")
     model.to(device)
+    if world_size > 1:
+        # all the workers start from the weights of rank 0, and step through
+        # the same number of mini-batches (turns with 12 or more history
+        # sentences are skipped by the training loop, so they are left out)
+        data_parallel.broadcast_parameters(model)
+        train_indices = [index for index in train_indices if index[3] < 12]
+        logging.info('%d workers, %d mini-batches each' % (world_size, len(train_indices) // world_size))
     # save meta parameters
-    path = args.model + '.conf'
-    with open(path, 'wb') as f:
-        pickle.dump((vocab, args), f, -1)
+    if rank == 0:
+        path = args.model + '.conf'
+        with open(path, 'wb') as f:
+            pickle.dump((vocab, args), f, -1)
+    if args.validation_worker and rank == 0:
+        if not args.resume:
+            validation_worker.reset(args.model)
+        logging.info('validation worker logging to ' + args.model + '.validation.log')
+        validator = validation_worker.start(args.model, args.valid_batch_size or 2 * args.batch_size,
+                                            device=args.valid_device,
+                                            generate_dialogs=args.valid_generate_dialogs)
+    else:
+        validator = None
 
     # start training
     logging.info('----------------')
@@ -316,11 +495,25 @@ if __name__ == "__main__":
         optimizer = torch.optim.Adadelta(model.parameters())
     elif args.optimizer == 'RMSprop':
         optimizer = torch.optim.RMSprop(model.parameters())
+    memory = memory_usage.MemoryAccount(model, optimizer)
+    memory.end('startup')
+    # the batch with the most samples, and the longest features among those
+    largest = max(train_indices, key=lambda index: (index[-1], index[2], index[3]))
+    batch_bytes = memory_usage.deep_size((dh.make_batch_a(train_data, largest),
+                                          dh.make_batch_q(train_data, largest)))
+    projected = memory_usage.projected_bytes(model, args.optimizer, batch_bytes, device)
+    logging.info('largest mini-batch (%d samples): %.1f MB, projected host memory: %.1f MB '
+                 '(without activations)' % (largest[-1], batch_bytes / memory_usage.MB,
+                                            projected / memory_usage.MB))
+    if args.memory_budget > 0 and projected > args.memory_budget * (1 << 30):
+        logging.warning('the projected host memory of %.2f GB exceeds the budget of %.2f GB, '
+                        'consider a smaller --batch-size' % (projected / float(1 << 30), args.memory_budget))
 
     # initialize status parameters
     modelext = '.pth.tar'
-    cur_loss = 0.
-    cur_num_words = 0
+    stateext = '.state'
+    # losses of the mini-batches since the last report, read only then
+    cur_loss = WordLoss()
     epoch = 0
     start_at = time.time()
     cur_at = start_at
@@ -330,22 +523,89 @@ if __name__ == "__main__":
     bestmodel_num = 0
 
     random.shuffle(train_indices)
+    train_time = 0.
+    train_steps = 0
+    start_epoch = 0
+    progress = None
+    if args.resume:
+        path = checkpoint.latest(args.model) if args.resume == 'latest' else args.resume
+        if path is None:
+            raise IOError('no checkpoint to resume from for ' + args.model)
+        logging.info('resuming from ' + path)
+        progress = checkpoint.restore(checkpoint.load(path), model, optimizer)
+        if progress['world_size'] != world_size:
+            raise ValueError('%s was written with %d workers, not %d'
+                             % (path, progress['world_size'], world_size))
+        train_indices = progress['train_indices']
+        start_epoch = progress['epoch']
+        n, train_steps, train_time = progress['n'], progress['train_steps'], progress['train_time']
+        cur_loss = WordLoss(progress['cur_loss'], progress['cur_num_words'])
+        min_valid_ppl, bestmodel_num = progress['min_valid_ppl'], progress['bestmodel_num']
+    # the order of all the mini-batches, before sharding
+    all_train_indices = train_indices
+    if world_size > 1:
+        # the shuffle is the same on every worker, since they share the seed
+        train_indices = data_parallel.shard(train_indices, rank, world_size)
+        valid_indices = valid_indices[rank::world_size]
+    params = [p for p in model.parameters() if p.requires_grad]
+    # micro-batch size of each length bucket that ran out of memory
+    micro_sizes = {}
+    # only rank 0 writes, from a copy of the model, while training goes on
+    if rank == 0 and not args.resume:
+        checkpoint.reset(args.model)
+    # with the validation worker, the perplexities of the epochs come later
+    writer = checkpoint.AsyncCheckpointer(args.model, keep_last=args.keep_last,
+                                          keep_best=not args.no_keep_best,
+                                          await_validation=validator is not None) if rank == 0 else None
+    # epochs whose perplexity from the worker was given to the writer
+    recorded = set()
+
+    def training_state(epoch, position, train_sums=(0., 0)):
+        # train_sums: loss and word sums of the epoch so far, over all the
+        # workers (nothing at the end of an epoch, the next one starts anew)
+        return checkpoint.snapshot(model, optimizer, epoch=epoch, position=position,
+                                   world_size=world_size, train_indices=all_train_indices,
+                                   n=n, train_steps=train_steps, train_time=train_time,
+                                   cur_loss=cur_loss.value(), cur_num_words=cur_loss.words,
+                                   train_loss=train_sums[0], train_num_words=train_sums[1],
+                                   min_valid_ppl=min_valid_ppl, bestmodel_num=bestmodel_num)
+
+    if args.profile:
+        profile_prefix = args.profile if world_size == 1 else '%s.rank%d' % (args.profile, rank)
+        profiler = profiling.ProfileWindow(profile_prefix, wait=args.profile_wait,
+                                           warmup=args.profile_warmup, active=args.profile_active,
+                                           start=args.profile_start, memory=not args.profile_no_memory,
+                                           stack=not args.profile_no_stack, top=args.profile_top)
+    else:
+        profiler = None
+
     # do training iterations
-    for i in six.moves.range(args.num_epochs):
+    for i in six.moves.range(start_epoch, args.num_epochs):
         logging.info('Epoch %d : %s' % (i + 1, args.optimizer))
-        train_loss = 0.
-        train_num_words = 0
+        if progress is not None and i == start_epoch:
+            # continue the interrupted epoch
+            start_j = progress['position']
+            if rank == 0:
+                # the sums of all the workers, added up again at the end of the epoch
+                train_loss = WordLoss(progress['train_loss'], progress['train_num_words'])
+            else:
+                train_loss = WordLoss()
+        else:
+            start_j = 0
+            train_loss = WordLoss()
         batch_time = AverageMeter()
         data_time = AverageMeter()
         end = time.time()
+        epoch_start = end
+        memory.begin('epoch %d training' % (i + 1))
         # fetch the first batch
-        batch_a = [dh.make_batch_a(train_data, train_indices[0])]
-        batch_q = [dh.make_batch_q(train_data, train_indices[0])]
+        batch_a = [dh.make_batch_a(train_data, train_indices[start_j])]
+        batch_q = [dh.make_batch_q(train_data, train_indices[start_j])]
         #test_count = 0
         # train iterations
         count = 0
         cul_loss_batch = 0
-        for j in six.moves.range(len(train_indices)):
+        for j in six.moves.range(start_j, len(train_indices)):
             data_time.update(time.time() - end)
             # get fetched batch
             x_batch, h_batch, q_batch, a_batch_in, a_batch_out, s_batch, summary_batch_in, summary_batch_out, c_batch = batch_a.pop()
@@ -383,21 +643,52 @@ if __name__ == "__main__":
             all_ai = [torch.from_numpy(all_ai) for all_ai in all_a_batch_in]
             all_qi = [torch.from_numpy(all_qi) for all_qi in all_q_batch_in]
 
-            s = torch.from_numpy(s_batch).cuda().float()
+            with stage_timer.scope('h2d'):
+                s = torch.from_numpy(s_batch).to(device).float()
             if len(h_batch) < 12:
-                _, _, loss = model.loss(x, h, q, c, ai, qi, smi, ao, qo, smo, s, all_ai, all_qi)
-
-                num_words = sum([len(s) for s in smo])
-                batch_loss = loss.cpu().data.numpy()
-                train_loss += batch_loss * num_words
-                train_num_words += num_words
-
-                cur_loss += batch_loss * num_words
-                cur_num_words += num_words
+                # mini-batches of a bucket that ran out of memory are split
+                # in micro-batches from then on
+                index = train_indices[j]
+                bucket = length_bucket(index)
+                parts = -(-index[-1] // micro_sizes[bucket]) if bucket in micro_sizes else 1
+                if parts == 1:
+                    try:
+                        optimizer.zero_grad()
+                        with stage_timer.scope('forward'):
+                            if args.dialog_level:
+                                _, _, loss = model.dialog_loss(x, h, c, ai, qi, smi, smo, s, all_ai, all_qi,
+                                                               n_cuts=args.num_cuts)
+                            else:
+                                _, _, loss = model.loss(x, h, q, c, ai, qi, smi, ao, qo, smo, s, all_ai, all_qi)
+
+                        num_words = sum([len(s) for s in smo])
+                        batch_loss = loss
+                        with stage_timer.scope('backward'):
+                            loss.backward()
+                    except RuntimeError as e:
+                        if not is_out_of_memory(e):
+                            raise
+                        parts = 2
+                        logging.warning('out of memory on a mini-batch of %d samples, splitting it' % index[-1])
+                    if parts > 1:
+                        loss = batch_loss = s = None
+                        release_memory()
+                if parts > 1:
+                    with stage_timer.scope('micro_batches'):
+                        batch_loss, num_words, parts = micro_batch_step(model, train_data, index, parts, device,
+                                                                        args.dialog_level, args.num_cuts)
+                    size = -(-index[-1] // parts)
+                    if micro_sizes.get(bucket, index[-1] + 1) > size:
+                        micro_sizes[bucket] = size
+                        logging.info('micro-batches of %d samples for history length %d, audio length %d, '
+                                     'remaining question length %d' % (size, index[3], bucket[1] * 32, bucket[2] * 32))
+                train_loss.add(batch_loss, num_words)
+                cur_loss.add(batch_loss, num_words)
                 if (n + 1) % report_interval == 0:
                     now = time.time()
                     throuput = report_interval / (now - cur_at)
-                    perp = math.exp(cur_loss / cur_num_words)
+                    with stage_timer.scope('loss_fetch'):
+                        perp = cur_loss.perplexity()
                     logging.info('iter {}, '
                                  'time {:.3f} ({:.3f})\t'
                                  'data {:.3f} ({:.3f})\t'
@@ -406,51 +697,145 @@ if __name__ == "__main__":
                                          data_time.val, data_time.avg, perp, throuput))
 
                     cur_at = now
-                    cur_loss = 0.
-                    cur_num_words = 0
+                    cur_loss.reset()
                 n += 1
 
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
+                if world_size > 1:
+                    with stage_timer.scope('allreduce'):
+                        data_parallel.average_gradients(params, world_size)
+                with stage_timer.scope('optimizer'):
+                    optimizer.step()
+                train_steps += 1
+                if profiler is not None:
+                    profiler.step()
+                if timer is not None and train_steps % args.timing_interval == 0:
+                    timer.write(timing_report)
                 batch_time.update(time.time() - end)
                 end = time.time()
+                # the checkpoint of the end of the epoch follows the last batch
+                if args.checkpoint_interval > 0 and train_steps % args.checkpoint_interval == 0 \
+                        and j < len(train_indices) - 1:
+                    with stage_timer.scope('checkpoint'):
+                        train_sums = [train_loss.value(), train_loss.words]
+                        if world_size > 1:
+                            # every worker steps through the same number of batches
+                            train_sums = data_parallel.all_sum(train_sums)
+                        if writer is not None:
+                            writer.save(training_state(i, j + 1, train_sums), i, j + 1)
 
 
 
 
             # wait prefetch completion
-            prefetch1.join()
-            prefetch2.join()
-
-
-        logging.info("epoch: %d  train perplexity: %f" % (i + 1, math.exp(train_loss / train_num_words)))
-        # validation step
-        logging.info('-----------------------validation--------------------------')
+            if j < len(train_indices) - 1:
+                with stage_timer.scope('data.wait'):
+                    prefetch1.join()
+                    prefetch2.join()
+
+
+        train_time += time.time() - epoch_start
+        memory.end('epoch %d training' % (i + 1))
+        if timer is not None:
+            timer.write(timing_report)
+            timer.log()
+        if world_size > 1:
+            train_loss = WordLoss(*data_parallel.all_sum([train_loss.value(), train_loss.words]))
+        logging.info("epoch: %d  train perplexity: %f" % (i + 1, train_loss.perplexity()))
         now = time.time()
-        valid_ppl, valid_time = evaluate(model, valid_data, valid_indices)
-        #valid_ppl  = 0
-        #valid_time = 0 
-        logging.info('validation perplexity: %.4f' % (valid_ppl))
+        if args.validation_worker:
+            # the epoch model is validated by the worker once it is written
+            valid_ppl = None
+        else:
+            # validation step
+            logging.info('-----------------------validation--------------------------')
+            if timer is not None:
+                timer.paused = True
+            memory.begin('epoch %d validation' % (i + 1))
+            valid_ppl, valid_time = evaluate(model, valid_data, valid_indices, distributed=world_size > 1)
+            memory.end('epoch %d validation' % (i + 1))
+            if timer is not None:
+                timer.paused = False
+            #valid_ppl  = 0
+            #valid_time = 0 
+            logging.info('validation perplexity: %.4f' % (valid_ppl))
 
         # update the model via comparing with the lowest perplexity
         modelfile = args.model + '_' + str(i + 1) + modelext
-        logging.info('writing model params to ' + modelfile)
-        torch.save(model, modelfile)
-
-        if min_valid_ppl > valid_ppl:
-            bestmodel_num = i + 1
-            logging.info('validation perplexity reduced %.4f -> %.4f' % (min_valid_ppl, valid_ppl))
-            min_valid_ppl = valid_ppl
+        # the replicas are identical, rank 0 writes the checkpoints
+        if writer is not None:
+            saved_model = copy.deepcopy(model).cpu()
+        if writer is not None and args.save_format != 'state':
+            logging.info('writing model params to ' + modelfile)
+            writer.submit(torch.save, saved_model, modelfile)
+        if writer is not None and args.save_format != 'pickle':
+            statefile = args.model + '_' + str(i + 1) + stateext
+            logging.info('writing model params to ' + statefile)
+            writer.submit(model_io.save, saved_model, vocab, args, statefile)
+        if validator is not None:
+            writer.submit(validation_worker.announce, args.model, i + 1, args.model + '_' + str(i + 1))
+            results = validation_worker.read_results(args.model)
+        else:
+            results = {i + 1: {'valid_ppl': valid_ppl}} if valid_ppl is not None else {}
+
+        for epoch in sorted(results):
+            if min_valid_ppl > results[epoch]['valid_ppl']:
+                bestmodel_num = epoch
+                logging.info('validation perplexity reduced %.4f -> %.4f (epoch %d)'
+                             % (min_valid_ppl, results[epoch]['valid_ppl'], epoch))
+                min_valid_ppl = results[epoch]['valid_ppl']
+        if writer is not None:
+            writer.save(training_state(i + 1, 0), i + 1, 0, valid_ppl=valid_ppl)
+            for epoch in sorted(set(results) - recorded) if validator is not None else []:
+                writer.set_valid_ppl(epoch, results[epoch]['valid_ppl'])
+                recorded.add(epoch)
 
         cur_at += time.time() - now  # skip time of evaluation and file I/O
         logging.info('----------------')
 
+    if profiler is not None:
+        profiler.close()
+    if writer is not None:
+        writer.wait()
+    if validator is not None:
+        logging.info('waiting for the validation worker')
+        if validator.wait() != 0:
+            logging.warning('the validation worker failed, see ' + args.model + '.validation.log')
+        results = validation_worker.read_results(args.model)
+        for epoch in sorted(results):
+            if min_valid_ppl > results[epoch]['valid_ppl']:
+                bestmodel_num = epoch
+                min_valid_ppl = results[epoch]['valid_ppl']
+        logging.info('validation perplexities: ' + ', '.join('epoch %d %.4f' % (epoch, results[epoch]['valid_ppl'])
+                                                             for epoch in sorted(results)))
+        if bestmodel_num == 0:
+            bestmodel_num = args.num_epochs
+            logging.warning('no epoch was validated, the last one is taken as the best')
+        # the checkpoints of the epochs validated after training are kept or
+        # removed now
+        for epoch in sorted(set(results) - recorded):
+            writer.set_valid_ppl(epoch, results[epoch]['valid_ppl'])
+        writer.wait()
+    if train_time > 0:
+        logging.info('%d workers: %.3f iters/sec per worker, %.3f mini-batches/sec in total'
+                     % (world_size, train_steps / train_time, world_size * train_steps / train_time))
+    if rank == 0 and args.scaling_report and train_time > 0:
+        data_parallel.record_scaling(args.scaling_report, world_size, train_steps / train_time,
+                                     args.batch_size)
+    if rank > 0:
+        logging.info('done')
+        sys.exit(0)
+    # summary of the run, collected by sweep.py
+    with open(args.model + '.results.json', 'w') as f:
+        json.dump({'best_epoch': bestmodel_num, 'valid_ppl': min_valid_ppl,
+                   'train_time': train_time,
+                   'iters_per_sec': train_steps / train_time if train_time > 0 else 0.}, f)
     # make a symlink to the best model
     logging.info('the best model is epoch %d.' % bestmodel_num)
-    logging.info('a symbolic link is made as ' + args.model + '_best' + modelext)
-    if os.path.exists(args.model + '_best' + modelext):
-        os.remove(args.model + '_best' + modelext)
-    os.symlink(os.path.basename(args.model + '_' + str(bestmodel_num) + modelext),
-               args.model + '_best' + modelext)
+    for ext in ([modelext] if args.save_format != 'state' else []) + \
+               ([stateext] if args.save_format != 'pickle' else []):
+        logging.info('a symbolic link is made as ' + args.model + '_best' + ext)
+        if os.path.lexists(args.model + '_best' + ext):
+            os.remove(args.model + '_best' + ext)
+        os.symlink(os.path.basename(args.model + '_' + str(bestmodel_num) + ext),
+                   args.model + '_best' + ext)
     logging.info('done')
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""Convert a trained model for int8 inference on the CPU
+   The LSTM and Linear layers (including the proj/out layers of the
+   decoders) are quantized dynamically: their weights are stored as int8
+   and the activations are quantized on the fly, so no calibration
+   statistics have to be collected.  The Conv1d embeddings of Atten have no
+   dynamically quantized version and stay in float32.
+   The converted model is written as <output>.pth.tar with <output>.conf,
+   which summary_generate.py loads as any other model, and both models are
+   compared on the first samples of the validation set.
+"""
+
+import argparse
+import copy
+import io
+import json
+import logging
+import pickle
+import time
+
+import torch
+import torch.nn as nn
+
+import qa_data_handler as dh
+import model_io
+
+
+def quantize(model):
+    """Return an int8 copy of the model for CPU inference"""
+    quantization = getattr(torch, 'quantization', None)
+    if quantization is None or not hasattr(quantization, 'quantize_dynamic'):
+        raise RuntimeError('dynamic quantization requires PyTorch 1.3 or later (found %s)'
+                           % torch.__version__)
+    model = copy.deepcopy(model).cpu().eval()
+    qmodel = quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+    qmodel.quantized = True
+    return qmodel
+
+
+def model_bytes(model):
+    buf = io.BytesIO()
+    torch.save(model.state_dict(), buf)
+    return len(buf.getvalue())
+
+
+def unigram_f1(hyp, ref):
+    if len(hyp) == 0 or len(ref) == 0:
+        return float(hyp == ref)
+    common = sum(min(hyp.count(w), ref.count(w)) for w in set(hyp))
+    if common == 0:
+        return 0.
+    p = float(common) / len(hyp)
+    r = float(common) / len(ref)
+    return 2 * p * r / (p + r)
+
+
+def compare(float_model, qmodel, data, indices, maxlen=30, beam=3, penalty=2.0):
+    """Generate the summaries of the given samples with both models
+
+    Both models draw the same per-call projections, so the differences only
+    come from the quantization.
+    Return:
+        dict of agreement and throughput figures
+    """
+    times = [0., 0.]
+    exact = 0
+    f1 = 0.
+    score_diff = 0.
+    n = 0
+    with torch.no_grad():
+        for index in indices:
+            x_batch, h_batch, q_batch, a_batch_in, a_batch_out, s_batch, summary_batch_in, summary_batch_out, c_batch = \
+                dh.make_batch_a(data, index)
+            if len(h_batch) >= 12:
+                continue
+            x = [torch.from_numpy(x) for x in x_batch]
+            h = [[torch.from_numpy(h) for h in hb] for hb in h_batch]
+            s = torch.from_numpy(s_batch).float()
+            c = [torch.from_numpy(c) for c in c_batch]
+            rng_state = torch.get_rng_state()
+            outs = []
+            for k, model in enumerate((float_model, qmodel)):
+                torch.set_rng_state(rng_state)
+                start_time = time.time()
+                pred_outs, _ = model.generate_batch(x, h, c, s.to(model.input_device()),
+                                                    maxlen=maxlen, beam=beam, penalty=penalty, nbest=1)
+                times[k] += time.time() - start_time
+                outs.append(pred_outs[0][0])
+            exact += int(outs[0][0] == outs[1][0])
+            f1 += unigram_f1(outs[1][0], outs[0][0])
+            score_diff += abs(outs[0][1] - outs[1][1])
+            n += 1
+    return {'samples': n,
+            'exact_match': float(exact) / max(n, 1),
+            'unigram_f1': f1 / max(n, 1),
+            'mean_abs_score_diff': score_diff / max(n, 1),
+            'float_samples_per_sec': n / times[0] if times[0] > 0 else 0.,
+            'int8_samples_per_sec': n / times[1] if times[1] > 0 else 0.}
+
+
+##################################
+# main
+if __name__ =="__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--model-conf', default='', type=str,
+                        help='Attention model to be output (not needed for a .state checkpoint)')
+    parser.add_argument('--model', '-m', default='', type=str,
+                        help='Float model to convert, as for summary_generate.py')
+    parser.add_argument('--output', '-o', default='', type=str,
+                        help='Name of the quantized model (<output>.pth.tar and <output>.conf)')
+    parser.add_argument('--valid-path', default='', type=str,
+                        help='Path to validation feature files')
+    parser.add_argument('--valid-set', default='', type=str,
+                        help='Filename of validation data (no comparison if empty)')
+    parser.add_argument('--num-samples', default=100, type=int,
+                        help='Number of validation samples to compare on')
+    parser.add_argument('--threads', default=0, type=int,
+                        help='Number of CPU threads (0: default)')
+    parser.add_argument('--maxlen', default=30, type=int,
+                        help='Max-length of output sequence')
+    parser.add_argument('--beam', default=3, type=int,
+                        help='Beam width')
+    parser.add_argument('--penalty', default=2.0, type=float,
+                        help='Insertion penalty')
+    parser.add_argument('--verbose', '-v', default=0, type=int,
+                        help='verbose level')
+
+    args = parser.parse_args()
+
+    if args.verbose >= 1:
+        logging.basicConfig(level=logging.DEBUG,
+            format='%(asctime)s (%(module)s:%(lineno)d) %(levelname)s: %(message)s')
+    else:
+        logging.basicConfig(level=logging.INFO,
+            format='%(asctime)s %(levelname)s: %(message)s')
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    logging.info('Loading model params from ' + args.model)
+    model, vocab, train_args, _ = model_io.load_model(args.model, args.model_conf, torch.device('cpu'))
+    model.eval()
+    qmodel = quantize(model)
+    logging.info('parameters: %d bytes (float) -> %d bytes (int8)' % (model_bytes(model), model_bytes(qmodel)))
+
+    if args.output:
+        logging.info('writing quantized model to ' + args.output + '.pth.tar')
+        torch.save(qmodel, args.output + '.pth.tar')
+        with open(args.output + '.conf', 'wb') as f:
+            pickle.dump((vocab, train_args), f, -1)
+
+    if args.valid_set:
+        logging.info('Loading validation data from ' + args.valid_set)
+        if train_args.dictmap != '':
+            dictmap = json.load(open(train_args.dictmap, 'r'))
+        else:
+            dictmap = None
+        valid_data = dh.load(train_args.fea_type, args.valid_path, args.valid_set,
+                             vocab=vocab, dictmap=dictmap, include_caption=train_args.include_caption)
+        valid_indices, _ = dh.make_batch_indices(valid_data, 1)
+        result = compare(model, qmodel, valid_data, valid_indices[:args.num_samples],
+                         maxlen=args.maxlen, beam=args.beam, penalty=args.penalty)
+        logging.info('%(samples)d samples: exact match %(exact_match).3f, unigram F1 %(unigram_f1).3f, '
+                     'mean |score diff| %(mean_abs_score_diff).4f' % result)
+        logging.info('float %(float_samples_per_sec).2f samples/sec, int8 %(int8_samples_per_sec).2f samples/sec'
+                     % result)
+    logging.info('done')
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""Sampled softmax loss for the summary decoder
+   At training time, the logits are computed only for the targets of the
+   batch and a set of negative words drawn from the smoothed unigram
+   distribution, with the usual log expected count correction.  The output
+   layer itself is unchanged, so generation still scores the full vocabulary.
+"""
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class SampledSoftmaxLoss(nn.Module):
+
+    def __init__(self, counts, n_samples, power=0.75):
+        """Initialize the sampler
+
+        Args:
+            counts (ndarray): word counts indexed by word id.
+            n_samples (int): number of negative words drawn per batch.
+            power (float): smoothing exponent of the unigram distribution.
+        """
+        super(SampledSoftmaxLoss, self).__init__()
+        probs = np.power(np.maximum(np.asarray(counts, dtype=np.float64), 1.0), power)
+        probs /= probs.sum()
+        self.register_buffer('probs', torch.from_numpy(probs).float())
+        self.n_samples = n_samples
+
+
+    def forward(self, h, weight, bias, target):
+        """Compute the sampled cross-entropy
+
+        Args:
+            h (Tensor): features before the output layer, (N, proj_size).
+            weight (Tensor): output layer weight, (vocab, proj_size).
+            bias (Tensor): output layer bias, (vocab,).
+            target (Tensor): target word ids, (N,).
+        Return:
+            (Tensor) cross-entropy averaged over the N targets
+        """
+        samples = torch.multinomial(self.probs, self.n_samples, replacement=True)
+        candidates, inverse = torch.unique(torch.cat((target, samples)), return_inverse=True)
+        # log of the expected number of times each candidate is drawn
+        q = self.probs[candidates]
+        log_expected = torch.log(-torch.expm1(self.n_samples * torch.log1p(-q)))
+        logits = F.linear(h, weight[candidates], bias[candidates]) - log_expected
+        return F.cross_entropy(logits, inverse[:target.size(0)])
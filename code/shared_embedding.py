@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Vocabulary embedding shared by the encoders and decoders
+"""
+
+import torch.nn as nn
+
+
+# number of per-parameter state tensors kept by each optimizer
+OPTIMIZER_STATES = {'SGD': 0, 'Adam': 2, 'AdaDelta': 2, 'RMSprop': 1}
+
+
+class ProjectedEmbedding(nn.Module):
+    """Shared embedding table followed by a consumer-specific projection"""
+
+    def __init__(self, embed, out_size):
+        super(ProjectedEmbedding, self).__init__()
+        self.embed = embed
+        self.proj = nn.Linear(embed.embedding_dim, out_size, bias=False)
+        self.embedding_dim = out_size
+
+    def forward(self, x):
+        return self.proj(self.embed(x))
+
+
+def consumer_embedding(shared, size):
+    """Return the embedding module to be passed to a consumer of width `size`
+
+    Args:
+        shared (nn.Embedding or None): shared table, or None for a private one.
+        size (int): embedding size expected by the consumer.
+    """
+    if shared is None or shared.embedding_dim == size:
+        return shared
+    return ProjectedEmbedding(shared, size)
+
+
+def embedding_memory(model, optimizer='Adam'):
+    """Account for the memory taken by the vocabulary embeddings of a model
+
+    The footprint is compared with the one of a model in which each consumer
+    owns a full-vocabulary table of its own width.
+    Args:
+        model (MMSeq2SeqModel): model to inspect
+        optimizer (str): optimizer name, to count its per-parameter state
+    Return:
+        dict of parameter counts and byte sizes (parameters, gradients and
+        optimizer states)
+    """
+    consumers = [model.history_encoder, model.a_caption_encoder, model.a_input_encoder,
+                 model.a_response_decoder, model.q_summary_decoder, model.q_question_decoder]
+    params = {}
+    private = 0
+    for consumer in consumers:
+        embed = consumer.embed
+        for p in embed.parameters():
+            params[id(p)] = p
+        table = embed.embed if isinstance(embed, ProjectedEmbedding) else embed
+        private += table.num_embeddings * embed.embedding_dim
+    used = sum(p.numel() for p in params.values())
+    # parameters, gradients and optimizer states are all float32
+    copies = 2 + OPTIMIZER_STATES.get(optimizer, 0)
+    total = sum(p.numel() for p in model.parameters())
+    return {'optimizer': optimizer,
+            'params': total,
+            'embedding_params': used,
+            'unshared_embedding_params': private,
+            'saved_params': private - used,
+            'param_bytes': total * 4,
+            'optimizer_state_bytes': total * 4 * OPTIMIZER_STATES.get(optimizer, 0),
+            'saved_bytes': (private - used) * 4 * copies}
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""Timing of named stages of training
+       with stage_timer.scope('backward'):
+           loss.backward()
+   Timing is off until enable() is called.  While it is off, scope()
+   returns a shared no-op context, so instrumented code only pays for one
+   function call per scope.  Durations are aggregated per scope name into a
+   count, a total and percentiles over the most recent samples.
+   With sync, CUDA is synchronized at both ends of each scope so that the
+   asynchronously launched kernels are charged to the scope that launched
+   them; this makes training slower and is meant for diagnosis.
+   While a profiler window is open (see profiling.py), the scopes are also
+   recorded as labelled ranges of the profiler trace.
+"""
+
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+import torch
+
+
+def _percentile(values, p):
+    if len(values) == 0:
+        return 0.
+    return values[min(len(values) - 1, int(p / 100. * len(values)))]
+
+
+class _NullScope(object):
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SCOPE = _NullScope()
+
+
+class _Scope(object):
+    __slots__ = ('timer', 'name', 'start', 'label')
+
+    def __init__(self, timer, name):
+        # timer is None when the scope is only a profiler label
+        self.timer = timer
+        self.name = name
+        self.label = None
+
+
+    def __enter__(self):
+        if _label_factory is not None:
+            self.label = _label_factory(self.name)
+            self.label.__enter__()
+        if self.timer is not None:
+            if self.timer.sync:
+                torch.cuda.synchronize()
+            self.start = time.time()
+        return self
+
+
+    def __exit__(self, *exc):
+        if self.timer is not None:
+            if self.timer.sync:
+                torch.cuda.synchronize()
+            self.timer.add(self.name, time.time() - self.start)
+        if self.label is not None:
+            self.label.__exit__(*exc)
+            self.label = None
+        return False
+
+
+class StageTimer(object):
+
+    def __init__(self, sync=False, window=10000):
+        """Initialize the timer
+
+        Args:
+            sync (bool): synchronize CUDA around each scope
+            window (int): number of recent samples the percentiles are taken over
+        """
+        self.sync = sync and torch.cuda.is_available()
+        self.window = window
+        # batches are built on the prefetch threads
+        self.lock = threading.Lock()
+        # no samples are taken while paused (e.g. during validation)
+        self.paused = False
+        self.reset()
+
+
+    def reset(self):
+        with self.lock:
+            self.samples = collections.OrderedDict()
+            self.totals = {}
+            self.counts = {}
+
+
+    def scope(self, name):
+        return _Scope(self, name)
+
+
+    def add(self, name, seconds):
+        with self.lock:
+            if name not in self.samples:
+                self.samples[name] = collections.deque(maxlen=self.window)
+                self.totals[name] = 0.
+                self.counts[name] = 0
+            self.samples[name].append(seconds)
+            self.totals[name] += seconds
+            self.counts[name] += 1
+
+
+    def summary(self):
+        """Return {name: {count, total, mean, p50, p90, p99}} (seconds)"""
+        with self.lock:
+            samples = collections.OrderedDict((name, sorted(values)) for name, values in self.samples.items())
+            totals = dict(self.totals)
+            counts = dict(self.counts)
+        result = collections.OrderedDict()
+        for name in samples:
+            result[name] = {'count': counts[name], 'total': totals[name],
+                            'mean': totals[name] / counts[name],
+                            'p50': _percentile(samples[name], 50),
+                            'p90': _percentile(samples[name], 90),
+                            'p99': _percentile(samples[name], 99)}
+        return result
+
+
+    def write(self, path):
+        """Write the summary to a .csv file, or json for any other extension"""
+        summary = self.summary()
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            if path.endswith('.csv'):
+                f.write('scope,count,total,mean,p50,p90,p99\n')
+                for name, st in summary.items():
+                    f.write('%s,%d,%f,%f,%f,%f,%f\n' % (name, st['count'], st['total'], st['mean'],
+                                                        st['p50'], st['p90'], st['p99']))
+            else:
+                json.dump(summary, f, indent=1)
+        os.rename(tmp, path)
+
+
+    def log(self):
+        summary = self.summary()
+        logging.info('%-24s %8s %10s %9s %9s %9s %9s' % ('scope', 'count', 'total(s)', 'mean(ms)',
+                                                         'p50(ms)', 'p90(ms)', 'p99(ms)'))
+        for name in sorted(summary, key=lambda n: -summary[n]['total']):
+            st = summary[name]
+            logging.info('%-24s %8d %10.2f %9.2f %9.2f %9.2f %9.2f'
+                         % (name, st['count'], st['total'], 1000. * st['mean'],
+                            1000. * st['p50'], 1000. * st['p90'], 1000. * st['p99']))
+
+
+_timer = None
+# context factory of the profiler ranges, set while a profiler window is open
+_label_factory = None
+
+
+def enable(sync=False, window=10000):
+    """Turn timing on and return the timer"""
+    global _timer
+    _timer = StageTimer(sync=sync, window=window)
+    return _timer
+
+
+def disable():
+    global _timer
+    _timer = None
+
+
+def active():
+    """Return the timer, or None if timing is off"""
+    return _timer
+
+
+def set_labels(factory):
+    """Also record the scopes as factory(name) ranges (e.g. record_function), or stop if None"""
+    global _label_factory
+    _label_factory = factory
+
+
+def label(name):
+    """Context recorded as a profiler range only, never timed (for code run
+       too many times per step to be worth a scope)"""
+    if _label_factory is None:
+        return _NULL_SCOPE
+    return _label_factory(name)
+
+
+def scope(name):
+    """Context timing the stage name, if timing is on"""
+    timer = _timer
+    if timer is not None and timer.paused:
+        timer = None
+    if timer is None and _label_factory is None:
+        return _NULL_SCOPE
+    return _Scope(timer, name)
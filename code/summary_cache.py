@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""Content-addressed on-disk cache of generated summaries
+   Each entry is a small json file named after the sha1 of everything that
+   determines the output of model.generate(): the checkpoint contents, the
+   video id, the tokenized caption and history, the decoding parameters and
+   the random generator state the per-call projections are drawn from.
+   The least recently used entries are removed when the cache exceeds its
+   size limit.
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """Return the sha1 of the contents of a file"""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _tokens(x):
+    return np.asarray(x).tolist()
+
+
+class SummaryCache(object):
+
+    def __init__(self, path, checkpoint_hash, max_bytes=1 << 30):
+        """Open (or create) a cache directory
+
+        Args:
+            path (str): cache directory
+            checkpoint_hash (str): hash of the model checkpoint (see file_hash)
+            max_bytes (int): size limit of the cache entries
+        """
+        self.path = path
+        self.checkpoint_hash = checkpoint_hash
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        # entry sizes and last access times, from the files left by previous runs
+        self.entries = {}
+        for name in os.listdir(path):
+            if name.endswith('.json'):
+                st = os.stat(os.path.join(path, name))
+                self.entries[name[:-5]] = [st.st_size, st.st_mtime]
+        self.total_bytes = sum(e[0] for e in self.entries.values())
+
+
+    def key(self, vid, caption, history, params):
+        """Compute the key of a sample
+
+        Args:
+            vid (str): video id
+            caption (array of int): caption word ids
+            history (list of arrays of int): history sentences word ids
+            params (dict): decoding parameters and random generator state
+        """
+        content = json.dumps([self.checkpoint_hash, vid, _tokens(caption),
+                              [_tokens(h) for h in history], params], sort_keys=True)
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.json')
+
+
+    def get(self, key):
+        """Return the n-best list (hyp, score) stored for key, or None"""
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        try:
+            with open(self._file(key), 'r') as f:
+                pred_out = [(hyp, score) for hyp, score in json.load(f)]
+        except (IOError, OSError, ValueError):
+            # removed or truncated by another process
+            self._remove(key)
+            self.misses += 1
+            return None
+        os.utime(self._file(key), None)
+        self.entries[key][1] = os.path.getmtime(self._file(key))
+        self.hits += 1
+        return pred_out
+
+
+    def get_all(self, keys):
+        """Return the n-best lists stored for all the keys, or None if any is missing"""
+        if any(key not in self.entries for key in keys):
+            self.misses += len(keys)
+            return None
+        pred_outs = [self.get(key) for key in keys]
+        return pred_outs if all(p is not None for p in pred_outs) else None
+
+
+    def put(self, key, pred_out):
+        """Store the n-best list (hyp, score) of a sample"""
+        data = json.dumps([[list(hyp), score] for hyp, score in pred_out])
+        tmp = self._file(key) + '.tmp.%d' % os.getpid()
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.rename(tmp, self._file(key))
+        if key in self.entries:
+            self.total_bytes -= self.entries[key][0]
+        self.entries[key] = [len(data), os.path.getmtime(self._file(key))]
+        self.total_bytes += len(data)
+        self._evict()
+
+
+    def _remove(self, key):
+        size, _ = self.entries.pop(key)
+        self.total_bytes -= size
+        try:
+            os.remove(self._file(key))
+        except OSError:
+            pass
+
+
+    def _evict(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+        for key in sorted(self.entries, key=lambda k: self.entries[k][1]):
+            self._remove(key)
+            self.evictions += 1
+            if self.total_bytes <= self.max_bytes:
+                break
+
+
+    def report(self):
+        n = self.hits + self.misses
+        logging.info('summary cache: %d hits / %d lookups (%.1f%%), %d entries, %d bytes, %d evicted'
+                     % (self.hits, n, 100. * self.hits / n if n > 0 else 0.,
+                        len(self.entries), self.total_bytes, self.evictions))
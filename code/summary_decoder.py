@@ -11,12 +11,14 @@ import torch.nn as nn
 import torch.nn.functional as F
 import six
 
+import context_lstm
+
 class Summary_HLSTMDecoder(nn.Module):
 
     frame_based = False
     take_all_states = False
 
-    def __init__(self, n_layers, in_size, out_size, embed_size, in_size_hier, hidden_size, proj_size, dropout=0.5, initialEmbW=None, independent=False, embed=None):
+    def __init__(self, n_layers, in_size, out_size, embed_size, in_size_hier, hidden_size, proj_size, dropout=0.5, initialEmbW=None, independent=False, embed=None, split_context=True):
         """Initialize encoder with structure parameters
 
         Args:
@@ -27,6 +29,9 @@ class Summary_HLSTMDecoder(nn.Module):
             hidden_size (int) : Dimensionality of hidden vectors.
             proj_size (int) : Dimensionality of projection before softmax.
             dropout (float): Dropout ratio.
+            split_context (bool): In step-wise decoding (update), project the
+                constant context through the LSTM input weights once per
+                sequence (see context_lstm).
         """
         super(Summary_HLSTMDecoder, self).__init__()
         self.embed = nn.Embedding(in_size, embed_size) if embed is None else embed
@@ -36,9 +41,10 @@ class Summary_HLSTMDecoder(nn.Module):
         self.n_layers = n_layers
         self.dropout = dropout
         self.independent = independent
+        self.split_context = split_context
 
 
-    def __call__(self, s, hs, xs):
+    def __call__(self, s, hs, xs, logits=True):
         """Calculate all hidden states, cell states, and output prediction.
 
         Args:
@@ -50,6 +56,8 @@ class Summary_HLSTMDecoder(nn.Module):
             xs (list of ~chianer.Variable): List of input label sequences.
                 Each element ``xs[i]`` is a :class:`chainer.Variable` holding
                 a sequence.
+            logits (bool): If ``False``, the features before the output layer
+                are returned instead of the logits (see SampledSoftmaxLoss).
         Return:
             (hy, cy): a pair of hidden and cell states at the end of the sequence,
             y: a sequence of pre-activatin vectors at the output layer
@@ -59,23 +67,25 @@ class Summary_HLSTMDecoder(nn.Module):
         if len(xs) > 1:
             sections = np.array([len(x) for x in xs], dtype=np.int32)
             aa = torch.cat(xs, 0)
-            bb = self.embed(torch.tensor(aa, dtype=torch.long).cuda())
+            bb = self.embed(torch.tensor(aa, dtype=torch.long).to(hs.device))
             cc = sections.tolist()
             hx = torch.split(bb, cc, dim=0)
         else:
-            xs[0] = torch.tensor(xs[0], dtype=torch.long).cuda()
+            sections = np.array([len(xs[0])], dtype=np.int32)
+            xs[0] = torch.tensor(xs[0], dtype=torch.long).to(hs.device)
             hx = [ self.embed(xs[0]) ]
         #print(hs.shape, len(hx), [e.shape for e in hx])
         #exit(1)
-        hxc = [ torch.cat((hx[i], hs[i].repeat(hx[i].shape[0], 1)), dim=1) for i in six.moves.range(len(hx))]
-
-        sort_hxc = []
         cc = torch.from_numpy(sections)
         cc, perm_index = torch.sort(cc, 0, descending=True)
+        if hasattr(self, 'independent') and self.independent:
+            s = None
+        hxc = [ torch.cat((hx[i], hs[i].repeat(hx[i].shape[0], 1)), dim=1) for i in six.moves.range(len(hx))]
+        sort_hxc = []
         sort_hxc.append([hxc[i] for i in perm_index])
         padded_hxc = nn.utils.rnn.pad_sequence(sort_hxc[0], batch_first=True)
         packed_hxc = nn.utils.rnn.pack_padded_sequence(padded_hxc, list(cc.data), batch_first=True)
-        if s is None or (hasattr(self, 'independent') and self.independent):
+        if s is None:
             ys, (hy, cy) = self.lstm(packed_hxc)
         else:
             ys, (hy, cy) = self.lstm(packed_hxc, s)
@@ -84,12 +94,13 @@ class Summary_HLSTMDecoder(nn.Module):
         # restore the sorting
         cc2, perm_index2 = torch.sort(perm_index, 0)
         odx = perm_index2.view(-1, 1).unsqueeze(1).expand(ys.size(0), ys.size(1), ys.size(2))
-        ys2 = ys.gather(0, odx.cuda())
+        ys2 = ys.gather(0, odx.to(ys.device))
 
         ys2_list=[]
         ys2_list.append([ys2[i, 0:sections[i],:] for i in six.moves.range(ys2.shape[0])])
-        y = self.out(self.proj(
-                F.dropout(torch.cat(ys2_list[0], dim=0), p=self.dropout)))
+        y = self.proj(F.dropout(torch.cat(ys2_list[0], dim=0), p=self.dropout))
+        if logits:
+            y = self.out(y)
         return (hy, cy), y
 
 
@@ -106,11 +117,11 @@ class Summary_HLSTMDecoder(nn.Module):
             initial decoder state
         """
         # LSTM decoder can be initialized in the same way as update()
-        if len(x) > 1:
-            print("Initialization check:", len(x))
-            self.hx = F.vstack([x[j][-1] for j in six.moves.range(len(x[1]))])
+        self.hx = x
+        if getattr(self, 'split_context', True) and context_lstm.supported(self.lstm):
+            self.hx_gates = context_lstm.context_gates(self.lstm, self.hx)
         else:
-            self.hx = x
+            self.hx_gates = None
         if hasattr(self, 'independent') and self.independent:
             return self.update(None,i)
         else:
@@ -127,6 +138,11 @@ class Summary_HLSTMDecoder(nn.Module):
         Return:
             (~chainer.Variable) updated decoder state
         """
+        if getattr(self, 'hx_gates', None) is not None and len(i) != 0:
+            # the context was projected once in initialize()
+            hy, cy = context_lstm.step(self.lstm, self.embed(i), self.hx_gates, s)
+            return hy, cy, hy[-1:]
+
         x = torch.cat((self.embed(i), self.hx), dim=1)
         if s is not None and len(s[0]) == self.n_layers*2:
             s = list(s)
@@ -137,7 +153,8 @@ class Summary_HLSTMDecoder(nn.Module):
                 s[m] = F.stack(ss, axis=0)
 
         if len(i) != 0:
-            xs = torch.unsqueeze(x,0)
+            # one step for each of the len(i) sequences
+            xs = torch.unsqueeze(x,1)
         else:
             xs = [x]
 
@@ -146,7 +163,7 @@ class Summary_HLSTMDecoder(nn.Module):
         else:
             dy, (hy, cy) = self.lstm( xs)
 
-        return hy, cy, dy
+        return hy, cy, dy.transpose(0, 1)
 
 
     def predict(self, s):
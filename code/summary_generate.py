@@ -4,28 +4,41 @@
    Used in: Describing Unseen Videos via Multi-Modal Cooperative Dialog Agents
 """
 
+import time
+# process start, for the time-to-first-summary report
+start_at = time.time()
+
 import argparse
 import logging
-import math
-import sys
-import time
-import os
 import copy
-import pickle
 import json
+import hashlib
 
-import numpy as np
 import six
 
 import torch
-import torch.nn as nn
 import qa_data_handler as dh
+import context_cache
+import profiling
+import memory_usage
+
+first_summary_at = None
+
+
+def mark_first_summary():
+    global first_summary_at
+    if first_summary_at is None:
+        first_summary_at = time.time()
+        logging.info('time to first summary: %f' % (first_summary_at - start_at))
 
 
 # Evaluation routine
-def generate_response(model, data, batch_indices, vocab, maxlen=20, beam=5, penalty=2.0, nbest=1):
+def generate_response(model, data, batch_indices, vocab, maxlen=20, beam=5, penalty=2.0, nbest=1,
+                      inner_decode='beam', inner_maxlen=None, summary_opts=None, cache=None,
+                      video_cache=None, profiler=None, memory=None):
     vocablist = sorted(vocab.keys(), key=lambda s:vocab[s])
     result_dialogs = []
+    params = decoding_params(maxlen, beam, penalty, nbest, inner_decode, inner_maxlen, summary_opts)
     model.eval()
     #print(data)
     with torch.no_grad():
@@ -51,7 +64,7 @@ def generate_response(model, data, batch_indices, vocab, maxlen=20, beam=5, pena
                         x = [torch.from_numpy(x) for x in x_batch]
                         h = [[torch.from_numpy(h) for h in hb] for hb in h_batch]
                         q = [torch.from_numpy(q) for q in q_batch]
-                        s = torch.from_numpy(s_batch).cuda().float()
+                        s = torch.from_numpy(s_batch).to(model.input_device()).float()
                         smi = [torch.from_numpy(smi) for smi in summary_batch_in]
                         smo = [torch.from_numpy(smo) for smo in summary_batch_out]
                         ai = [torch.from_numpy(ai) for ai in a_batch_in]
@@ -61,20 +74,251 @@ def generate_response(model, data, batch_indices, vocab, maxlen=20, beam=5, pena
                         c = [torch.from_numpy(c) for c in c_batch]
                         all_ai = [torch.from_numpy(all_ai) for all_ai in all_a_batch_in]
                         all_qi = [torch.from_numpy(all_qi) for all_qi in all_q_batch_in]
-                        pred_out, _ = model.generate(x, h, q, c, s, ai, qi, all_ai, all_qi, maxlen=maxlen,
-                                                beam=beam, penalty=penalty, nbest=nbest)
+                        key = cache_key(cache, data, batch_indices[qa_id - 1][1][0], params) if cache is not None else None
+                        pred_out = cache.get(key) if key is not None else None
+                        if pred_out is None:
+                            if memory is not None:
+                                memory.begin('generate %d' % qa_id)
+                            keys = context_keys(video_cache, data, batch_indices[qa_id - 1]) \
+                                if video_cache is not None else None
+                            context = context_cache.video_context(model, video_cache, keys, x, c, s)
+                            pred_out, _ = model.generate(x, h, q, c, s, ai, qi, all_ai, all_qi, maxlen=maxlen,
+                                                    beam=beam, penalty=penalty, nbest=nbest,
+                                                    inner_decode=inner_decode, inner_maxlen=inner_maxlen,
+                                                    summary_opts=summary_opts, context=context)
+                            if key is not None:
+                                cache.put(key, pred_out)
+                            if memory is not None:
+                                memory.end('generate %d' % qa_id)
+                            if profiler is not None:
+                                profiler.step()
+                        else:
+                            model.round_projection()  # advance the generator as generate() would
                         for n in six.moves.range(min(nbest, len(pred_out))):
                             pred = pred_out[n]
                             hypstr = ' '.join([vocablist[w] for w in pred[0]])
                             logging.info('HYP[%d]: %s  ( %f )' % (n + 1, hypstr, pred[1]))
                             if n==0:
                                 pred_dialog['dialog'][t]['summary'] = hypstr
+                        mark_first_summary()
                         logging.info('ElapsedTime: %f' % (time.time() - start_time))
                         logging.info('-----------------------')
 
     return {'dialogs': result_dialogs}
 
 
+def decoding_params(maxlen, beam, penalty, nbest, inner_decode, inner_maxlen, summary_opts):
+    """Decoding parameters that change the generated summaries"""
+    opts = summary_opts or {}
+    return {'maxlen': maxlen, 'beam': beam, 'penalty': penalty, 'nbest': nbest,
+            'inner_decode': inner_decode, 'inner_maxlen': inner_maxlen,
+            'abs_margin': opts.get('abs_margin'), 'rel_margin': opts.get('rel_margin')}
+
+
+def cache_key(cache, data, index, params):
+    """Key of a sample of data['dialogs'] in the summary cache, including
+       the current state of the random generator"""
+    vid, _, history = data['dialogs'][index][:3]
+    caption = data['dialogs'][index][10]
+    rng = hashlib.sha1(torch.get_rng_state().numpy().tobytes()).hexdigest()
+    return cache.key(vid, caption, history, dict(params, rng=rng))
+
+
+def context_keys(video_cache, data, index):
+    """Keys of the samples of a batch in the video context cache"""
+    return [video_cache.key(data['dialogs'][i][0], data['dialogs'][i][10]) for i in index[1]]
+
+
+def replay_projections(model, states):
+    """Draw the projections that model.generate() would have drawn from
+       the given random generator states, leaving the generator unchanged"""
+    rng_state = torch.get_rng_state()
+    lin_layers = []
+    for state in states:
+        torch.set_rng_state(state)
+        lin_layers.append(model.round_projection())
+    torch.set_rng_state(rng_state)
+    return lin_layers
+
+
+def report_hypotheses(vocablist, qa_id, dialog, pred_dialog, t, pred_out, nbest):
+    logging.info('%d' % (qa_id + 1))
+    logging.info('REF: ' + dialog['summary'])
+    for n in six.moves.range(min(nbest, len(pred_out))):
+        pred = pred_out[n]
+        hypstr = ' '.join([vocablist[w] for w in pred[0]])
+        logging.info('HYP[%d]: %s  ( %f )' % (n + 1, hypstr, pred[1]))
+        if n==0:
+            pred_dialog['dialog'][t]['summary'] = hypstr
+    mark_first_summary()
+
+
+def generate_response_batched(model, data, batch_indices, vocab, batch_size, maxlen=20, beam=5, penalty=2.0, nbest=1,
+                              inner_decode='beam', inner_maxlen=None, summary_opts=None, cache=None,
+                              video_cache=None, profiler=None, memory=None):
+    """Generate summaries for many samples at once
+
+    Only samples with the same history, audio and caption lengths are put
+    in a batch, so that no padding is introduced and the results are the
+    same as those of generate_response().  The per-sample projection that
+    model.generate() draws from the random generator is reproduced by
+    replaying the generator state each sample would have seen.
+    """
+    vocablist = sorted(vocab.keys(), key=lambda s:vocab[s])
+    result_dialogs = []
+    params = decoding_params(maxlen, beam, penalty, nbest, inner_decode, inner_maxlen, summary_opts)
+    turns = []
+    for dialog in data['original']['dialogs']:
+        pred_dialog = {'image_id': dialog['image_id'],
+                       'dialog': copy.deepcopy(dialog['dialog'])}
+        result_dialogs.append(pred_dialog)
+        for t in six.moves.range(len(dialog['dialog'])):
+            turns.append((dialog, pred_dialog, t))
+
+    def run(pending):
+        start_time = time.time()
+        if memory is not None:
+            memory.begin('generate %d' % pending[0][0])
+        lin_layers = replay_projections(model, [state for _, state, _ in pending])
+        index = dh.merge_batch_indices([batch_indices[qa_id] for qa_id, _, _ in pending])
+        x_batch, h_batch, q_batch, a_batch_in, a_batch_out, s_batch, summary_batch_in, summary_batch_out, c_batch = \
+            dh.make_batch_a(data, index)
+        x = [torch.from_numpy(x) for x in x_batch]
+        h = [[torch.from_numpy(h) for h in hb] for hb in h_batch]
+        s = torch.from_numpy(s_batch).to(model.input_device()).float()
+        c = [torch.from_numpy(c) for c in c_batch]
+        keys = context_keys(video_cache, data, index) if video_cache is not None else None
+        pred_outs, _ = model.generate_batch(x, h, c, s, lin_layers=lin_layers, maxlen=maxlen,
+                                            beam=beam, penalty=penalty, nbest=nbest,
+                                            inner_decode=inner_decode, inner_maxlen=inner_maxlen,
+                                            summary_opts=summary_opts,
+                                            context=context_cache.video_context(model, video_cache, keys, x, c, s))
+        for (qa_id, _, ckey), pred_out in zip(pending, pred_outs):
+            dialog, pred_dialog, t = turns[qa_id]
+            report_hypotheses(vocablist, qa_id, dialog, pred_dialog, t, pred_out, nbest)
+            if ckey is not None:
+                cache.put(ckey, pred_out)
+        if memory is not None:
+            memory.end('generate %d' % pending[0][0])
+        if profiler is not None:
+            profiler.step()
+        logging.info('batch of %d, ElapsedTime: %f' % (len(pending), time.time() - start_time))
+        logging.info('-----------------------')
+
+    model.eval()
+    with torch.no_grad():
+        groups = {}
+        for qa_id, index in enumerate(batch_indices):
+            if index[3] >= 12:
+                continue
+            ckey = cache_key(cache, data, index[1][0], params) if cache is not None else None
+            pred_out = cache.get(ckey) if ckey is not None else None
+            if pred_out is not None:
+                dialog, pred_dialog, t = turns[qa_id]
+                report_hypotheses(vocablist, qa_id, dialog, pred_dialog, t, pred_out, nbest)
+                model.round_projection()  # advance the generator as generate() would
+                continue
+            # x_len, h_len and caption_len must match within a batch
+            key = (tuple(index[2]), index[3], index[7])
+            groups.setdefault(key, []).append((qa_id, torch.get_rng_state(), ckey))
+            model.round_projection()  # advance the generator as generate() would
+            if len(groups[key]) == batch_size:
+                run(groups.pop(key))
+        for key in sorted(groups, key=lambda k: groups[k][0][0]):
+            run(groups[key])
+
+    return {'dialogs': result_dialogs}
+
+
+def generate_response_dialogs(model, data, batch_indices, vocab, batch_size=1, maxlen=20, beam=5, penalty=2.0, nbest=1,
+                              inner_decode='beam', inner_maxlen=None, summary_opts=None, cache=None,
+                              video_cache=None, profiler=None, memory=None):
+    """Generate summaries for all the turns of a dialog as one job
+
+    The frames, audio and caption of a dialog are encoded once, and its
+    history is encoded once, sentence by sentence: the history of turn t is
+    the prefix of the one of the last turn.  Only the Q/A rounds that follow
+    each turn are run per turn.  Dialogs with the same audio and caption
+    lengths and number of turns are processed batch_size at a time.  The
+    results are the same as those of generate_response().
+    """
+    vocablist = sorted(vocab.keys(), key=lambda s:vocab[s])
+    result_dialogs = []
+    params = decoding_params(maxlen, beam, penalty, nbest, inner_decode, inner_maxlen, summary_opts)
+    jobs = []
+    qa_id = 0
+    for dialog in data['original']['dialogs']:
+        pred_dialog = {'image_id': dialog['image_id'],
+                       'dialog': copy.deepcopy(dialog['dialog'])}
+        result_dialogs.append(pred_dialog)
+        n_turns = len(dialog['dialog'])
+        # as in generate_response(), turns with 11 or more history sentences are skipped
+        jobs.append((dialog, pred_dialog, qa_id, min(n_turns, 11)))
+        qa_id += n_turns
+
+    def run(pending):
+        start_time = time.time()
+        index = dh.merge_batch_indices([batch_indices[job[2] + job[3] - 1] for job, _, _ in pending])
+        x_batch, h_batch, q_batch, a_batch_in, a_batch_out, s_batch, summary_batch_in, summary_batch_out, c_batch = \
+            dh.make_batch_a(data, index)
+        x = [torch.from_numpy(x) for x in x_batch]
+        h = [[torch.from_numpy(h) for h in hb] for hb in h_batch]
+        s = torch.from_numpy(s_batch).to(model.input_device()).float()
+        c = [torch.from_numpy(c) for c in c_batch]
+        keys = context_keys(video_cache, data, index) if video_cache is not None else None
+        context = context_cache.video_context(model, video_cache, keys, x, c, s)
+        history = model.encode_history(h)
+        for t in six.moves.range(pending[0][0][3]):
+            if memory is not None:
+                memory.begin('generate %d' % (pending[0][0][2] + t))
+            lin_layers = replay_projections(model, [states[t] for _, states, _ in pending])
+            pred_outs, _ = model.generate_batch(x, None, c, s, lin_layers=lin_layers, maxlen=maxlen,
+                                                beam=beam, penalty=penalty, nbest=nbest,
+                                                inner_decode=inner_decode, inner_maxlen=inner_maxlen,
+                                                summary_opts=summary_opts,
+                                                context=context, history=history[:, :t + 1])
+            for (job, _, ckeys), pred_out in zip(pending, pred_outs):
+                dialog, pred_dialog, qa_id, _ = job
+                report_hypotheses(vocablist, qa_id + t, dialog, pred_dialog, t, pred_out, nbest)
+                if ckeys is not None:
+                    cache.put(ckeys[t], pred_out)
+            if memory is not None:
+                memory.end('generate %d' % (pending[0][0][2] + t))
+            if profiler is not None:
+                profiler.step()
+        logging.info('%d dialogs, ElapsedTime: %f' % (len(pending), time.time() - start_time))
+        logging.info('-----------------------')
+
+    model.eval()
+    with torch.no_grad():
+        groups = {}
+        for job in jobs:
+            states = []
+            ckeys = [] if cache is not None else None
+            for t in six.moves.range(job[3]):
+                states.append(torch.get_rng_state())
+                if cache is not None:
+                    ckeys.append(cache_key(cache, data, batch_indices[job[2] + t][1][0], params))
+                model.round_projection()  # advance the generator as generate() would
+            # a dialog is generated again unless all its turns are cached
+            pred_outs = cache.get_all(ckeys) if cache is not None else None
+            if pred_outs is not None:
+                dialog, pred_dialog, qa_id, _ = job
+                for t, pred_out in enumerate(pred_outs):
+                    report_hypotheses(vocablist, qa_id + t, dialog, pred_dialog, t, pred_out, nbest)
+                continue
+            # x_len, caption_len and the number of turns must match within a batch
+            index = batch_indices[job[2]]
+            key = (tuple(index[2]), index[7], job[3])
+            groups.setdefault(key, []).append((job, states, ckeys))
+            if len(groups[key]) == batch_size:
+                run(groups.pop(key))
+        for key in sorted(groups, key=lambda k: groups[k][0][0][2]):
+            run(groups[key])
+
+    return {'dialogs': result_dialogs}
+
+
 ##################################
 # main
 if __name__ =="__main__":
@@ -87,9 +331,10 @@ if __name__ =="__main__":
     parser.add_argument('--test-set', default='', type=str,
                         help='Filename of test data')
     parser.add_argument('--model-conf', default='', type=str,
-                        help='Attention model to be output')
+                        help='Attention model to be output (not needed for a .state checkpoint)')
     parser.add_argument('--model', '-m', default='', type=str,
-                        help='Attention model to be output')
+                        help='Attention model to be output: loaded from <model>.state '
+                             'if it exists, else from <model>.pth.tar')
     parser.add_argument('--maxlen', default=30, type=int,
                         help='Max-length of output sequence')
     parser.add_argument('--beam', default=3, type=int,
@@ -98,6 +343,56 @@ if __name__ =="__main__":
                         help='Insertion penalty')
     parser.add_argument('--nbest', default=5, type=int,
                         help='Number of n-best hypotheses')
+    parser.add_argument('--no-early-stop', action='store_true',
+                        help='Always run --maxlen steps of the summary beam search')
+    parser.add_argument('--beam-margin', default=None, type=float,
+                        help='Prune the summary hypotheses whose log probability '
+                             'is more than this below the best one')
+    parser.add_argument('--beam-rel-margin', default=None, type=float,
+                        help='Prune the summary hypotheses whose log probability '
+                             'is below (1 + this) times the best one')
+    parser.add_argument('--inner-decode', default='beam', choices=['beam', 'greedy'],
+                        help='Decoding of the questions and answers of the '
+                             'dialog rounds (beam: width-1 beam search)')
+    parser.add_argument('--inner-maxlen', default=None, type=int,
+                        help='Max-length of the questions and answers of the '
+                             'dialog rounds (defaults to --maxlen)')
+    parser.add_argument('--batch-size', '-b', default=1, type=int,
+                        help='Number of samples generated at once')
+    parser.add_argument('--dialog-job', action='store_true',
+                        help='Generate all the turns of a dialog at once, '
+                             'sharing the video context and history encodings')
+    parser.add_argument('--cache-dir', default='', type=str,
+                        help='Directory of the generated summary cache (disabled if empty)')
+    parser.add_argument('--cache-size', default=1024, type=int,
+                        help='Size limit of the summary cache in MB')
+    parser.add_argument('--context-cache-size', default=0, type=int,
+                        help='Size limit in MB of the in-memory cache of the per-video '
+                             'frame, audio and caption encodings (disabled if 0)')
+    parser.add_argument('--context-spill-dir', default='', type=str,
+                        help='Directory the entries evicted from the context cache are written to')
+    parser.add_argument('--profile', default='', type=str,
+                        help='Profile a window of generation steps (samples, or batches with '
+                             '--batch-size/--dialog-job) and write the trace and operator summary '
+                             'to files with this prefix')
+    parser.add_argument('--profile-videos', nargs='+', default=[], type=str,
+                        help='Generate only the dialogs of these videos when profiling')
+    parser.add_argument('--profile-start', default=0, type=int,
+                        help='Number of steps before the profiler schedule begins')
+    parser.add_argument('--profile-wait', default=1, type=int,
+                        help='Number of steps waited before the profiler warmup')
+    parser.add_argument('--profile-warmup', default=1, type=int,
+                        help='Number of profiled steps discarded as warmup')
+    parser.add_argument('--profile-active', default=3, type=int,
+                        help='Number of steps recorded')
+    parser.add_argument('--profile-top', default=20, type=int,
+                        help='Number of operators in the profile summary tables')
+    parser.add_argument('--profile-no-memory', action='store_true',
+                        help='Do not record memory allocations in the profile')
+    parser.add_argument('--profile-no-stack', action='store_true',
+                        help='Do not record the source stacks of the operators in the profile')
+    parser.add_argument('--memory-report', action='store_true',
+                        help='Report the memory of the test data and of each generation call')
     parser.add_argument('--output', '-o', default='', type=str,
                         help='Output generated responses in a json file')
     parser.add_argument('--verbose', '-v', default=0, type=int,
@@ -112,14 +407,13 @@ if __name__ =="__main__":
         logging.basicConfig(level=logging.INFO,
             format='%(asctime)s %(levelname)s: %(message)s')
  
+    logging.info('startup: %f' % (time.time() - start_at))
     logging.info('Loading model params from ' + args.model)
-    path = args.model_conf
-    with open(path, 'r') as f:
-        vocab, train_args = pickle.load(f)
-
-    model = torch.load(args.model+'.pth.tar')
+    load_at = time.time()
+    import model_io
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    model.to(device)
+    model, vocab, train_args, model_files = model_io.load_model(args.model, args.model_conf, device)
+    logging.info('model loaded from %s in %f' % (', '.join(model_files), time.time() - load_at))
 
     if train_args.dictmap != '':
         dictmap = json.load(open(train_args.dictmap, 'r'))
@@ -129,19 +423,91 @@ if __name__ =="__main__":
     logging.info('#vocab = %d' % len(vocab))
     # prepare test data
     logging.info('Loading test data from ' + args.test_set)
-    test_data = dh.load(train_args.fea_type, args.test_path, args.test_set,
-                        vocab=vocab, dictmap=dictmap, 
-                        include_caption=train_args.include_caption)
+    if args.profile and args.profile_videos:
+        dialog_data = json.load(open(args.test_set, 'r'))
+        videos = set(args.profile_videos)
+        dialog_data['dialogs'] = [d for d in dialog_data['dialogs'] if d['image_id'] in videos]
+        if len(dialog_data['dialogs']) == 0:
+            parser.error('no dialog of the videos ' + ' '.join(args.profile_videos))
+        test_data = dh.load_dialogs(train_args.fea_type, args.test_path, dialog_data,
+                                    vocab=vocab, dictmap=dictmap,
+                                    include_caption=train_args.include_caption)
+    else:
+        test_data = dh.load(train_args.fea_type, args.test_path, args.test_set,
+                            vocab=vocab, dictmap=dictmap, 
+                            include_caption=train_args.include_caption)
     test_indices, test_samples = dh.make_batch_indices(test_data, 1)
+    if args.memory_report:
+        memory_usage.log_dataset('test', test_data)
+        memory = memory_usage.MemoryAccount(model)
+        memory.end('startup')
+    else:
+        memory = None
     logging.info('#test sample = %d' % test_samples)
+    logging.info('ready after %f' % (time.time() - start_at))
     # generate sentences
     logging.info('-----------------------generate--------------------------')
+    if args.cache_dir or args.context_spill_dir:
+        import summary_cache
+        checkpoint_hash = hashlib.sha1(' '.join(summary_cache.file_hash(f) for f in model_files)
+                                       .encode('utf-8')).hexdigest()
+    else:
+        checkpoint_hash = ''
+    if args.cache_dir:
+        cache = summary_cache.SummaryCache(args.cache_dir, checkpoint_hash,
+                                           max_bytes=args.cache_size << 20)
+    else:
+        cache = None
+    if args.context_cache_size > 0:
+        video_cache = context_cache.ContextCache(checkpoint_hash, max_bytes=args.context_cache_size << 20,
+                                                 spill_dir=args.context_spill_dir or None)
+    else:
+        video_cache = None
+    if args.profile:
+        profiler = profiling.ProfileWindow(args.profile, wait=args.profile_wait,
+                                           warmup=args.profile_warmup, active=args.profile_active,
+                                           start=args.profile_start, memory=not args.profile_no_memory,
+                                           stack=not args.profile_no_stack, top=args.profile_top)
+    else:
+        profiler = None
     start_time = time.time()
-    result = generate_response(model, test_data, test_indices, vocab, 
-                               maxlen=args.maxlen, beam=args.beam, 
-                               penalty=args.penalty, nbest=args.nbest)
+    search_stats = {}
+    summary_opts = {'early_stop': not args.no_early_stop, 'abs_margin': args.beam_margin,
+                    'rel_margin': args.beam_rel_margin, 'stats': search_stats}
+    if args.dialog_job:
+        result = generate_response_dialogs(model, test_data, test_indices, vocab, args.batch_size,
+                                           maxlen=args.maxlen, beam=args.beam,
+                                           penalty=args.penalty, nbest=args.nbest,
+                                           inner_decode=args.inner_decode, inner_maxlen=args.inner_maxlen,
+                                           summary_opts=summary_opts, cache=cache,
+                                           video_cache=video_cache, profiler=profiler, memory=memory)
+    elif args.batch_size > 1:
+        result = generate_response_batched(model, test_data, test_indices, vocab, args.batch_size,
+                                           maxlen=args.maxlen, beam=args.beam,
+                                           penalty=args.penalty, nbest=args.nbest,
+                                           inner_decode=args.inner_decode, inner_maxlen=args.inner_maxlen,
+                                           summary_opts=summary_opts, cache=cache,
+                                           video_cache=video_cache, profiler=profiler, memory=memory)
+    else:
+        result = generate_response(model, test_data, test_indices, vocab, 
+                                   maxlen=args.maxlen, beam=args.beam, 
+                                   penalty=args.penalty, nbest=args.nbest,
+                                   inner_decode=args.inner_decode, inner_maxlen=args.inner_maxlen,
+                                   summary_opts=summary_opts, cache=cache,
+                                   video_cache=video_cache, profiler=profiler, memory=memory)
+    if profiler is not None:
+        profiler.close()
     logging.info('----------------')
     logging.info('wall time = %f' % (time.time() - start_time))
+    if search_stats.get('searches', 0) > 0:
+        n = float(search_stats['searches'])
+        logging.info('summary beam search: %.2f steps on average, %.2f saved out of %d'
+                     % (search_stats['steps'] / n, (search_stats['max_steps'] - search_stats['steps']) / n,
+                        args.maxlen))
+    if cache is not None:
+        cache.report()
+    if video_cache is not None:
+        video_cache.report()
     if args.output:
         logging.info('writing results to ' + args.output)
         json.dump(result, open(args.output, 'w'), indent=4)
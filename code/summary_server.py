@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+"""Resident summary generation server
+   The model, vocabulary and decoding settings are loaded once, and
+   summaries are served over HTTP on a local port.
+
+   POST /generate with a json dialog
+       {"image_id": "...", "caption": "...",
+        "dialog": [{"question": "...", "answer": "..."}, ...],
+        "features": {"<FeaType>": "path.npy", ...}}
+   returns the n-best summaries given the caption and all the QA pairs
+   (at most 10; the rounds up to the 10th are generated by the model)
+       {"summaries": [{"summary": "...", "score": ...}, ...], "latency": ...}
+   "features" is optional; the files are found from --fea-path otherwise.
+
+   GET /metrics returns the queue depth, batch sizes and latency percentiles
+   (and the context cache hits).
+
+   Concurrent requests are coalesced into micro-batches: a batch is run
+   when it reaches --max-batch requests or when its first request has
+   waited --max-wait milliseconds.  Requests with the same history, audio
+   and caption lengths are decoded together (see generate_batch).
+   With --context-cache-size, the frame, audio and caption encodings of the
+   videos given by image_id are kept between requests (see context_cache.py).
+"""
+
+import argparse
+import collections
+import json
+import logging
+import threading
+import time
+
+import six
+from six.moves import BaseHTTPServer
+from six.moves import queue
+from six.moves import socketserver
+
+import torch
+import qa_data_handler as dh
+import model_io
+import context_cache
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return 0.
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100. * len(values)))]
+
+
+class Metrics(object):
+
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.waits = collections.deque(maxlen=window)
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.batched_requests = 0
+        self.max_queue_depth = 0
+
+
+    def enqueued(self, depth):
+        with self.lock:
+            self.requests += 1
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+
+
+    def batch(self, size):
+        with self.lock:
+            self.batches += 1
+            self.batched_requests += size
+
+
+    def done(self, latency, wait, error=False):
+        with self.lock:
+            self.latencies.append(latency)
+            self.waits.append(wait)
+            if error:
+                self.errors += 1
+
+
+    def snapshot(self, depth):
+        with self.lock:
+            latencies = list(self.latencies)
+            waits = list(self.waits)
+            return {'queue_depth': depth,
+                    'max_queue_depth': self.max_queue_depth,
+                    'requests': self.requests,
+                    'errors': self.errors,
+                    'batches': self.batches,
+                    'mean_batch_size': float(self.batched_requests) / self.batches if self.batches > 0 else 0.,
+                    'latency_ms': dict(('p%d' % p, 1000. * percentile(latencies, p)) for p in (50, 90, 99)),
+                    'queue_wait_ms': dict(('p%d' % p, 1000. * percentile(waits, p)) for p in (50, 90, 99))}
+
+
+class Request(object):
+
+    def __init__(self, uid, sample, features, index, vid=None):
+        self.uid = uid
+        self.vid = vid
+        self.sample = sample
+        self.features = features
+        self.index = index
+        self.arrival = time.time()
+        self.start = None
+        self.result = None
+        self.error = None
+        self.event = threading.Event()
+
+
+class Batcher(object):
+
+    def __init__(self, model, vocab, train_args, args, dictmap=None, video_cache=None):
+        self.model = model
+        self.vocab = vocab
+        self.vocablist = sorted(vocab.keys(), key=lambda s:vocab[s])
+        self.fea_types = train_args.fea_type
+        self.include_caption = train_args.include_caption
+        self.args = args
+        self.dictmap = dictmap
+        self.video_cache = video_cache
+        self.metrics = Metrics()
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.n_requests = 0
+        thread = threading.Thread(target=self._loop)
+        thread.daemon = True
+        thread.start()
+
+
+    def prepare(self, body):
+        """Convert a json dialog into a Request"""
+        turns = body.get('dialog', [])
+        if len(turns) > 10:
+            raise ValueError('at most 10 QA pairs are supported')
+        with self.lock:
+            uid = 'request-%d' % self.n_requests
+            self.n_requests += 1
+        features = body.get('features', {})
+        fea_files = {}
+        # only the features found from the image id can be cached
+        vid = body.get('image_id') if len(features) == 0 else None
+        for ftype in self.fea_types:
+            if ftype in features:
+                fea_files[ftype] = {uid: features[ftype]}
+            elif 'image_id' in body and self.args.fea_path:
+                vid = self.dictmap[body['image_id']] if self.dictmap is not None else body['image_id']
+                fea_files[ftype] = {uid: self.args.fea_path.replace('<FeaType>', ftype)
+                                                          .replace('<ImageID>', vid)}
+            else:
+                raise ValueError('no %s features for this request' % ftype)
+        # the sample after the given turns has all of them in its history; the
+        # turns are padded with empty ones, since load_dialogs() also reads the
+        # remaining rounds up to the 10th (not used by generation)
+        n = len(turns)
+        padding = [{'question': '', 'answer': ''}] * max(1, 10 - n)
+        dialog = {'image_id': uid, 'caption': body.get('caption', ''), 'summary': '',
+                  'dialog': [{'question': t['question'], 'answer': t['answer']} for t in turns] + padding}
+        data = dh.load_dialogs(self.fea_types, '', {'dialogs': [dialog]}, vocab=self.vocab,
+                               include_caption=self.include_caption, fea_files=fea_files)
+        # batches of one sample keep the order of the samples
+        indices, _ = dh.make_batch_indices(data, 1)
+        return Request(uid, data['dialogs'][n], [f[uid] for f in data['features']], indices[n], vid=vid)
+
+
+    def submit(self, body):
+        arrival = time.time()
+        try:
+            request = self.prepare(body)
+        except Exception:
+            # rejected requests are counted as failed ones
+            self.metrics.enqueued(self.queue.qsize())
+            self.metrics.done(time.time() - arrival, 0., error=True)
+            raise
+        self.queue.put(request)
+        self.metrics.enqueued(self.queue.qsize())
+        request.event.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+
+    def _loop(self):
+        while True:
+            pending = [self.queue.get()]
+            deadline = pending[0].arrival + self.args.max_wait / 1000.
+            while len(pending) < self.args.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            # only requests of the same shapes can be decoded together
+            groups = collections.OrderedDict()
+            for request in pending:
+                index = request.index
+                groups.setdefault((tuple(index[2]), index[3], index[7]), []).append(request)
+            for group in groups.values():
+                self._run(group)
+
+
+    def _run(self, group):
+        start_time = time.time()
+        for request in group:
+            request.start = start_time
+        self.metrics.batch(len(group))
+        try:
+            data = {'dialogs': [r.sample for r in group],
+                    'features': [dict((r.uid, r.features[i]) for r in group)
+                                 for i in six.moves.range(len(self.fea_types))]}
+            indices = []
+            for n, r in enumerate(group):
+                index = list(r.index)
+                index[1] = [n]
+                indices.append(tuple(index))
+            index = dh.merge_batch_indices(indices)
+            x_batch, h_batch, q_batch, a_batch_in, a_batch_out, s_batch, summary_batch_in, summary_batch_out, c_batch = \
+                dh.make_batch_a(data, index)
+            x = [torch.from_numpy(x) for x in x_batch]
+            h = [[torch.from_numpy(h) for h in hb] for hb in h_batch]
+            s = torch.from_numpy(s_batch).to(self.model.input_device()).float()
+            c = [torch.from_numpy(c) for c in c_batch]
+            if self.video_cache is not None and all(r.vid is not None for r in group):
+                cache = self.video_cache
+                keys = [cache.key(r.vid, r.sample[10]) for r in group]
+            else:
+                cache = keys = None
+            with torch.no_grad():
+                context = context_cache.video_context(self.model, cache, keys, x, c, s)
+                pred_outs, _ = self.model.generate_batch(x, h, c, s, maxlen=self.args.maxlen, beam=self.args.beam,
+                                                         penalty=self.args.penalty, nbest=self.args.nbest,
+                                                         inner_decode=self.args.inner_decode, context=context)
+            for r, pred_out in zip(group, pred_outs):
+                r.result = {'summaries': [{'summary': ' '.join([self.vocablist[w] for w in hyp]), 'score': score}
+                                          for hyp, score in pred_out]}
+        except Exception as e:
+            logging.exception('batch of %d failed' % len(group))
+            for r in group:
+                r.error = e
+        end_time = time.time()
+        for r in group:
+            if r.result is not None:
+                r.result['latency'] = end_time - r.arrival
+            self.metrics.done(end_time - r.arrival, r.start - r.arrival, error=r.error is not None)
+            r.event.set()
+        logging.debug('batch of %d, ElapsedTime: %f' % (len(group), end_time - start_time))
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def _reply(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            batcher = self.server.batcher
+            metrics = batcher.metrics.snapshot(batcher.queue.qsize())
+            if batcher.video_cache is not None:
+                metrics['context_cache'] = batcher.video_cache.stats()
+            self._reply(200, metrics)
+        else:
+            self._reply(404, {'error': 'unknown path ' + self.path})
+
+
+    def do_POST(self):
+        if self.path != '/generate':
+            self._reply(404, {'error': 'unknown path ' + self.path})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length).decode('utf-8'))
+            result = self.server.batcher.submit(body)
+        except (ValueError, KeyError, IOError) as e:
+            self._reply(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self._reply(500, {'error': str(e)})
+            return
+        self._reply(200, result)
+
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+##################################
+# main
+if __name__ =="__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--model-conf', default='', type=str,
+                        help='Attention model to be output (not needed for a .state checkpoint)')
+    parser.add_argument('--model', '-m', default='', type=str,
+                        help='Attention model to be output: loaded from <model>.state '
+                             'if it exists, else from <model>.pth.tar')
+    parser.add_argument('--fea-path', default='', type=str,
+                        help='Path pattern of the feature files, with <FeaType> and <ImageID>')
+    parser.add_argument('--host', default='127.0.0.1', type=str,
+                        help='Address to listen on')
+    parser.add_argument('--port', default=8080, type=int,
+                        help='Port to listen on')
+    parser.add_argument('--max-batch', default=8, type=int,
+                        help='Maximum number of requests decoded at once')
+    parser.add_argument('--max-wait', default=20., type=float,
+                        help='Maximum time (ms) a request waits for a batch to fill')
+    parser.add_argument('--maxlen', default=30, type=int,
+                        help='Max-length of output sequence')
+    parser.add_argument('--beam', default=3, type=int,
+                        help='Beam width')
+    parser.add_argument('--penalty', default=2.0, type=float,
+                        help='Insertion penalty')
+    parser.add_argument('--nbest', default=5, type=int,
+                        help='Number of n-best hypotheses')
+    parser.add_argument('--inner-decode', default='beam', choices=['beam', 'greedy'],
+                        help='Decoding of the questions and answers of the dialog rounds')
+    parser.add_argument('--context-cache-size', default=0, type=int,
+                        help='Size limit in MB of the in-memory cache of the per-video '
+                             'frame, audio and caption encodings (disabled if 0)')
+    parser.add_argument('--context-spill-dir', default='', type=str,
+                        help='Directory the entries evicted from the context cache are written to')
+    parser.add_argument('--verbose', '-v', default=0, type=int,
+                        help='verbose level')
+
+    args = parser.parse_args()
+
+    if args.verbose >= 1:
+        logging.basicConfig(level=logging.DEBUG,
+            format='%(asctime)s (%(module)s:%(lineno)d) %(levelname)s: %(message)s')
+    else:
+        logging.basicConfig(level=logging.INFO,
+            format='%(asctime)s %(levelname)s: %(message)s')
+
+    logging.info('Loading model params from ' + args.model)
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    model, vocab, train_args, model_files = model_io.load_model(args.model, args.model_conf, device)
+    model.eval()
+    logging.info('#vocab = %d' % len(vocab))
+    if train_args.dictmap != '':
+        dictmap = json.load(open(train_args.dictmap, 'r'))
+    else:
+        dictmap = None
+
+    if args.context_cache_size > 0:
+        import hashlib
+        import summary_cache
+        checkpoint_hash = hashlib.sha1(' '.join(summary_cache.file_hash(f) for f in model_files)
+                                       .encode('utf-8')).hexdigest()
+        video_cache = context_cache.ContextCache(checkpoint_hash, max_bytes=args.context_cache_size << 20,
+                                                 spill_dir=args.context_spill_dir or None)
+    else:
+        video_cache = None
+
+    server = Server((args.host, args.port), Handler)
+    server.batcher = Batcher(model, vocab, train_args, args, dictmap=dictmap, video_cache=video_cache)
+    logging.info('serving on http://%s:%d' % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    logging.info('done')
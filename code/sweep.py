@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""Hyperparameter sweep over qa_train.py
+   The trials of a grid or random search are run as concurrent qa_train.py
+   processes on this host, as many at a time as the core and memory limits
+   allow.  The dialogs are tokenized and the features packed once, into
+   <out-dir>/data (see qa_data_handler.save_preprocessed); the trainings
+   read the features through memory maps of the same files, so they share
+   one copy in the page cache.  The results of all the trials are collected
+   into <out-dir>/results.csv.
+
+   spec (json):
+       {"grid": {"att-size": [64, 128], "batch-size": [32, 64]}}
+   or
+       {"random": {"trials": 8, "seed": 1,
+                   "params": {"dec-hsize": [128, 256, 512],
+                              "att-size": {"low": 64, "high": 256, "int": true, "log": true}}}}
+   The parameter names are qa_train.py options without the leading dashes;
+   a list value of an option that takes several arguments is given as a list,
+   e.g. "enc-psize": [[64], [128, 128]].
+
+   usage: sweep.py --spec spec.json --out-dir exp/sweep -- <qa_train.py options>
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import time
+
+import six
+
+
+def trials_of(spec):
+    """Return the list of parameter dicts of the trials of a spec"""
+    if 'grid' in spec:
+        names = sorted(spec['grid'])
+        return [dict(zip(names, values))
+                for values in itertools.product(*[spec['grid'][n] for n in names])]
+    rs = spec['random']
+    rng = random.Random(rs.get('seed', 1))
+    trials = []
+    for _ in six.moves.range(rs['trials']):
+        trial = {}
+        for name in sorted(rs['params']):
+            dist = rs['params'][name]
+            if isinstance(dist, list):
+                trial[name] = rng.choice(dist)
+            else:
+                if dist.get('log', False):
+                    value = math.exp(rng.uniform(math.log(dist['low']), math.log(dist['high'])))
+                else:
+                    value = rng.uniform(dist['low'], dist['high'])
+                trial[name] = int(round(value)) if dist.get('int', False) else value
+        trials.append(trial)
+    return trials
+
+
+def trial_args(trial):
+    args = []
+    for name in sorted(trial):
+        value = trial[name]
+        if isinstance(value, bool):
+            if value:
+                args.append('--' + name)
+            continue
+        args.append('--' + name)
+        args.extend(str(v) for v in (value if isinstance(value, list) else [value]))
+    return args
+
+
+def available_memory():
+    """Available memory in bytes (Linux), or None"""
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+
+def max_concurrent(args):
+    cores = multiprocessing.cpu_count()
+    n = args.max_jobs if args.max_jobs > 0 else cores
+    n = min(n, max(1, cores // args.cores_per_job))
+    memory = available_memory()
+    if args.mem_per_job > 0 and memory is not None:
+        n = min(n, max(1, int(memory // (args.mem_per_job * (1 << 30)))))
+    return n
+
+
+def run_sweep(args, train_args, trials):
+    train = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'qa_train.py')
+    n_jobs = max_concurrent(args)
+    logging.info('%d trials, %d at a time' % (len(trials), n_jobs))
+    pending = list(enumerate(trials))
+    running = {}
+    results = []
+    while pending or running:
+        while pending and len(running) < n_jobs:
+            k, trial = pending.pop(0)
+            trial_dir = os.path.join(args.out_dir, 'trial%d' % k)
+            if not os.path.isdir(trial_dir):
+                os.makedirs(trial_dir)
+            with open(os.path.join(trial_dir, 'trial.json'), 'w') as f:
+                json.dump(trial, f)
+            env = dict(os.environ, OMP_NUM_THREADS=str(args.cores_per_job),
+                       MKL_NUM_THREADS=str(args.cores_per_job))
+            if args.gpus:
+                env['CUDA_VISIBLE_DEVICES'] = args.gpus[k % len(args.gpus)]
+            cmd = [sys.executable, train] + train_args + trial_args(trial) + \
+                  ['--model', os.path.join(trial_dir, 'avsd_model')]
+            log = open(os.path.join(trial_dir, 'train.log'), 'w')
+            logging.info('trial %d: %s' % (k, ' '.join(trial_args(trial))))
+            running[k] = (subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT),
+                          log, trial, time.time())
+        time.sleep(1)
+        for k in list(running):
+            proc, log, trial, start = running[k]
+            if proc.poll() is None:
+                continue
+            log.close()
+            del running[k]
+            result = {'trial': k, 'params': trial, 'status': proc.returncode,
+                      'wall_time': time.time() - start}
+            path = os.path.join(args.out_dir, 'trial%d' % k, 'avsd_model.results.json')
+            if proc.returncode == 0 and os.path.exists(path):
+                with open(path, 'r') as f:
+                    result.update(json.load(f))
+            logging.info('trial %d finished with status %d' % (k, proc.returncode))
+            results.append(result)
+    return results
+
+
+def report(results, out_dir):
+    """Log and write the comparison table of the trials, best first"""
+    names = sorted(set(name for r in results for name in r['params']))
+    results = sorted(results, key=lambda r: (r['status'] != 0, r.get('valid_ppl', float('inf'))))
+    columns = ['trial'] + names + ['valid_ppl', 'best_epoch', 'iters_per_sec', 'wall_time', 'status']
+    rows = []
+    for r in results:
+        row = [r['trial']] + [r['params'].get(n, '') for n in names] + \
+              [r.get('valid_ppl', ''), r.get('best_epoch', ''), r.get('iters_per_sec', ''),
+               r['wall_time'], r['status']]
+        rows.append([('%.4g' % v) if isinstance(v, float) else
+                     ' '.join(str(x) for x in v) if isinstance(v, list) else str(v) for v in row])
+    with open(os.path.join(out_dir, 'results.csv'), 'w') as f:
+        f.write(','.join(columns) + '\n')
+        for row in rows:
+            f.write(','.join('"%s"' % v if ',' in v else v for v in row) + '\n')
+    with open(os.path.join(out_dir, 'results.json'), 'w') as f:
+        json.dump(results, f, indent=1)
+    widths = [max([len(c)] + [len(row[i]) for row in rows]) for i, c in enumerate(columns)]
+    logging.info('  '.join(c.rjust(w) for c, w in zip(columns, widths)))
+    for row in rows:
+        logging.info('  '.join(v.rjust(w) for v, w in zip(row, widths)))
+
+
+##################################
+# main
+if __name__ =="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--spec', required=True, type=str,
+                        help='Search spec (.json)')
+    parser.add_argument('--out-dir', required=True, type=str,
+                        help='Directory of the trials, shared data and results')
+    parser.add_argument('--max-jobs', default=0, type=int,
+                        help='Maximum number of concurrent trainings (0: number of cores)')
+    parser.add_argument('--cores-per-job', default=1, type=int,
+                        help='CPU threads given to each training')
+    parser.add_argument('--mem-per-job', default=0., type=float,
+                        help='Memory (GB) reserved for each training (0: no limit)')
+    parser.add_argument('--gpus', nargs='*', default=[], type=str,
+                        help='GPU ids assigned to the trials in turn')
+    parser.add_argument('train_args', nargs=argparse.REMAINDER,
+                        help='qa_train.py options shared by all the trials, after --')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s: %(message)s')
+
+    train_args = args.train_args[1:] if args.train_args[:1] == ['--'] else args.train_args
+    if '--model' in train_args or '-m' in train_args:
+        parser.error('--model is set for each trial')
+    with open(args.spec, 'r') as f:
+        trials = trials_of(json.load(f))
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+
+    if '--data-cache' not in train_args:
+        train_args = train_args + ['--data-cache', os.path.join(args.out_dir, 'data')]
+    # the data is prepared once, before the trainings start
+    cache = train_args[train_args.index('--data-cache') + 1]
+    if not os.path.exists(os.path.join(cache, 'data.pkl')):
+        logging.info('preparing the shared data in ' + cache)
+        train = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'qa_train.py')
+        status = subprocess.call([sys.executable, train] + train_args +
+                                 ['--prepare-only', '--model', os.path.join(args.out_dir, 'prepare')])
+        if status != 0:
+            sys.exit(status)
+
+    results = run_sweep(args, train_args, trials)
+    report(results, args.out_dir)
+    logging.info('done')
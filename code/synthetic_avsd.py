@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""Synthetic AVSD corpus
+   Writes dialogs in the AVSD json format, with a caption, a summary and 10
+   question/answer turns per video, and the matching feature files
+       <out-dir>/dialogs.json
+       <out-dir>/vggish/<ImageID>.npy            (frames, 128)
+       <out-dir>/i3d_rgb_vgg19_4/<ImageID>.npy   (4, 49, 512)
+   so that the data handling and the model can be run (e.g. by benchmark.py)
+   without the Charades features.  The words are drawn from a Zipf
+   distribution over a synthetic vocabulary.  The output only depends on the
+   options, the same seed gives the same files.
+
+   usage: synthetic_avsd.py --out-dir data/synthetic --num-dialogs 200
+"""
+
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+import six
+
+# feature types and shapes of the files read by the model
+# (the frame count of the audio features varies per video)
+AUDIO_FEATURE = 'vggish'
+VISUAL_FEATURE = 'i3d_rgb_vgg19_4'
+AUDIO_DIM = 128
+VISUAL_SHAPE = (4, 49, 512)
+NUM_TURNS = 10
+
+FEA_FILE = '<FeaType>/<ImageID>.npy'
+
+DEFAULTS = {'num_dialogs': 200, 'vocab_size': 2000, 'min_frames': 20, 'max_frames': 100, 'seed': 1}
+
+
+def _sentence(rng, vocab_size, min_len, max_len):
+    n = rng.randint(min_len, max_len + 1)
+    ids = np.minimum(rng.zipf(1.3, n), vocab_size) - 1
+    return ' '.join('w%d' % i for i in ids)
+
+
+def generate(out_dir, num_dialogs=200, vocab_size=2000, min_frames=20, max_frames=100, seed=1):
+    """Write a synthetic corpus
+
+    Args:
+        out_dir (str): output directory
+        num_dialogs (int): number of dialogs (one per video)
+        vocab_size (int): number of distinct words
+        min_frames, max_frames (int): range of the audio feature lengths
+        seed (int): random seed
+    Return:
+        (dialog file, feature path pattern for qa_data_handler.load())
+    """
+    rng = np.random.RandomState(seed)
+    for ftype in (AUDIO_FEATURE, VISUAL_FEATURE):
+        if not os.path.isdir(os.path.join(out_dir, ftype)):
+            os.makedirs(os.path.join(out_dir, ftype))
+    dialogs = []
+    for n in six.moves.range(num_dialogs):
+        vid = 'S%05d' % n
+        dialog = {'image_id': vid,
+                  'caption': _sentence(rng, vocab_size, 8, 25),
+                  'summary': _sentence(rng, vocab_size, 20, 50),
+                  'dialog': [{'question': _sentence(rng, vocab_size, 4, 12),
+                              'answer': _sentence(rng, vocab_size, 3, 15)}
+                             for _ in six.moves.range(NUM_TURNS)]}
+        dialogs.append(dialog)
+        frames = rng.randint(min_frames, max_frames + 1)
+        np.save(os.path.join(out_dir, AUDIO_FEATURE, vid + '.npy'),
+                rng.standard_normal((frames, AUDIO_DIM)).astype(np.float32))
+        np.save(os.path.join(out_dir, VISUAL_FEATURE, vid + '.npy'),
+                rng.standard_normal(VISUAL_SHAPE).astype(np.float32))
+    dialog_file = os.path.join(out_dir, 'dialogs.json')
+    with open(dialog_file, 'w') as f:
+        json.dump({'dialogs': dialogs}, f)
+    with open(os.path.join(out_dir, 'synthetic.json'), 'w') as f:
+        json.dump({'num_dialogs': num_dialogs, 'vocab_size': vocab_size, 'min_frames': min_frames,
+                   'max_frames': max_frames, 'seed': seed}, f)
+    return dialog_file, os.path.join(out_dir, FEA_FILE)
+
+
+def ensure(out_dir, **options):
+    """Generate the corpus unless out_dir already holds one made with the
+       same options; return the same as generate()"""
+    options = dict(DEFAULTS, **options)
+    info = os.path.join(out_dir, 'synthetic.json')
+    if os.path.exists(info):
+        with open(info, 'r') as f:
+            if json.load(f) == options:
+                return os.path.join(out_dir, 'dialogs.json'), os.path.join(out_dir, FEA_FILE)
+    logging.info('generating a synthetic corpus in ' + out_dir)
+    return generate(out_dir, **options)
+
+
+##################################
+# main
+if __name__ =="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--out-dir', required=True, type=str,
+                        help='Output directory')
+    parser.add_argument('--num-dialogs', default=200, type=int,
+                        help='Number of dialogs (one per video)')
+    parser.add_argument('--vocab-size', default=2000, type=int,
+                        help='Number of distinct words')
+    parser.add_argument('--min-frames', default=20, type=int,
+                        help='Minimum length of the audio features')
+    parser.add_argument('--max-frames', default=100, type=int,
+                        help='Maximum length of the audio features')
+    parser.add_argument('--seed', default=1, type=int,
+                        help='Random seed')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s: %(message)s')
+
+    dialog_file, fea_path = generate(args.out_dir, num_dialogs=args.num_dialogs,
+                                     vocab_size=args.vocab_size, min_frames=args.min_frames,
+                                     max_frames=args.max_frames, seed=args.seed)
+    logging.info('dialogs: %s, features: %s (--fea-type %s %s)'
+                 % (dialog_file, fea_path, AUDIO_FEATURE, VISUAL_FEATURE))
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+"""Validation of the epoch models out of the training process
+   qa_train.py --validation-worker starts this script and goes on training
+   instead of stopping for evaluate() at the end of each epoch.  Once an
+   epoch model is written, the trainer appends it to <model>.validate; the
+   worker computes its validation perplexity, with a batch size of its own
+   and without gradients, and optionally generates the summaries of a fixed
+   subset of the validation dialogs and scores them (BLEU-4 and CIDEr, with
+   pycocoevalcap).  The results are appended to <model>.validation.json, which
+   the trainer reads to select the best model.  The training options and
+   the vocabulary are read from <model>.conf.
+
+   usage: validation_worker.py --model exp/avsd_model [--batch-size 128] [--generate-dialogs 20]
+"""
+
+import argparse
+import json
+import logging
+import os
+import pickle
+import random
+import subprocess
+import sys
+import time
+
+import six
+import torch
+
+import qa_data_handler as dh
+import model_io
+
+
+def queue_file(prefix):
+    return prefix + '.validate'
+
+
+def results_file(prefix):
+    return prefix + '.validation.json'
+
+
+def _read_lines(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        # a line being written has no newline yet
+        return [json.loads(line) for line in f if line.endswith('\n')]
+
+
+def announce(prefix, epoch, model_path):
+    """Queue an epoch model, once it is completely written, for validation"""
+    with open(queue_file(prefix), 'a') as f:
+        f.write(json.dumps({'epoch': epoch, 'model': model_path}) + '\n')
+
+
+def read_results(prefix):
+    """Return {epoch: result} of the epochs validated so far"""
+    return dict((r['epoch'], r) for r in _read_lines(results_file(prefix)))
+
+
+def reset(prefix):
+    """Forget the queue and results of an earlier run"""
+    for path in (queue_file(prefix), results_file(prefix)):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def start(prefix, batch_size, device='', generate_dialogs=0):
+    """Run the worker for the training of prefix, its output going to
+       <prefix>.validation.log; return the process"""
+    cmd = [sys.executable, os.path.abspath(__file__), '--model', prefix,
+           '--batch-size', str(batch_size), '--trainer-pid', str(os.getpid()),
+           '--generate-dialogs', str(generate_dialogs)]
+    if device:
+        cmd += ['--device', device]
+    log = open(prefix + '.validation.log', 'a')
+    return subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def load_validation_data(train_args, vocab, dictmap):
+    data_cache = getattr(train_args, 'data_cache', '')
+    if data_cache and dh.is_preprocessed(data_cache):
+        (_, valid_data), _ = dh.load_preprocessed(data_cache)
+        return valid_data
+    return dh.load(train_args.fea_type, train_args.valid_path, train_args.valid_set,
+                   vocab=dict(vocab), dictmap=dictmap, include_caption=train_args.include_caption)
+
+
+def generation_scores(model, valid_data, dialogs, vocab, dictmap=None, include_caption=False,
+                      beam=3, maxlen=30, penalty=1.0):
+    """Generate the summaries of every turn of the given dialogs and score
+       them against the reference summary of their dialog"""
+    from pycocoevalcap.bleu.bleu import Bleu
+    from pycocoevalcap.cider.cider import Cider
+    from summary_generate import generate_response
+    # the features of the validation set are reused
+    data = dh.load_dialogs([], '', {'dialogs': dialogs}, vocab=dict(vocab), dictmap=dictmap,
+                           include_caption=include_caption)
+    data['features'] = valid_data['features']
+    indices, _ = dh.make_batch_indices(data, 1)
+    result = generate_response(model, data, indices, vocab, maxlen=maxlen, beam=beam,
+                               penalty=penalty, nbest=1)
+    refs, hyps = {}, {}
+    for dialog, pred in zip(dialogs, result['dialogs']):
+        for t, turn in enumerate(pred['dialog']):
+            if 'summary' in turn:
+                key = '%s_%d' % (dialog['image_id'], t)
+                refs[key] = [dialog['summary']]
+                hyps[key] = [turn['summary']]
+    if not hyps:
+        return {}
+    bleu, _ = Bleu(4).compute_score(refs, hyps)
+    cider, _ = Cider().compute_score(refs, hyps)
+    return {'bleu4': bleu[3], 'cider': cider, 'generated': len(hyps)}
+
+
+##################################
+# main
+if __name__ =="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', '-m', required=True, type=str,
+                        help='Model prefix of the training (--model of qa_train.py)')
+    parser.add_argument('--batch-size', '-b', default=128, type=int,
+                        help='Batch size of the perplexity evaluation')
+    parser.add_argument('--device', default='', type=str,
+                        help='Device of the evaluation (default: cuda:0 if available)')
+    parser.add_argument('--generate-dialogs', default=0, type=int,
+                        help='Number of validation dialogs whose summaries are generated and '
+                             'scored (0: perplexity only)')
+    parser.add_argument('--beam', default=3, type=int,
+                        help='Beam width of the generation')
+    parser.add_argument('--maxlen', default=30, type=int,
+                        help='Maximum length of the generated summaries')
+    parser.add_argument('--penalty', default=1.0, type=float,
+                        help='Penalty added to the score of each hypothesis')
+    parser.add_argument('--trainer-pid', default=0, type=int,
+                        help='Exit when this process is gone and the queue is empty')
+    parser.add_argument('--poll', default=10., type=float,
+                        help='Seconds between checks of the queue')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s [validation] %(levelname)s: %(message)s')
+
+    # the trainer writes the configuration before it starts training
+    while not os.path.exists(args.model + '.conf'):
+        time.sleep(args.poll)
+    with open(args.model + '.conf', 'rb') as f:
+        vocab, train_args = pickle.load(f)
+    if args.device:
+        device = torch.device(args.device)
+    else:
+        device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    if train_args.dictmap != '':
+        dictmap = json.load(open(train_args.dictmap, 'r'))
+    else:
+        dictmap = None
+    logging.info('Loading validation data')
+    valid_data = load_validation_data(train_args, vocab, dictmap)
+    indices, samples = dh.make_batch_indices(valid_data, args.batch_size,
+                                             max_length=train_args.max_length)
+    logging.info('#validation sample = %d, #validation batch = %d' % (samples, len(indices)))
+    if args.generate_dialogs > 0:
+        # the same dialogs at every epoch
+        dialogs = valid_data['original']['dialogs']
+        subset = sorted(random.Random(1).sample(six.moves.range(len(dialogs)),
+                                                min(args.generate_dialogs, len(dialogs))))
+        gen_dialogs = [dialogs[k] for k in subset]
+
+    from qa_train import evaluate
+    done = read_results(args.model)
+    while True:
+        pending = [e for e in _read_lines(queue_file(args.model)) if e['epoch'] not in done]
+        for entry in pending:
+            logging.info('validating epoch %d (%s)' % (entry['epoch'], entry['model']))
+            model, _, _, _ = model_io.load_model(entry['model'], args.model + '.conf', device)
+            valid_ppl, valid_time = evaluate(model, valid_data, indices)
+            result = {'epoch': entry['epoch'], 'model': entry['model'],
+                      'valid_ppl': valid_ppl, 'valid_time': valid_time}
+            if args.generate_dialogs > 0:
+                start_time = time.time()
+                result.update(generation_scores(model, valid_data, gen_dialogs, vocab, dictmap=dictmap,
+                                                include_caption=train_args.include_caption,
+                                                beam=args.beam, maxlen=args.maxlen, penalty=args.penalty))
+                result['generation_time'] = time.time() - start_time
+            with open(results_file(args.model), 'a') as f:
+                f.write(json.dumps(result) + '\n')
+            done[entry['epoch']] = result
+            logging.info('epoch %d: %s' % (entry['epoch'], ', '.join(
+                '%s %s' % (k, v) for k, v in sorted(result.items()) if k not in ('epoch', 'model'))))
+            del model
+        if len(done) >= train_args.num_epochs:
+            break
+        if args.trainer_pid and not _alive(args.trainer_pid) and not pending:
+            # the trainer wrote everything it queued before it exited
+            if not [e for e in _read_lines(queue_file(args.model)) if e['epoch'] not in done]:
+                break
+        if not pending:
+            time.sleep(args.poll)
+    logging.info('done')